@@ -0,0 +1,297 @@
+"""Benchmarks for El Caption's load, filter, edit, save and thumbnail paths.
+
+Generates synthetic datasets of PNG + txt pairs with a Zipf-distributed tag
+vocabulary in a temp directory, runs the engine against them without a
+display and prints JSON timings that can be compared between commits:
+
+    python benchmark.py --sizes 1000,10000,100000 --output before.json
+    python benchmark.py --sizes 1000,10000,100000 --output after.json
+
+Thumbnail timings need Pillow and are skipped without it.
+"""
+
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from el_caption_core import (
+    CACHE_DIR_NAME,
+    INSTRUMENTS,
+    CaptionSaver,
+    Dataset,
+    SortedTags,
+    TagSearchIndex,
+    compile_filter_query,
+    save_manifest,
+)
+
+try:
+    from PIL import Image
+    from el_caption_images import THUMBNAIL_SIZE, render_thumbnail
+except ImportError:
+    Image = None
+
+# Smallest valid PNG (1x1 gray), used when Pillow isn't installed
+TINY_PNG = bytes.fromhex(
+    "89504e470d0a1a0a0000000d4948445200000001000000010800000000"
+    "3a7e9b550000000a49444154789c636000000002000154a24f5d0000000049454e44ae426082"
+)
+
+ADJECTIVES = [
+    "red", "blue", "green", "orange", "black", "white", "long", "short", "open", "closed",
+    "small", "large", "striped", "wet", "messy", "twin", "holding", "looking at", "wearing", "bare",
+]
+NOUNS = [
+    "hair", "eyes", "hat", "dress", "shirt", "skirt", "gloves", "boots", "ribbon", "bow",
+    "sky", "tree", "window", "sword", "flower", "umbrella", "cup", "book", "cat", "background",
+]
+
+
+def make_vocabulary(size, rng):
+    """Return ``size`` distinct tag names, shaped like booru-style captions."""
+    base = [f"{adjective} {noun}" for adjective in ADJECTIVES for noun in NOUNS]
+    rng.shuffle(base)
+    tags = base[:size]
+    for index in itertools.count(1):
+        if len(tags) >= size:
+            break
+        tags.append(f"{base[index % len(base)]} ({index})")
+    return tags
+
+
+def make_png_templates(image_size, count=8):
+    """Return a few distinct encoded PNGs to copy around the dataset."""
+    if Image is None:
+        return [TINY_PNG]
+    templates = []
+    for index in range(count):
+        img = Image.linear_gradient("L").resize((image_size, image_size)).rotate(index * 45)
+        img = Image.merge("RGB", (img, img.point(lambda v, i=index: (v * (i + 1)) % 256), img))
+        path = os.path.join(tempfile.gettempdir(), f"elcaption-template-{os.getpid()}.png")
+        img.save(path, format="PNG")
+        with open(path, "rb") as f:
+            templates.append(f.read())
+        os.remove(path)
+    return templates
+
+
+def generate_dataset(directory, images, vocabulary, tags_per_image, zipf_exponent, uncaptioned, templates, rng):
+    """Write ``images`` PNG + txt pairs; return the number of captions written."""
+    weights = [1 / rank ** zipf_exponent for rank in range(1, len(vocabulary) + 1)]
+    cumulative = list(itertools.accumulate(weights))
+
+    def captions():
+        for index in range(images):
+            if rng.random() < uncaptioned:
+                yield index, None
+                continue
+            count = max(1, int(rng.gauss(tags_per_image, tags_per_image / 4)))
+            tags = dict.fromkeys(rng.choices(vocabulary, cum_weights=cumulative, k=count))
+            yield index, ", ".join(tags)
+
+    def write(item):
+        index, caption = item
+        name = f"image_{index:07d}"
+        with open(os.path.join(directory, name + ".png"), "wb") as f:
+            f.write(templates[index % len(templates)])
+        if caption is not None:
+            with open(os.path.join(directory, name + ".txt"), "w") as f:
+                f.write(caption)
+        return caption is not None
+
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        return sum(executor.map(write, captions(), chunksize=256))
+
+
+class Timings:
+    def __init__(self):
+        self.results = {}
+
+    def measure(self, name, func, *args, **kwargs):
+        started = time.perf_counter()
+        result = func(*args, **kwargs)
+        self.results[name] = time.perf_counter() - started
+        return result
+
+    def repeat(self, name, func, repeat):
+        """Record the median of ``repeat`` runs."""
+        samples = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            func()
+            samples.append(time.perf_counter() - started)
+        self.results[name] = statistics.median(samples)
+
+
+def build_vocabulary(dataset):
+    """What the UI does with each loaded batch: the sorted All Tags list and its search index."""
+    all_tags = SortedTags()
+    search = TagSearchIndex()
+    for tags in dataset.image_tags.values():
+        for tag in tags:
+            if all_tags.add(tag) is not None:
+                search.add(tag)
+    return all_tags
+
+
+def tag_at_rank(dataset, fraction):
+    """Return the tag ``fraction`` of the way down the frequency ranking (0 is the most common)."""
+    ranked = sorted(dataset.tag_counts().items(), key=lambda item: -item[1])
+    return ranked[min(len(ranked) - 1, int(len(ranked) * fraction))][0]
+
+
+def benchmark_size(directory, images, args, templates, rng):
+    """Generate one dataset and time every path against it."""
+    timings = Timings()
+    INSTRUMENTS.reset()
+    vocabulary = make_vocabulary(args.vocabulary, rng)
+    captions = timings.measure(
+        "generate",
+        generate_dataset,
+        directory, images, vocabulary, args.tags_per_image, args.zipf, args.uncaptioned, templates, rng,
+    )
+
+    # process_directory without the UI: scan, parse, index, then build the All Tags vocabulary
+    dataset = Dataset(directory)
+    reread = timings.measure("load_cold", dataset.load, known={}, max_workers=args.workers)
+    all_tags = timings.measure("build_vocabulary", build_vocabulary, dataset)
+    timings.measure("save_manifest", save_manifest, directory, dataset.manifest_entries())
+    warm = Dataset(directory)
+    timings.measure("load_manifest", warm.load, max_workers=args.workers)
+
+    # Filters, uncached: each run recompiles the query and re-evaluates it
+    common = tag_at_rank(dataset, 0.0)
+    middle = tag_at_rank(dataset, 0.05)
+    rare = tag_at_rank(dataset, 0.5)
+    queries = {
+        "filter_tag": common,
+        "filter_and": f"{common}, {middle}",
+        "filter_or": f"{middle} OR {rare}",
+        "filter_not": f"{common}, !({middle})",
+        "filter_wildcard": f"*{common.split()[-1]}",
+    }
+    matches = {}
+    for name, query in queries.items():
+        def run(query=query):
+            compile_filter_query.cache_clear()
+            dataset.filter_cache.clear()
+            return dataset.filter(query)
+        timings.repeat(name, run, args.repeat)
+        matches[name] = len(run())
+
+    # Bulk edits in memory, then drain their saves through the write-behind queue
+    renamed = timings.measure("rename_tag", dataset.rename_tag, middle, middle + " renamed")
+    deleted = timings.measure("delete_tag", dataset.delete_tag, common)
+    to_save = list(dict.fromkeys(renamed + deleted))
+
+    def drain():
+        saver = CaptionSaver()
+        for image_name in to_save:
+            saver.queue(dataset.caption_path(image_name), dataset.image_tags[image_name])
+        saver.close()
+
+    timings.measure("save_drain", drain)
+
+    result = {
+        "images": images,
+        "captions": captions,
+        "captions_parsed": reread,
+        "tags": len(all_tags),
+        "tag_occurrences": sum(len(tags) for tags in dataset.image_tags.values()),
+        "filter_matches": matches,
+        "saved_captions": len(to_save),
+    }
+
+    if Image is not None and args.thumbnails:
+        sample = rng.sample(dataset.images, min(args.thumbnails, len(dataset.images)))
+        cache_dir = os.path.join(directory, CACHE_DIR_NAME, "thumbnails")
+
+        def thumbnails():
+            with ProcessPoolExecutor(mp_context=args.mp_context) as executor:
+                for _ in executor.map(render_thumbnail, itertools.repeat(directory), itertools.repeat(cache_dir),
+                                      sample, itertools.repeat(THUMBNAIL_SIZE), chunksize=16):
+                    pass
+
+        timings.measure("thumbnails_cold", thumbnails)
+        timings.measure("thumbnails_cached", thumbnails)
+        result["thumbnails"] = len(sample)
+
+    result["seconds"] = timings.results
+    if INSTRUMENTS.enabled:
+        result["instruments"] = INSTRUMENTS.snapshot()
+    return result
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark El Caption on synthetic datasets.")
+    parser.add_argument("--sizes", default="1000,10000", help="comma-separated dataset sizes (images)")
+    parser.add_argument("--vocabulary", type=int, default=5000, help="distinct tags")
+    parser.add_argument("--tags-per-image", type=int, default=20, help="mean tags per caption")
+    parser.add_argument("--zipf", type=float, default=1.1, help="Zipf exponent of tag frequencies")
+    parser.add_argument("--uncaptioned", type=float, default=0.02, help="fraction of images without a .txt")
+    parser.add_argument("--image-size", type=int, default=256, help="edge of the generated PNGs")
+    parser.add_argument("--thumbnails", type=int, default=500, help="images thumbnailed per size (0 to skip)")
+    parser.add_argument("--repeat", type=int, default=5, help="runs per filter query (median is reported)")
+    parser.add_argument("--workers", type=int, default=8, help="threads used to read captions")
+    parser.add_argument("--instrument", action="store_true", help="include the engine's internal timers and counters")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--dir", help="where to create datasets (default: system temp)")
+    parser.add_argument("--keep", action="store_true", help="don't delete the generated datasets")
+    parser.add_argument("--output", help="write the JSON results here instead of stdout")
+    args = parser.parse_args(argv)
+    args.mp_context = multiprocessing.get_context("spawn")  # Same start method as the app's thumbnail pool
+    INSTRUMENTS.enabled = INSTRUMENTS.enabled or args.instrument
+
+    rng = random.Random(args.seed)
+    templates = make_png_templates(args.image_size)
+    report = {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "parameters": {key: value for key, value in vars(args).items() if key not in ("mp_context", "output")},
+        "results": [],
+    }
+
+    for images in (int(size) for size in args.sizes.split(",")):
+        directory = tempfile.mkdtemp(prefix=f"elcaption-bench-{images}-", dir=args.dir)
+        try:
+            result = benchmark_size(directory, images, args, templates, rng)
+        finally:
+            if not args.keep:
+                shutil.rmtree(directory, ignore_errors=True)
+        report["results"].append(result)
+        print(f"{images} images: " + ", ".join(f"{name} {seconds:.3f}s" for name, seconds in result["seconds"].items()),
+              file=sys.stderr)
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,16 +1,577 @@
 import os
-import re
+import logging
+import multiprocessing
 import threading
 import time
-import fnmatch
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from queue import Queue
 import tkinter as tk
 from tkinter import PhotoImage
 from tkinter import filedialog, messagebox
 from tkinter.ttk import Treeview
 from PIL import Image, ImageTk  # For handling and displaying thumbnails
+from el_caption_core import (
+    CACHE_DIR_NAME,
+    BatchEdit,
+    BatchEditError,
+    CaptionSaver,
+    Dataset,
+    DirectoryScanner,
+    EditJournal,
+    FilterSyntaxError,
+    INSTRUMENTS,
+    PollingWatchBackend,
+    SortedTags,
+    TagSearchIndex,
+    commit_caption_files,
+    natural_sort_key,
+    read_caption_file,
+    relative_name,
+    save_manifest,
+    split_roots,
+)
+from el_caption_duplicates import HASHERS, MAX_DISTANCE, DuplicateFinder
+from el_caption_export import EXPORT_FORMATS, SHARD_SIZE, Exporter
+from el_caption_images import THUMBNAIL_SIZE, decode_preview, render_thumbnail, thumbnail_cache_path
+from el_caption_store import CaptionStore, StoreDataset
+
+log = logging.getLogger("el_caption")
+
+# Virtualized image grid layout
+GRID_COLUMNS = 2
+GRID_CELL_WIDTH = 150
+GRID_CELL_HEIGHT = 90
+GRID_MARGIN_ROWS = 2  # Extra rows kept bound above and below the viewport
+
+
+class ThumbnailCache:
+    """Persistent on-disk cache of grid thumbnails, stored next to the dataset.
+
+    Entries are keyed by a hash of the image's relative path, mtime and size, so
+    an edited image simply misses the cache. The cache is bounded by
+    ``max_bytes``; the least recently used entries are evicted first.
+    """
+
+    TOUCH_INTERVAL = 60 * 60  # Seconds between mtime bumps of an entry in use
+
+    def __init__(self, directory, max_bytes=256 * 1024 * 1024, size=THUMBNAIL_SIZE):
+        self.directory = directory
+        self.cache_dir = os.path.join(directory, CACHE_DIR_NAME, "thumbnails")
+        self.max_bytes = max_bytes
+        self.size = size
+        self.lock = threading.Lock()
+        self.entries = None  # key -> [file size, last use], loaded lazily
+        self.total_bytes = 0
+
+    def _load_entries(self):
+        """Index the files already in the cache directory."""
+        self.entries = {}
+        self.total_bytes = 0
+        if not os.path.isdir(self.cache_dir):
+            return
+        for bucket in os.scandir(self.cache_dir):
+            if not bucket.is_dir():
+                continue
+            for entry in os.scandir(bucket.path):
+                if not entry.name.endswith(".png"):
+                    continue
+                stat = entry.stat()
+                self.entries[entry.name[:-4]] = [stat.st_size, stat.st_mtime]
+                self.total_bytes += stat.st_size
+
+    def touch(self, key):
+        """Mark an entry as recently used.
+
+        The file's mtime is bumped too, at most once per ``TOUCH_INTERVAL``,
+        so the next session's ``_load_entries`` still evicts by last use.
+        """
+        now = time.time()
+        with self.lock:
+            if self.entries is None:
+                self._load_entries()
+            entry = self.entries.get(key)
+            if entry is None:
+                return
+            stale = now - entry[1] > self.TOUCH_INTERVAL
+            entry[1] = now
+        if stale:
+            try:
+                os.utime(thumbnail_cache_path(self.cache_dir, key), (now, now))
+            except OSError:
+                pass  # Evicted meanwhile, or a read-only cache
+
+    def record(self, key, nbytes):
+        """Account for a cache lookup; ``nbytes`` is non-zero if the entry was just written."""
+        if not nbytes:
+            self.touch(key)
+            return
+
+        with self.lock:
+            if self.entries is None:
+                self._load_entries()
+            self._forget(key)
+            self.entries[key] = [nbytes, time.time()]
+            self.total_bytes += nbytes
+            if self.total_bytes > self.max_bytes:
+                self._evict()
+
+    def _forget(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.total_bytes -= entry[0]
+
+    def _evict(self):
+        """Remove least recently used entries until the cache is at 90% of its budget."""
+        target = self.max_bytes * 0.9
+        for key, _ in sorted(self.entries.items(), key=lambda item: item[1][1]):
+            if self.total_bytes <= target:
+                break
+            try:
+                os.remove(thumbnail_cache_path(self.cache_dir, key))
+            except OSError:
+                pass
+            self._forget(key)
+
+
+class ThumbnailLoader:
+    """Generates grid thumbnails in a process pool and streams them back to the Tk thread.
+
+    Jobs are submitted in the order the grid asks for them (viewport first) and
+    can be cancelled while still queued. Finished thumbnails are delivered by
+    polling a queue with ``root.after``, and the most recent ones are kept in a
+    small in-memory LRU so scrolling back doesn't need another round trip.
+    """
+
+    POLL_INTERVAL_MS = 30
+
+    def __init__(self, root, cache, on_ready, memory_entries=1024, max_workers=None):
+        self.root = root
+        self.cache = cache
+        self.on_ready = on_ready  # Called on the Tk thread with (image_name, PIL image)
+        self.memory = OrderedDict()
+        self.memory_entries = memory_entries
+        self.max_workers = max_workers or max(1, (os.cpu_count() or 2) - 1)
+        self.executor = None
+        self.pending = {}  # image_name -> Future
+        self.requested_at = {}  # image_name -> perf_counter() at request, while instrumented
+        self.results = Queue()
+        self.polling = False
+
+    def get(self, image_name):
+        """Return the thumbnail if it is already in memory, else None."""
+        img = self.memory.get(image_name)
+        if img is not None:
+            self.memory.move_to_end(image_name)
+        return img
+
+    def request(self, image_name):
+        """Queue a thumbnail for generation unless it's already pending."""
+        if image_name in self.pending:
+            return
+        if self.executor is None:
+            # Spawn rather than fork, the parent holds a display connection and threads
+            self.executor = ProcessPoolExecutor(max_workers=self.max_workers, mp_context=multiprocessing.get_context("spawn"))
+
+        future = self.executor.submit(render_thumbnail, self.cache.directory, self.cache.cache_dir, image_name, self.cache.size)
+        self.pending[image_name] = future
+        if INSTRUMENTS.enabled:
+            self.requested_at[image_name] = time.perf_counter()
+            INSTRUMENTS.gauge("thumbnail.queue_depth", len(self.pending))
+        future.add_done_callback(lambda f, name=image_name: self.results.put((name, f)))
+
+        if not self.polling:
+            self.polling = True
+            self.root.after(self.POLL_INTERVAL_MS, self._poll)
+
+    def cancel_except(self, wanted):
+        """Cancel queued jobs for images that are no longer wanted."""
+        for image_name, future in list(self.pending.items()):
+            if image_name not in wanted and future.cancel():
+                del self.pending[image_name]
+
+    def _poll(self):
+        """Hand finished thumbnails to the UI."""
+        if self.executor is None:
+            self.polling = False  # Shut down, drop whatever is left
+            return
+
+        while not self.results.empty():
+            image_name, future = self.results.get_nowait()
+            if self.pending.get(image_name) is future:
+                del self.pending[image_name]
+            requested_at = self.requested_at.pop(image_name, None)
+            if future.cancelled():
+                continue
+            try:
+                key, written, mode, size, pixels, decode_seconds = future.result()
+            except Exception as e:
+                log.warning("Error generating thumbnail for %s: %s", image_name, e)
+                continue
+
+            if INSTRUMENTS.enabled:
+                if decode_seconds:
+                    INSTRUMENTS.record("thumbnail.decode", decode_seconds)
+                else:
+                    INSTRUMENTS.count("thumbnail.disk_cache_hits")
+                if requested_at is not None:
+                    INSTRUMENTS.record("thumbnail.latency", time.perf_counter() - requested_at)
+
+            self.cache.record(key, written)
+            img = Image.frombytes(mode, size, pixels)
+            self.memory[image_name] = img
+            if len(self.memory) > self.memory_entries:
+                self.memory.popitem(last=False)
+            self.on_ready(image_name, img)
+
+        if self.pending:
+            self.root.after(self.POLL_INTERVAL_MS, self._poll)
+        else:
+            self.polling = False
+
+    def shutdown(self):
+        """Stop the worker pool, dropping any queued jobs."""
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+        self.pending.clear()
+        self.requested_at.clear()
+
+
+class PreviewCache:
+    """Memory-bounded LRU cache of Selected Image previews, already scaled to the pane.
+
+    Entries are keyed by path, mtime, size and target size. ``prefetch`` decodes
+    images on a small thread pool so stepping to a neighbour is a cache hit.
+    """
+
+    def __init__(self, max_bytes=192 * 1024 * 1024, max_workers=2):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # key -> PIL image
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.pending = {}  # key -> Future of a prefetch
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    @staticmethod
+    def key_for(image_path, width, height):
+        stat = os.stat(image_path)
+        return (image_path, stat.st_mtime_ns, stat.st_size, width, height)
+
+    def get(self, image_path, width, height):
+        """Return the preview for an image, decoding it now on a miss."""
+        key = self.key_for(image_path, width, height)
+        with self.lock:
+            img = self.entries.get(key)
+            if img is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                INSTRUMENTS.count("preview.hits")
+                return img
+            self.misses += 1
+            future = self.pending.get(key)
+        INSTRUMENTS.count("preview.misses")
+
+        # Wait for a prefetch already in flight rather than decoding twice
+        if future is not None:
+            try:
+                return future.result()
+            except Exception:
+                pass
+        with INSTRUMENTS.timer("preview.decode"):
+            img = decode_preview(image_path, width, height)
+        self._store(key, img)
+        return img
+
+    def prefetch(self, image_paths, width, height):
+        """Decode previews for ``image_paths`` in the background."""
+        for image_path in image_paths:
+            try:
+                key = self.key_for(image_path, width, height)
+            except OSError:
+                continue
+            with self.lock:
+                if key in self.entries or key in self.pending:
+                    continue
+                self.pending[key] = self.executor.submit(self._prefetch_one, key)
+
+    def _prefetch_one(self, key):
+        try:
+            with INSTRUMENTS.timer("preview.prefetch_decode"):
+                img = decode_preview(key[0], key[3], key[4])
+            self._store(key, img)
+            return img
+        finally:
+            with self.lock:
+                self.pending.pop(key, None)
+
+    def _store(self, key, img):
+        nbytes = img.width * img.height * len(img.getbands())
+        with self.lock:
+            if key in self.entries:
+                return
+            self.entries[key] = img
+            self.total_bytes += nbytes
+            while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+                _, old = self.entries.popitem(last=False)
+                self.total_bytes -= old.width * old.height * len(old.getbands())
+
+    def stats(self):
+        """Return a dict with the cache's size and hit rate."""
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "bytes": self.total_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+class DirectoryLoader:
+    """Runs a DirectoryScanner off the Tk thread and streams its batches back to the UI.
+
+    Batches are delivered through a queue that the UI drains with
+    ``root.after``.
+    """
+
+    POLL_INTERVAL_MS = 100
+
+    def __init__(self, root, directory, sort_key, on_batch, on_done, known=None, max_workers=8, roots=("",), recursive=False):
+        self.root = root
+        self.scanner = DirectoryScanner(
+            directory, known=known, sort_key=sort_key, max_workers=max_workers, roots=roots, recursive=recursive
+        )
+        self.on_batch = on_batch  # Called on the Tk thread with (batch, loaded, total)
+        self.on_done = on_done  # Called on the Tk thread with (cancelled, error)
+        self.results = Queue()
+        self.discarded = False
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    @property
+    def reread(self):
+        return self.scanner.reread
+
+    def start(self):
+        self.thread.start()
+        self.root.after(self.POLL_INTERVAL_MS, self._poll)
+
+    def cancel(self, discard=False):
+        """Stop loading after the batch in progress; ``discard`` also drops undelivered batches."""
+        self.discarded = discard
+        self.scanner.cancel()
+
+    def _run(self):
+        try:
+            for batch, loaded, total in self.scanner.batches():
+                self.results.put(("batch", batch, loaded, total))
+        except Exception as e:
+            self.results.put(("done", e))
+        else:
+            self.results.put(("done", None))
+
+    def _poll(self):
+        """Hand finished batches to the UI."""
+        if self.discarded:
+            return  # Superseded by another load
+
+        batches = []
+        while not self.results.empty():
+            item = self.results.get_nowait()
+            if item[0] == "batch":
+                batches.append(item)
+                continue
+
+            # Deliver what arrived before the end marker, then finish
+            for _, batch, loaded, total in batches:
+                self.on_batch(batch, loaded, total)
+            self.on_done(self.scanner.cancelled.is_set(), item[1])
+            return
+
+        for _, batch, loaded, total in batches:
+            self.on_batch(batch, loaded, total)
+        self.root.after(self.POLL_INTERVAL_MS, self._poll)
+
+
+class FilterWorker:
+    """Evaluates filter queries on a background thread, delivering only the latest request's result.
+
+    Every ``submit`` starts a new generation: it waits ``delay`` ms for
+    typing to pause, then runs ``evaluate`` on the worker thread. Requests
+    superseded before they start are skipped and results of superseded ones
+    are dropped, so fast typing never queues up stale work.
+    ``on_done(result, error)`` is called on the Tk thread.
+    """
+
+    POLL_INTERVAL_MS = 20
+
+    def __init__(self, root):
+        self.root = root
+        self.generation = 0
+        self.timer = None  # root.after id while waiting for typing to pause
+        self.outstanding = 0  # Requests handed to the thread and not yet back
+        self.jobs = Queue()
+        self.results = Queue()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, evaluate, on_done, delay=0):
+        self.cancel()
+        if delay:
+            self.timer = self.root.after(delay, self._start, self.generation, evaluate, on_done)
+        else:
+            self._start(self.generation, evaluate, on_done)
+
+    def cancel(self):
+        """Drop the request in progress, if any."""
+        self.generation += 1
+        if self.timer is not None:
+            self.root.after_cancel(self.timer)
+            self.timer = None
+
+    def _start(self, generation, evaluate, on_done):
+        self.timer = None
+        self.jobs.put((generation, evaluate, on_done))
+        self.outstanding += 1
+        if self.outstanding == 1:
+            self.root.after(self.POLL_INTERVAL_MS, self._poll)
+
+    def _run(self):
+        while True:
+            generation, evaluate, on_done = self.jobs.get()
+            result = error = None
+            if generation == self.generation:  # Else superseded while queued
+                try:
+                    result = evaluate()
+                except Exception as e:
+                    error = e
+            self.results.put((generation, result, error, on_done))
+
+    def _poll(self):
+        """Hand the latest result to the UI."""
+        while not self.results.empty():
+            generation, result, error, on_done = self.results.get_nowait()
+            self.outstanding -= 1
+            if generation == self.generation:
+                on_done(result, error)
+            else:
+                INSTRUMENTS.count("filter.superseded")
+        if self.outstanding:
+            self.root.after(self.POLL_INTERVAL_MS, self._poll)
+
+
+class DirectoryWatcher:
+    """Polls a watch backend on a background thread and reports what changed.
+
+    Each sweep is diffed against the previous one (the first against
+    ``baseline``, which only needs to hold the captions). Changed or new
+    captions are read on the watcher thread.
+    ``on_changes`` is called on the Tk thread with a list of events:
+
+    * ``("caption", txt_name, stat, tags)`` for a new or modified caption,
+    * ``("caption_removed", txt_name)`` for a deleted caption,
+    * ``("images", added, removed, modified)`` with lists of ``.png`` names.
+
+    Sweeps are spaced at least ``interval`` seconds apart, and further on slow
+    directories so a sweep never takes more than a fraction of the time.
+    """
+
+    POLL_INTERVAL_MS = 250
+
+    def __init__(self, root, backend, baseline, on_changes, interval=3.0):
+        self.root = root
+        self.backend = backend
+        self.previous = dict(baseline)
+        self.first_sweep = True  # Images missing from the baseline are recorded, not reported
+        self.on_changes = on_changes
+        self.interval = interval
+        self.results = Queue()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        self.root.after(self.POLL_INTERVAL_MS, self._poll)
+
+    def stop(self):
+        self.stopped.set()
+
+    def sweep(self):
+        """Compare one snapshot against the previous one and return the change events."""
+        current = self.backend.snapshot()
+        events = []
+        added_images, removed_images, modified_images = [], [], []
+
+        for name, stat in current.items():
+            previous = self.previous.get(name)
+            if previous == stat:
+                continue
+            if name.endswith(".txt"):
+                try:
+                    events.append(("caption", name, stat, self.backend.read_caption(name)))
+                except OSError:
+                    current[name] = previous  # Vanished or locked, look again next sweep
+            elif previous is None:
+                if not self.first_sweep:
+                    added_images.append(name)
+            else:
+                modified_images.append(name)
+
+        for name in self.previous.keys() - current.keys():
+            if name.endswith(".txt"):
+                events.append(("caption_removed", name))
+            else:
+                removed_images.append(name)
+
+        if added_images or removed_images or modified_images:
+            events.append(("images", added_images, removed_images, modified_images))
+        self.previous = {name: stat for name, stat in current.items() if stat is not None}
+        self.first_sweep = False
+        return events
+
+    def _run(self):
+        while not self.stopped.is_set():
+            started = time.monotonic()
+            try:
+                events = self.sweep()
+            except OSError as e:
+                log.warning("Error watching directory: %s", e)
+                events = []
+            if events:
+                self.results.put(events)
+
+            elapsed = time.monotonic() - started
+            self.stopped.wait(max(self.interval, elapsed * 4))
+
+    def _poll(self):
+        """Hand change events to the UI."""
+        if self.stopped.is_set():
+            return
+        while not self.results.empty():
+            self.on_changes(self.results.get_nowait())
+        self.root.after(self.POLL_INTERVAL_MS, self._poll)
+
 
 class ImageTaggerApp:
+    AUTOCOMPLETE_SIZE = 8  # Suggestions shown under the Add Tag field
+    PREFETCH_NEIGHBORS = 2  # Previews decoded ahead of and behind the selected image
+    CONFLICT_POLL_MS = 500
+    COOCCURRENCE_ROWS = 200  # Most frequent co-occurring tags listed
+    DUPLICATE_POLL_MS = 100
+    EXPORT_POLL_MS = 100
+    BACKGROUND_POLL_MS = 50
+    FILTER_DEBOUNCE_MS = 150  # Pause in typing before a filter-as-you-type query runs
+    ALL_TAGS_DEBOUNCE_MS = 100
+    SAVE_DELAY = 2.0  # Seconds caption writes wait to coalesce edits, once the journal makes them durable
+    BATCH_OPERATIONS = ("Add", "Remove", "Rename / Merge", "Reorder")
+
     def __init__(self, root):
         self.root = root
         self.root.title("El Caption")
@@ -19,91 +580,125 @@ class ImageTaggerApp:
         self.root.iconphoto(False, PhotoImage(file=icon_path))
 
         # Background saving variables
-        self.save_queue = Queue()
-        self.save_thread = threading.Thread(target=self.process_save_queue, daemon=True)
-        self.save_thread.start()
+        self.saver = CaptionSaver()
 
         # Other variables
         self.directory = ""
-        self.images = []
+        self.dataset = Dataset()
+        self.loaded_directory = None  # Directory whose load completed, eligible for a rescan
         self.current_image_index = -1
-        self.all_tags = set()
-        self.image_tags = {}
+        self.all_tags = SortedTags()
+        self.visible_tags = SortedTags()  # Tags shown in the All Tags list, one per row
+        self.shown_counts = {}  # tag -> count its All Tags row was sorted by, when sorting by frequency
+        self.tag_search = TagSearchIndex()
+        self.highlighted_tags = set()  # Tags whose All Tags row is highlighted
+        self.image_tag_rows = {}  # tag -> row in the Image Tags list
+        self.all_tags_query = ""
+        self.thumbnail_cache = None
+        self.thumbnail_loader = None
+        self.directory_loader = None
+        self.watcher = None
+        self.batch_edit = BatchEdit()  # Operations staged in the Batch Edit window
+        self.filter_worker = FilterWorker(self.root)
+        self.all_tags_filter_timer = None
+        self.journal = None  # EditJournal of the loaded directory
+        self.store = None  # CaptionStore the dataset is paged from, when loaded with the SQLite store
+        self.store_flush_timer = None
+        self.batch_window = None
+        self.flush_window = None  # Shown while queued saves are written before closing or switching directories
+        self.diagnostics_window = None
+        self.cooccurrence_window = None
+        self.cooccurrence_tag = None
+        self.duplicates_window = None
+        self.duplicate_finder = None  # DuplicateFinder while a search runs
+        self.duplicate_groups = []  # Lists of image names from the last search
+        self.export_window = None
+        self.exporter = None  # Exporter while an export runs
+
+        self.preview_cache = PreviewCache()
+
+        # Virtualized grid state
+        self.grid_images = []
+        self.grid_positions = None  # image name -> index in grid_images, built on demand
+        self.grid_cells = []
         
         self.root.protocol("WM_DELETE_WINDOW", self.on_close)
 
         # UI Elements
         self.create_ui()
-        
-    def process_save_queue(self):
-        """Background thread to handle file saves."""
-        while True:
-            item = self.save_queue.get()  # Get the next file to save
-            if item == (None, None):  # Exit signal
-                print("Exiting save thread...")
-                self.save_queue.task_done()
-                break
-
-            image_name, tags = item
-            if image_name is not None and tags is not None:  # Ensure valid data
-                try:
-                    tag_file = os.path.splitext(image_name)[0] + ".txt"
-                    tag_path = os.path.join(self.directory, tag_file)
-
-                    # Write tags to the file
-                    with open(tag_path, "w") as f:
-                        f.write(", ".join(tags))
-                except Exception as e:
-                    print(f"Error saving file {image_name}: {e}")
-
-            self.save_queue.task_done()  # Mark task as complete
-            time.sleep(0.1)  # Slight delay to avoid overloading resources
 
+        self.root.after(self.CONFLICT_POLL_MS, self.poll_save_conflicts)
+        
     def parse_filter_query(self, query):
         """Parse the filter query and return a list of matching image names."""
-        filtered_images = []
-
-        # Preprocess query
-        query = query.strip()
-        include_tags = []
-        exclude_tags = []
-
-        # Handle NOT conditions first
-        not_matches = re.findall(r"!\(([^)]+)\)", query)
-        exclude_tags = [tag.strip() for tag in not_matches]
-        query = re.sub(r"!\([^)]+\)", "", query)
-
-        # Handle OR conditions
-        if "OR" in query:
-            or_tags = [tag.strip() for tag in query.split("OR") if tag.strip()]
-            for image_name, tags in self.image_tags.items():
-                if any(tag in tags for tag in or_tags):
-                    filtered_images.append(image_name)
-        else:
-            # Handle AND conditions (comma-separated or remaining tags)
-            include_tags = [tag.strip() for tag in query.split(",") if tag.strip()]
-            for image_name, tags in self.image_tags.items():
-                # Match inclusion and exclusion conditions
-                if all(any(fnmatch.fnmatch(t, pattern) for t in tags) for pattern in include_tags) and not any(
-                    any(fnmatch.fnmatch(t, pattern) for t in tags) for pattern in exclude_tags
-                ):
-                    filtered_images.append(image_name)
-
-        return filtered_images
+        return self.dataset.filter(query)
 
 
     def apply_filter(self):
         """Apply the filter and update the image grid."""
+        self.request_filter(explicit=True)
+
+    def on_filter_typed(self, event):
+        if self.live_filter.get() and event.keysym != "Return":
+            self.request_filter(self.FILTER_DEBOUNCE_MS)
+
+    def request_filter(self, delay=0, explicit=False):
+        """Filter the grid by the query in the filter entry, evaluating it in the background.
+
+        ``explicit`` requests (Apply, Enter) report syntax errors in a dialog;
+        filter-as-you-type ones only in the Images label.
+        """
         query = self.filter_entry.get().strip()
         if not query:
             # If query is empty, reset to show all images
-            self.display_thumbnails(self.images)
+            self.filter_worker.cancel()
+            self.display_thumbnails(self.dataset.images)
             return
 
-        # Get filtered images
-        filtered_images = self.parse_filter_query(query)
+        dataset = self.dataset
+        if self.store is not None:
+            # Counted in SQL on the worker; the grid then pages the matches in as it shows them
+            self.filter_worker.submit(
+                lambda: dataset.filter(query),
+                lambda result, error: self.on_filter_evaluated(dataset, query, None, explicit, result, error),
+                delay,
+            )
+            return
 
-        # Update the grid with filtered images
+        filtered_images = self.dataset.cached_filter(query)
+        if filtered_images is not None:
+            self.filter_worker.cancel()
+            self.display_thumbnails(filtered_images)
+            return
+
+        version = dataset.tag_index.version
+        self.filter_worker.submit(
+            lambda: dataset.evaluate_filter(query),
+            lambda result, error: self.on_filter_evaluated(dataset, query, version, explicit, result, error),
+            delay,
+        )
+
+    def on_filter_evaluated(self, dataset, query, version, explicit, filtered_images, error):
+        """Show a filter result from the worker, unless the tags changed while it was evaluated.
+
+        ``version`` is None for store queries, which read the tags as they are.
+        """
+        if dataset is not self.dataset:
+            return  # Another directory was loaded since
+        if version is not None and version != dataset.tag_index.version:
+            self.request_filter(explicit=explicit)  # The result may be stale, evaluate again
+            return
+        if error is not None:
+            if not isinstance(error, FilterSyntaxError):
+                raise error
+            if explicit:
+                messagebox.showerror("Invalid Filter", str(error))
+            else:
+                self.images_label.config(text=f"Images: {error}")
+            return
+
+        if version is not None:
+            dataset.cache_filter(query, version, filtered_images)
         self.display_thumbnails(filtered_images)
 
 
@@ -122,9 +717,31 @@ class ImageTaggerApp:
         self.dir_button = tk.Button(self.dir_frame, text="Browse", command=self.select_directory)
         self.dir_button.pack(side=tk.LEFT, padx=5)
 
+        # Several folders, separated by os.pathsep in the entry, load as one dataset
+        self.add_dir_button = tk.Button(self.dir_frame, text="Add Folder", command=self.add_directory)
+        self.add_dir_button.pack(side=tk.LEFT)
+
+        self.recursive_var = tk.BooleanVar(value=False)
+        self.recursive_checkbox = tk.Checkbutton(self.dir_frame, text="Include subfolders", variable=self.recursive_var)
+        self.recursive_checkbox.pack(side=tk.LEFT, padx=5)
+
+        # Large datasets can be paged out of an SQLite store instead of loaded into memory
+        self.store_var = tk.BooleanVar(value=False)
+        self.store_checkbox = tk.Checkbutton(self.dir_frame, text="Use SQLite store", variable=self.store_var)
+        self.store_checkbox.pack(side=tk.LEFT)
+
         self.process_button = tk.Button(self.dir_frame, text="Process Images and Tags", command=self.process_directory)
         self.process_button.pack(side=tk.LEFT, padx=5)
 
+        self.cancel_load_button = tk.Button(self.dir_frame, text="Cancel", command=self.cancel_directory_load, state=tk.DISABLED)
+        self.cancel_load_button.pack(side=tk.LEFT, padx=5)
+
+        self.diagnostics_button = tk.Button(self.dir_frame, text="Diagnostics", command=self.open_diagnostics)
+        self.diagnostics_button.pack(side=tk.RIGHT, padx=5)
+
+        self.load_status = tk.Label(self.dir_frame, text="", anchor="w")
+        self.load_status.pack(side=tk.LEFT, padx=5)
+
         # Main layout (panes)
         self.main_pane = tk.PanedWindow(self.root, orient=tk.HORIZONTAL)
         self.main_pane.pack(side=tk.RIGHT, fill=tk.BOTH, expand=True, padx=5, pady=5)
@@ -144,12 +761,34 @@ class ImageTaggerApp:
         self.filter_label = tk.Label(self.filter_frame, text="Filter:")
         self.filter_label.pack(side=tk.LEFT)
 
+        self.live_filter = tk.BooleanVar(value=False)
+        self.live_filter_checkbox = tk.Checkbutton(self.filter_frame, text="As you type", variable=self.live_filter)
+        self.live_filter_checkbox.pack(side=tk.LEFT)
+
         self.filter_button = tk.Button(self.filter_frame, text="Apply", command=self.apply_filter)
         self.filter_button.pack(side=tk.RIGHT)
 
+        self.batch_edit_button = tk.Button(self.filter_frame, text="Batch Edit...", command=self.open_batch_edit)
+        self.batch_edit_button.pack(side=tk.RIGHT, padx=5)
+
+        self.duplicates_button = tk.Button(self.filter_frame, text="Duplicates...", command=self.open_duplicates)
+        self.duplicates_button.pack(side=tk.RIGHT)
+
+        self.export_button = tk.Button(self.filter_frame, text="Export...", command=self.open_export)
+        self.export_button.pack(side=tk.RIGHT, padx=(0, 5))
+
+        self.redo_button = tk.Button(self.filter_frame, text="Redo", command=self.redo_edit, state=tk.DISABLED)
+        self.redo_button.pack(side=tk.RIGHT)
+        self.undo_button = tk.Button(self.filter_frame, text="Undo", command=self.undo_edit, state=tk.DISABLED)
+        self.undo_button.pack(side=tk.RIGHT, padx=5)
+        self.root.bind("<Control-z>", self.undo_edit)
+        self.root.bind("<Control-y>", self.redo_edit)
+        self.root.bind("<Control-Z>", self.redo_edit)
+
         self.filter_entry = tk.Entry(self.images_frame, width=40)
         self.filter_entry.pack(fill=tk.X, padx=5, pady=2)
         self.filter_entry.bind("<Return>", lambda event: self.apply_filter())
+        self.filter_entry.bind("<KeyRelease>", self.on_filter_typed)
 
         # Images Grid
         self.images_canvas = tk.Canvas(self.images_frame, width=300)
@@ -158,10 +797,15 @@ class ImageTaggerApp:
         self.images_scroll = tk.Scrollbar(self.images_frame, orient="vertical", command=self.images_canvas.yview)
         self.images_scroll.pack(side=tk.RIGHT, fill=tk.Y)
 
-        self.images_canvas.configure(yscrollcommand=self.images_scroll.set)
-        self.images_inner_frame = tk.Frame(self.images_canvas, width=300)
-        self.images_canvas.create_window((0, 0), window=self.images_inner_frame, anchor="nw")
-        self.images_inner_frame.bind("<Configure>", lambda e: self.images_canvas.configure(scrollregion=self.images_canvas.bbox("all")))
+        # The grid is virtualized: a small pool of cells covers the viewport and
+        # is rebound to other images as the canvas scrolls
+        self.images_canvas.configure(yscrollcommand=self._on_images_scrolled, yscrollincrement=GRID_CELL_HEIGHT // 3)
+        self.images_canvas.bind("<Configure>", lambda e: self.render_visible_thumbnails())
+        self._bind_mouse_wheel(self.images_canvas)
+
+        # Shown in grid cells while their thumbnail is being generated
+        self.placeholder_thumbnail = PhotoImage(width=THUMBNAIL_SIZE, height=THUMBNAIL_SIZE)
+        self.placeholder_thumbnail.put("gray80", to=(0, 0, THUMBNAIL_SIZE, THUMBNAIL_SIZE))
 
         # Right panes: Selected image and tags
         self.right_pane = tk.PanedWindow(self.main_pane, orient=tk.HORIZONTAL)
@@ -177,6 +821,9 @@ class ImageTaggerApp:
         self.image_display = tk.Label(self.image_frame, bg="gray")
         self.image_display.pack(fill=tk.BOTH, expand=True)
 
+        self.preview_stats_label = tk.Label(self.image_frame, text="", anchor="w")
+        self.preview_stats_label.pack(fill=tk.X)
+
         # Tags section
         self.tags_pane = tk.PanedWindow(self.right_pane, orient=tk.HORIZONTAL)
         self.right_pane.add(self.tags_pane, minsize=200)
@@ -203,6 +850,12 @@ class ImageTaggerApp:
         self.all_tags_filter_frame = tk.Frame(self.all_tags_frame)
         self.all_tags_filter_frame.pack(fill=tk.X, padx=5, pady=2)
 
+        self.sort_tags_by_frequency = tk.BooleanVar(value=False)
+        self.sort_tags_checkbox = tk.Checkbutton(
+            self.all_tags_filter_frame, text="By count", variable=self.sort_tags_by_frequency, command=self.change_all_tags_sort
+        )
+        self.sort_tags_checkbox.pack(side=tk.RIGHT)
+
         self.all_tags_filter_entry = tk.Entry(self.all_tags_filter_frame, width=40)
         self.all_tags_filter_entry.pack(fill=tk.X, padx=5)
         self.all_tags_filter_entry.bind("<KeyRelease>", self.update_all_tags_filter)
@@ -211,12 +864,14 @@ class ImageTaggerApp:
         self.all_tags_list.pack(fill=tk.BOTH, expand=True)
         self.all_tags_list.bind("<Double-1>", self.add_tag_to_current_image)
         self.all_tags_list.bind("<<ListboxSelect>>", self.find_tag_in_image_tags)
+        self.all_tags_list.bind("<<ListboxSelect>>", self.follow_cooccurrence, add="+")
         
         # Create a context menu for the All Tags list
         self.all_tags_menu = tk.Menu(self.all_tags_list, tearoff=0)
         self.all_tags_menu.add_command(label="Rename", command=self.rename_tag)
         self.all_tags_menu.add_command(label="Delete", command=self.delete_tag)
         self.all_tags_menu.add_command(label="Filter", command=self.filter_by_tag)  # Add Filter option
+        self.all_tags_menu.add_command(label="Co-occurring Tags...", command=self.open_cooccurrence)
 
         # Bind the right-click event to show the context menu
         self.all_tags_list.bind("<Button-3>", self.show_all_tags_menu)  # For Windows/Linux
@@ -231,6 +886,22 @@ class ImageTaggerApp:
 
         self.add_tag_button = tk.Button(self.add_tag_frame, text="Add Tag", command=self.add_new_tag)
         self.add_tag_button.pack(side=tk.LEFT)
+
+        # Autocomplete dropdown for the Add Tag field
+        self.autocomplete_window = tk.Toplevel(self.root)
+        self.autocomplete_window.withdraw()
+        self.autocomplete_window.overrideredirect(True)
+        self.autocomplete_list = tk.Listbox(self.autocomplete_window, height=self.AUTOCOMPLETE_SIZE, exportselection=False)
+        self.autocomplete_list.pack(fill=tk.BOTH, expand=True)
+        # Accept on press, before the entry's focus-out hides the list
+        self.autocomplete_list.bind("<Button-1>", lambda event: self.accept_autocomplete(self.autocomplete_list.nearest(event.y)))
+
+        self.add_tag_entry.bind("<KeyRelease>", self.update_autocomplete)
+        self.add_tag_entry.bind("<Down>", lambda event: self.move_autocomplete(1))
+        self.add_tag_entry.bind("<Up>", lambda event: self.move_autocomplete(-1))
+        self.add_tag_entry.bind("<Return>", lambda event: self.accept_autocomplete())
+        self.add_tag_entry.bind("<Escape>", lambda event: self.hide_autocomplete())
+        self.add_tag_entry.bind("<FocusOut>", lambda event: self.root.after(200, self.hide_autocomplete))
         
     def filter_by_tag(self):
         """Filter images by the selected tag."""
@@ -239,7 +910,7 @@ class ImageTaggerApp:
             return
 
         # Get the selected tag
-        selected_tag = self.all_tags_list.get(selection[0])
+        selected_tag = self.visible_tags[selection[0]]
 
         # Update the filter entry with the selected tag and apply the filter
         self.filter_entry.delete(0, tk.END)
@@ -258,50 +929,123 @@ class ImageTaggerApp:
             messagebox.showwarning("Empty Tag", "Tag cannot be empty.")
             return
 
-        image_name = self.images[self.current_image_index]
+        image_name = self.dataset.images[self.current_image_index]
 
         # Check if the tag already exists for the image
-        if new_tag in self.image_tags[image_name]:
+        if new_tag in self.dataset.tags_of(image_name):
             messagebox.showinfo("Tag Exists", f"The tag '{new_tag}' already exists for this image.")
             return
 
+        # Warn before creating a near-duplicate of an existing tag
+        if new_tag not in self.all_tags:
+            similar = sorted(self.tag_search.near_duplicates(new_tag), key=self.natural_sort_key)
+            if similar and not messagebox.askyesno(
+                "Similar Tag Exists",
+                f"'{new_tag}' is new, but similar tags already exist: {', '.join(similar)}.\n\nAdd '{new_tag}' anyway?",
+            ):
+                return
+
+        self.hide_autocomplete()
+
         # Add the tag to the image
-        self.image_tags[image_name].append(new_tag)
+        old_tags = self.dataset.tags_of(image_name)
+        self.dataset.add_tag(image_name, new_tag)
 
         # Update the All Tags list
-        if new_tag not in self.all_tags:
-            self.all_tags.add(new_tag)
-
-            # Add the new tag in alphabetical order
-            index = sorted(self.all_tags, key=self.natural_sort_key).index(new_tag)
-            self.all_tags_list.insert(index, new_tag)
+        self.add_to_all_tags(new_tag)
 
         # Highlight the tag in All Tags if it belongs to the current image
         self.update_all_tags_highlight()
 
         # Update the Image Tags list
         self.image_tags_list.insert(tk.END, new_tag)
+        self.image_tag_rows.setdefault(new_tag, self.image_tags_list.size() - 1)
 
         # Clear the entry field
         self.add_tag_entry.delete(0, tk.END)
 
         # Save the changes
-        self.queue_file_save(image_name)
+        self.record_edit(f"Add '{new_tag}'", [(image_name, old_tags)])
 
-        print(f"Added tag: {new_tag} to image: {image_name}")
+        INSTRUMENTS.count("edit.tags_added")
 
 
+    def update_autocomplete(self, event=None):
+        """Suggest existing tags, most used first, for the text in the Add Tag field."""
+        if event is not None and event.keysym in ("Up", "Down", "Return", "Escape"):
+            return
+
+        text = self.add_tag_entry.get().strip()
+        if not text:
+            self.hide_autocomplete()
+            return
+
+        current_tags = set()
+        if self.current_image_index != -1:
+            current_tags = set(self.dataset.tags_of(self.dataset.images[self.current_image_index]))
+
+        suggestions = [
+            tag for tag in self.tag_search.ranked(text, self.dataset.tag_count, limit=self.AUTOCOMPLETE_SIZE + len(current_tags))
+            if tag not in current_tags
+        ][:self.AUTOCOMPLETE_SIZE]
+        if not suggestions:
+            self.hide_autocomplete()
+            return
+
+        self.autocomplete_list.delete(0, tk.END)
+        self.autocomplete_list.insert(tk.END, *suggestions)
+        self.autocomplete_list.config(height=len(suggestions))
+
+        # Drop the list just below the entry
+        x = self.add_tag_entry.winfo_rootx()
+        y = self.add_tag_entry.winfo_rooty() + self.add_tag_entry.winfo_height()
+        self.autocomplete_window.geometry(f"+{x}+{y}")
+        self.autocomplete_window.deiconify()
+        self.autocomplete_window.lift()
+
+    def move_autocomplete(self, step):
+        """Move the highlighted suggestion up or down."""
+        if not self.autocomplete_window.winfo_viewable():
+            return
+        selection = self.autocomplete_list.curselection()
+        index = selection[0] + step if selection else (0 if step > 0 else self.autocomplete_list.size() - 1)
+        index = max(0, min(index, self.autocomplete_list.size() - 1))
+        self.autocomplete_list.selection_clear(0, tk.END)
+        self.autocomplete_list.selection_set(index)
+        self.autocomplete_list.see(index)
+        return "break"
+
+    def accept_autocomplete(self, index=None):
+        """Add the chosen suggestion, or the typed text if none is chosen."""
+        if index is None and self.autocomplete_window.winfo_viewable():
+            selection = self.autocomplete_list.curselection()
+            index = selection[0] if selection else None
+        if index is not None:
+            self.add_tag_entry.delete(0, tk.END)
+            self.add_tag_entry.insert(0, self.autocomplete_list.get(index))
+        self.hide_autocomplete()
+        self.add_new_tag()
+
+    def hide_autocomplete(self):
+        self.autocomplete_list.selection_clear(0, tk.END)
+        self.autocomplete_window.withdraw()
+
     def update_all_tags_filter(self, event=None):
-        """Filter the All Tags list based on the text in the filter entry."""
+        """Filter the All Tags list based on the text in the filter entry, once typing pauses."""
         if event and event.widget != self.all_tags_filter_entry:
             return  # Ignore events from other widgets
 
-        query = self.all_tags_filter_entry.get().strip().lower()
-        self.all_tags_list.delete(0, tk.END)
+        if self.all_tags_filter_timer is not None:
+            self.root.after_cancel(self.all_tags_filter_timer)
+        self.all_tags_filter_timer = self.root.after(self.ALL_TAGS_DEBOUNCE_MS, self.apply_all_tags_filter)
 
-        for tag in sorted(self.all_tags, key=self.natural_sort_key):
-            if query in tag.lower():
-                self.all_tags_list.insert(tk.END, tag)
+    def apply_all_tags_filter(self):
+        self.all_tags_filter_timer = None
+        query = self.all_tags_filter_entry.get().strip().lower()
+        if query == self.all_tags_query:
+            return  # E.g. only the cursor moved
+        self.all_tags_query = query
+        self.refresh_all_tags_list()
 
         # Reapply highlight to the tags in the current image
         self.update_all_tags_highlight()
@@ -316,15 +1060,15 @@ class ImageTaggerApp:
             self.all_tags_list.selection_set(index)
             self.all_tags_menu.post(event.x_root, event.y_root)
         except Exception as e:
-            print(f"Error showing context menu: {e}")
+            log.warning("Error showing context menu: %s", e)
 
     def delete_tag(self):
         """Delete a tag from all images and All Tags."""
         selection = self.all_tags_list.curselection()
-        if not selection:
+        if not selection or self.store_unsupported("Delete Tag"):
             return
 
-        tag_to_delete = self.all_tags_list.get(selection[0])
+        tag_to_delete = self.visible_tags[selection[0]]
 
         # Confirm deletion
         confirm = messagebox.askyesno("Delete Tag", f"Are you sure you want to delete '{tag_to_delete}' from all images?")
@@ -335,16 +1079,12 @@ class ImageTaggerApp:
         scroll_position = self.all_tags_list.yview()
         selected_index = self.all_tags_list.curselection()
 
-        # Remove the tag from all images and queue for saving
-        images_to_save = []
-        for image_name, tags in self.image_tags.items():
-            if tag_to_delete in tags:
-                tags.remove(tag_to_delete)
-                images_to_save.append(image_name)
+        # Remove the tag from all images that carry it and queue for saving
+        old_tags = {image_name: self.dataset.tags_of(image_name) for image_name in self.dataset.images_with(tag_to_delete)}
+        images_to_save = self.dataset.delete_tag(tag_to_delete)
 
         # Remove the tag from All Tags
-        if tag_to_delete in self.all_tags:
-            self.all_tags.remove(tag_to_delete)
+        self.remove_from_all_tags(tag_to_delete)
 
         # Update UI
         self.update_ui()
@@ -354,26 +1094,19 @@ class ImageTaggerApp:
         if selected_index:
             self.all_tags_list.selection_set(selected_index[0])
 
-        # Queue file operations in the background
-        threading.Thread(target=self.queue_deletion_operations, args=(images_to_save, tag_to_delete)).start()
-
-        print(f"Deleted tag: {tag_to_delete}")
-
-    def queue_deletion_operations(self, images_to_save, tag_to_delete):
-        """Handle file updates for deletions in the background."""
-        for image_name in images_to_save:
-            self.queue_file_save(image_name)
+        # Queue updated images for saving
+        self.record_edit(f"Delete '{tag_to_delete}'", [(image_name, old_tags[image_name]) for image_name in images_to_save])
 
-        print(f"Completed deletion operations for tag: {tag_to_delete}")
+        log.info("Deleted tag '%s' from %d images", tag_to_delete, len(images_to_save))
 
     
     def rename_tag(self):
         """Rename a tag across all images."""
         selection = self.all_tags_list.curselection()
-        if not selection:
+        if not selection or self.store_unsupported("Rename Tag"):
             return
 
-        old_tag = self.all_tags_list.get(selection[0])
+        old_tag = self.visible_tags[selection[0]]
 
         # Prompt for the new tag name
         new_tag = tk.simpledialog.askstring("Rename Tag", f"Rename '{old_tag}' to:")
@@ -385,21 +1118,13 @@ class ImageTaggerApp:
         scroll_position = self.all_tags_list.yview()
         selected_index = self.all_tags_list.curselection()
 
-        images_to_save = set()  # Track images that need saving
-        new_all_tags = set(self.all_tags)  # Copy current tags
-
-        # Update tags across all images
-        for image_name, tags in self.image_tags.items():
-            if old_tag in tags:
-                tags.remove(old_tag)
-                if new_tag not in tags:  # Avoid duplicates
-                    tags.append(new_tag)
-                images_to_save.add(image_name)
+        # Update tags across all images that carry the old tag
+        old_tags = {image_name: self.dataset.tags_of(image_name) for image_name in self.dataset.images_with(old_tag)}
+        images_to_save = self.dataset.rename_tag(old_tag, new_tag)
 
         # Update All Tags
-        new_all_tags.discard(old_tag)
-        new_all_tags.add(new_tag)
-        self.all_tags = new_all_tags
+        self.remove_from_all_tags(old_tag)
+        self.add_to_all_tags(new_tag)
 
         # Update UI
         self.update_ui()
@@ -410,13 +1135,202 @@ class ImageTaggerApp:
             self.all_tags_list.selection_set(selected_index[0])
 
         # Queue updated images for saving
-        for image_name in images_to_save:
-            self.queue_file_save(image_name)
+        self.record_edit(
+            f"Rename '{old_tag}' to '{new_tag}'", [(image_name, old_tags[image_name]) for image_name in images_to_save]
+        )
+
+        log.info("Renamed tag '%s' to '%s' on %d images", old_tag, new_tag, len(images_to_save))
+
+
+
+
+    def open_batch_edit(self):
+        """Open the window for staging tag operations on the images shown in the grid."""
+        if self.store_unsupported("Batch Edit"):
+            return
+        if self.batch_window is not None and self.batch_window.winfo_exists():
+            self.batch_window.lift()
+            self.update_batch_scope()
+            return
+
+        self.batch_window = tk.Toplevel(self.root)
+        self.batch_window.title("Batch Edit")
+        self.batch_window.transient(self.root)
+
+        self.batch_scope_label = tk.Label(self.batch_window, anchor="w")
+        self.batch_scope_label.pack(fill=tk.X, padx=5, pady=5)
+
+        form = tk.Frame(self.batch_window)
+        form.pack(fill=tk.X, padx=5)
+
+        self.batch_operation = tk.StringVar(value=self.BATCH_OPERATIONS[0])
+        tk.OptionMenu(form, self.batch_operation, *self.BATCH_OPERATIONS).pack(side=tk.LEFT)
+
+        tk.Label(form, text="Tags:").pack(side=tk.LEFT)
+        self.batch_tags_entry = tk.Entry(form, width=30)
+        self.batch_tags_entry.pack(side=tk.LEFT, padx=5)
+
+        tk.Label(form, text="Into:").pack(side=tk.LEFT)
+        self.batch_target_entry = tk.Entry(form, width=20)
+        self.batch_target_entry.pack(side=tk.LEFT, padx=5)
+
+        tk.Button(form, text="Stage", command=self.stage_batch_operation).pack(side=tk.LEFT)
+        self.batch_tags_entry.bind("<Return>", lambda event: self.stage_batch_operation())
+        self.batch_target_entry.bind("<Return>", lambda event: self.stage_batch_operation())
 
-        print(f"Renamed tag '{old_tag}' to '{new_tag}'. Updated {len(images_to_save)} images.")
+        self.batch_list = tk.Listbox(self.batch_window, height=10)
+        self.batch_list.pack(fill=tk.BOTH, expand=True, padx=5, pady=5)
 
+        buttons = tk.Frame(self.batch_window)
+        buttons.pack(fill=tk.X, padx=5, pady=5)
+        tk.Button(buttons, text="Unstage", command=self.unstage_batch_operation).pack(side=tk.LEFT)
+        tk.Button(buttons, text="Close", command=self.batch_window.destroy).pack(side=tk.RIGHT)
+        self.batch_apply_button = tk.Button(buttons, text="Apply", command=self.apply_batch_edit)
+        self.batch_apply_button.pack(side=tk.RIGHT, padx=5)
 
+        self.refresh_batch_list()
+        self.update_batch_scope()
 
+    def update_batch_scope(self):
+        self.batch_scope_label.config(
+            text=f"Operations apply to the {len(self.grid_images)} images shown in the grid (the current filter)."
+        )
+
+    def refresh_batch_list(self):
+        self.batch_list.delete(0, tk.END)
+        self.batch_list.insert(tk.END, *(BatchEdit.describe(operation) for operation in self.batch_edit.operations))
+
+    def stage_batch_operation(self):
+        """Add the operation described by the Batch Edit form to the staged list."""
+        operation = self.batch_operation.get()
+        tags = [tag.strip() for tag in self.batch_tags_entry.get().split(",") if tag.strip()]
+        target = self.batch_target_entry.get().strip()
+
+        if not tags:
+            messagebox.showwarning("Empty Tag", "Enter one or more tags, separated by commas.", parent=self.batch_window)
+            return
+        if operation == "Rename / Merge" and not target:
+            messagebox.showwarning("Empty Tag", "Enter the tag to rename or merge into.", parent=self.batch_window)
+            return
+
+        if operation == "Add":
+            for tag in tags:
+                self.batch_edit.add(tag)
+        elif operation == "Remove":
+            for tag in tags:
+                self.batch_edit.remove(tag)
+        elif operation == "Reorder":
+            self.batch_edit.reorder(tags)
+        elif len(tags) == 1:
+            self.batch_edit.rename(tags[0], target)
+        else:
+            self.batch_edit.merge(tags, target)
+
+        self.batch_tags_entry.delete(0, tk.END)
+        self.batch_target_entry.delete(0, tk.END)
+        self.refresh_batch_list()
+
+    def unstage_batch_operation(self):
+        selection = self.batch_list.curselection()
+        if selection:
+            del self.batch_edit.operations[selection[0]]
+            self.refresh_batch_list()
+
+    def apply_batch_edit(self):
+        """Apply the staged operations to the images in the grid, writing each changed caption once."""
+        self.update_batch_scope()
+        if not self.batch_edit.operations:
+            return
+
+        plan = self.batch_edit.plan(self.dataset, self.grid_images)
+        if not plan:
+            messagebox.showinfo("Batch Edit", "No caption in the grid would change.", parent=self.batch_window)
+            return
+        if not messagebox.askyesno(
+            "Batch Edit",
+            f"Apply {len(self.batch_edit.operations)} operations, changing {len(plan)} caption files?",
+            parent=self.batch_window,
+        ):
+            return
+
+        # Captions are written in the background; the window stays modal so the grid can't change meanwhile
+        self.batch_window.grab_set()
+        self.batch_apply_button.config(state=tk.DISABLED)
+        self.batch_scope_label.config(text="Saving queued captions...")
+        dataset = self.dataset
+
+        def write_batch(_, error):
+            # Queued saves of the same captions had to land first, or they would be checked against stale stats
+            changes = dataset.batch_changes(plan, expected_stat=self.known_caption_stat)
+            if self.batch_window_open():
+                self.batch_scope_label.config(text=f"Writing {len(changes)} caption files...")
+            self.run_in_background(
+                lambda: commit_caption_files(changes),
+                lambda new_stats, error: self.finish_batch_edit(dataset, plan, new_stats, error),
+            )
+
+        self.run_in_background(self.saver.flush, write_batch)
+
+    def batch_window_open(self):
+        return self.batch_window is not None and self.batch_window.winfo_exists()
+
+    def finish_batch_edit(self, dataset, plan, new_stats, error):
+        """Apply a batch edit in memory once its captions are written."""
+        if self.batch_window_open():
+            self.batch_window.grab_release()
+            self.batch_apply_button.config(state=tk.NORMAL)
+        if error is not None:
+            if not isinstance(error, BatchEditError):
+                log.error("Error applying batch edit: %s", error)
+            if self.batch_window_open():
+                self.batch_scope_label.config(text="Batch edit failed, no caption was changed.")
+            messagebox.showerror("Batch Edit Failed", str(error), parent=self.batch_window if self.batch_window_open() else self.root)
+            return
+        if dataset is not self.dataset:
+            return  # Another directory was loaded since; the files are written, the old dataset is gone
+        changed = dataset.apply_batch(plan, new_stats)
+
+        # Already on disk, only logged so it can be undone
+        self.record_edit(f"Batch edit of {len(changed)} captions", changed, save=False)
+
+        touched_tags = set()
+        for image_name, old_tags in changed:
+            self.saver.forget_written(self.caption_path(image_name))
+            touched_tags.update(old_tags)
+            for tag in self.dataset.image_tags[image_name]:
+                self.add_to_all_tags(tag)
+        for tag in touched_tags:
+            if not self.dataset.tag_index.images_with(tag):
+                self.remove_from_all_tags(tag)
+
+        self.batch_edit = BatchEdit()
+
+        # Keep the filter, the edit may have moved images in or out of it
+        self.apply_filter()
+        if self.current_image_index != -1:
+            self.select_image_by_index(self.current_image_index)
+        if self.batch_window_open():
+            self.refresh_batch_list()
+            self.batch_scope_label.config(text=f"Changed {len(changed)} caption files.")
+
+    def run_in_background(self, work, on_done):
+        """Run ``work()`` on a thread, then call ``on_done(result, error)`` on the Tk thread."""
+        results = Queue()
+
+        def run():
+            try:
+                results.put((work(), None))
+            except Exception as e:
+                results.put((None, e))
+
+        threading.Thread(target=run, daemon=True).start()
+        self.root.after(self.BACKGROUND_POLL_MS, self.poll_background, results, on_done)
+
+    def poll_background(self, results, on_done):
+        if results.empty():
+            self.root.after(self.BACKGROUND_POLL_MS, self.poll_background, results, on_done)
+            return
+        on_done(*results.get_nowait())
 
     def _on_mouse_wheel(self, event):
         scroll_units = int(event.delta / 120) or int(event.delta / 10)  # Adjust for macOS
@@ -430,57 +1344,162 @@ class ImageTaggerApp:
         elif event.num == 5:  # Scroll down
             self.images_canvas.yview_scroll(1, "units")
 
+    def _bind_mouse_wheel(self, widget):
+        """Scroll the image grid when the mouse wheel is used over a widget."""
+        widget.bind("<MouseWheel>", self._on_mouse_wheel)  # Windows/macOS
+        widget.bind("<Button-4>", self._on_mouse_wheel_linux)
+        widget.bind("<Button-5>", self._on_mouse_wheel_linux)
+
+    def _on_images_scrolled(self, first, last):
+        """Keep the scrollbar in sync and rebind the grid cells to the new viewport."""
+        self.images_scroll.set(first, last)
+        self.render_visible_thumbnails()
 
     def display_thumbnails(self, image_list=None):
         """Display thumbnails for a given list of images (default to all images)."""
         if image_list is None:
-            image_list = self.images
+            image_list = self.dataset.images
+
+        self.grid_images = image_list
+        self.grid_positions = None
+        self.images_label.config(text=f"Images ({len(image_list)})")
+
+        # Size the scroll region for the whole list; only visible rows get widgets
+        rows = (len(image_list) + GRID_COLUMNS - 1) // GRID_COLUMNS
+        self.images_canvas.configure(scrollregion=(0, 0, GRID_COLUMNS * GRID_CELL_WIDTH, rows * GRID_CELL_HEIGHT))
+
+        # Force every cell to rebind, the list behind the indexes has changed
+        for cell in self.grid_cells:
+            cell["index"] = None
+
+        self.render_visible_thumbnails()
+
+    def render_visible_thumbnails(self):
+        """Bind the cell pool to the rows in (and just around) the viewport."""
+        with INSTRUMENTS.timer("grid.render"):
+            self._render_visible_thumbnails()
+
+    def _render_visible_thumbnails(self):
+        top = self.images_canvas.canvasy(0)
+        height = self.images_canvas.winfo_height()
+
+        viewport_first_row = int(top // GRID_CELL_HEIGHT)
+        viewport_last_row = int((top + height) // GRID_CELL_HEIGHT)
+        first_row = max(0, viewport_first_row - GRID_MARGIN_ROWS)
+        last_row = viewport_last_row + GRID_MARGIN_ROWS
+        visible = range(first_row * GRID_COLUMNS, min(len(self.grid_images), (last_row + 1) * GRID_COLUMNS))
+
+        # Cells already showing a visible image keep it, the rest are recycled
+        bound = {}
+        free = []
+        for cell in self.grid_cells:
+            if cell["index"] is not None and cell["index"] in visible:
+                bound[cell["index"]] = cell
+            else:
+                free.append(cell)
+
+        for index in visible:
+            if index in bound:
+                continue
+            cell = free.pop() if free else self._create_grid_cell()
+            self._bind_grid_cell(cell, index)
+
+        # Park unused cells off-screen
+        for cell in free:
+            if cell["index"] is not None or cell["image_name"] is not None:
+                cell["index"] = None
+                cell["image_name"] = None
+                cell["button"].config(image="", text="")
+                cell["button"].image = None
+                self.images_canvas.coords(cell["window"], -GRID_CELL_WIDTH, -GRID_CELL_HEIGHT)
+
+        # Generate missing thumbnails, rows in the viewport first, then the margin
+        if self.thumbnail_loader is None:
+            return
+        viewport = range(viewport_first_row * GRID_COLUMNS, (viewport_last_row + 1) * GRID_COLUMNS)
+        wanted = set()
+        for index in sorted(visible, key=lambda i: i not in viewport):
+            image_name = self.grid_images[index]
+            wanted.add(image_name)
+            if self.thumbnail_loader.get(image_name) is None:
+                self.thumbnail_loader.request(image_name)
+
+        # Drop queued work for rows that scrolled away
+        self.thumbnail_loader.cancel_except(wanted)
+
+    def _create_grid_cell(self):
+        """Add one recycled cell to the grid pool."""
+        btn = tk.Button(self.images_canvas, compound="top")
+        self._bind_mouse_wheel(btn)
+        window = self.images_canvas.create_window(
+            -GRID_CELL_WIDTH, -GRID_CELL_HEIGHT,
+            window=btn,
+            anchor="nw",
+            width=GRID_CELL_WIDTH - 10,
+            height=GRID_CELL_HEIGHT - 10,
+        )
+        cell = {"window": window, "button": btn, "index": None, "image_name": None, "loaded": False}
+        self.grid_cells.append(cell)
+        return cell
+
+    def _bind_grid_cell(self, cell, index):
+        """Point a grid cell at the image at ``index`` of the displayed list."""
+        image_name = self.grid_images[index]
+        cell["index"] = index
+
+        row, column = divmod(index, GRID_COLUMNS)
+        self.images_canvas.coords(cell["window"], column * GRID_CELL_WIDTH + 5, row * GRID_CELL_HEIGHT + 5)
+
+        if cell["image_name"] == image_name:
+            return  # Same image, only the position changed
+        cell["image_name"] = image_name
+
+        # Truncate the image name
+        if len(image_name) > 15:
+            display_name = f"{image_name[:3]}...{image_name[-12:]}"
+        else:
+            display_name = image_name
 
-        # Clear existing thumbnails
-        for widget in self.images_inner_frame.winfo_children():
-            widget.destroy()
+        cell["button"].config(
+            text=display_name,
+            command=lambda name=image_name: self.select_image_by_index(self.dataset.image_positions[name]),
+        )
 
-        # Thumbnail size and padding
-        thumbnail_size = 50
-        padding = 10
+        # Show the thumbnail if it's in memory, otherwise a placeholder until the worker delivers it
+        img = self.thumbnail_loader.get(image_name)
+        if img is not None:
+            self._set_cell_thumbnail(cell, img)
+        else:
+            cell["loaded"] = False
+            cell["button"].config(image=self.placeholder_thumbnail)
+            cell["button"].image = self.placeholder_thumbnail
 
-        for index, image_name in enumerate(image_list):
-            # Truncate the image name
-            if len(image_name) > 15:
-                display_name = f"{image_name[:3]}...{image_name[-12:]}"
-            else:
-                display_name = image_name
-
-            # Load and resize thumbnail
-            img_path = os.path.join(self.directory, image_name)
-            img = Image.open(img_path)
-            img.thumbnail((thumbnail_size, thumbnail_size))  # Resize to thumbnail size
-            img_tk = ImageTk.PhotoImage(img)
-
-            # Create image button
-            btn = tk.Button(
-                self.images_inner_frame,
-                image=img_tk,
-                text=display_name,
-                compound="top",
-                command=lambda i=self.images.index(image_name): self.select_image_by_index(i),
-            )
-            btn.image = img_tk  # Keep a reference to avoid garbage collection
-            btn.grid(row=index // 2, column=index % 2, padx=padding, pady=padding)
+    def _set_cell_thumbnail(self, cell, img):
+        img_tk = ImageTk.PhotoImage(img)
+        cell["button"].config(image=img_tk)
+        cell["button"].image = img_tk  # Keep a reference to avoid garbage collection
+        cell["loaded"] = True
+
+    def on_thumbnail_ready(self, image_name, img):
+        """Fill in the grid cell (if any) that is waiting for this thumbnail."""
+        for cell in self.grid_cells:
+            if cell["image_name"] == image_name and not cell["loaded"]:
+                self._set_cell_thumbnail(cell, img)
 
     def select_image_by_index(self, index):
         """Handle selection of an image by its index."""
         self.current_image_index = index
-        image_name = self.images[index]
+        image_name = self.dataset.images[index]
 
         # Display the selected image
         img_path = os.path.join(self.directory, image_name)
         self.display_selected_image(img_path)
 
         # Update tags list
+        tags = self.dataset.tags_of(image_name)
         self.image_tags_list.delete(0, tk.END)
-        for tag in self.image_tags[image_name]:  # Keep the original order
-            self.image_tags_list.insert(tk.END, tag)
+        self.image_tags_list.insert(tk.END, *tags)  # Keep the original order
+        self.index_image_tag_rows(tags)
 
         # Update highlights in the All Tags list
         self.update_all_tags_highlight()
@@ -488,71 +1507,618 @@ class ImageTaggerApp:
     
     def select_directory(self):
         """Open a file dialog to select a directory."""
-        self.directory = filedialog.askdirectory()
+        directory = filedialog.askdirectory()
+        if directory:
+            self.dir_path.delete(0, tk.END)
+            self.dir_path.insert(0, directory)
+
+    def add_directory(self):
+        """Add another folder to load together with the ones already entered."""
+        directory = filedialog.askdirectory()
+        if not directory:
+            return
+        current = self.dir_path.get().strip()
         self.dir_path.delete(0, tk.END)
-        self.dir_path.insert(0, self.directory)
+        self.dir_path.insert(0, current + os.pathsep + directory if current else directory)
         
-    @staticmethod
-    def natural_sort_key(s):
-        """Generate a sort key for natural sort order."""
-        # Split the string into chunks of digits and non-digits
-        return [int(text) if text.isdigit() else text.lower() for text in re.split(r'(\d+)', s)]
+    natural_sort_key = staticmethod(natural_sort_key)
     
     def process_directory(self):
-        """Load images and tags from the selected directory."""
-        if not self.directory:
+        """Load images and tags from the selected directories."""
+        directories = [directory.strip() for directory in self.dir_path.get().split(os.pathsep) if directory.strip()]
+        if not directories:
             messagebox.showerror("Error", "Please select a directory first.")
             return
 
+        # Images are named by their path relative to the folders' common parent
+        try:
+            directory, roots = split_roots(directories)
+        except ValueError as e:
+            messagebox.showerror("Error", str(e))
+            return
+        recursive = self.recursive_var.get()
+
+        # Reprocessing the loaded directories only re-reads what changed on disk
+        if (
+            directory == self.loaded_directory
+            and (roots, recursive) == (self.dataset.roots, self.dataset.recursive)
+            and self.directory_loader is None
+            and self.store is None
+            and not self.store_var.get()
+        ):
+            self.rescan_directory()
+            return
+
+        # Queued saves belong to the loaded directories; write them out first, showing progress
+        self.saver.expedite()
+        if self.saver.pending_count():
+            self.show_flush_progress(self.process_directory)
+            return
+
+        self.directory = directory
+
         # Reset data
-        self.images = []
-        self.image_tags = {}
-        self.all_tags = set()
+        if self.watcher is not None:
+            self.watcher.stop()
+            self.watcher = None
+        self.close_journal()
+        self.close_store()
+        self.cancel_duplicates()
+        self.duplicate_groups = []
+        self.refresh_duplicate_groups()
+        self.loaded_directory = None
+        self.dataset = Dataset(self.directory, roots, recursive)
+        self.all_tags = SortedTags()
+        self.shown_counts = {}
+        self.tag_search = TagSearchIndex()
+        self.highlighted_tags = set()
         self.current_image_index = -1
+        if self.thumbnail_loader is not None:
+            self.thumbnail_loader.shutdown()
+        self.thumbnail_cache = ThumbnailCache(self.directory)
+        self.thumbnail_loader = ThumbnailLoader(self.root, self.thumbnail_cache, self.on_thumbnail_ready)
+
+        # Scan and parse in the background; the UI fills in as batches arrive
+        if self.directory_loader is not None:
+            self.directory_loader.cancel(discard=True)
+            self.directory_loader = None
+        if self.store_var.get():
+            self.open_store()
+            return
+        self.directory_loader = DirectoryLoader(
+            self.root, self.directory, self.natural_sort_key, self.on_directory_batch, self.on_directory_loaded,
+            roots=self.dataset.roots, recursive=self.dataset.recursive,
+        )
+        self.cancel_load_button.config(state=tk.NORMAL)
+        self.load_status.config(text="Scanning...")
+        self.update_ui()
+        self.directory_loader.start()
 
-        # Scan directory
-        for file in os.listdir(self.directory):
-            if file.endswith(".png"):
-                self.images.append(file)
+    def on_directory_batch(self, batch, loaded, total):
+        """Merge a batch of parsed images into the dataset and refresh the UI."""
+        with INSTRUMENTS.timer("load.merge_batch"):
+            self.dataset.add_images(batch)
+            for _, tags, _ in batch:
+                for tag in tags:
+                    if self.all_tags.add(tag) is not None:
+                        self.tag_search.add(tag)
 
-        # Sort images in natural order
-        self.images.sort(key=self.natural_sort_key)
+        self.load_status.config(text=f"Loaded {loaded} / {total} images")
 
-        for image_name in self.images:
-            tag_file = os.path.splitext(image_name)[0] + ".txt"
-            tag_path = os.path.join(self.directory, tag_file)
+        # Lighter than update_ui, the selected image itself hasn't changed
+        self.display_thumbnails()
+        self.refresh_all_tags_list()
+        self.update_all_tags_highlight()
 
-            if os.path.exists(tag_path):
-                with open(tag_path, "r") as f:
-                    # Split by commas and strip whitespace
-                    tags = [tag.strip() for tag in f.read().strip().split(",")]
-                    self.image_tags[image_name] = tags
-                    self.all_tags.update(tags)
-            else:
-                self.image_tags[image_name] = []
+    def on_directory_loaded(self, cancelled, error):
+        """Finish a directory load."""
+        reread = self.directory_loader.reread
+        self.directory_loader = None
+        self.cancel_load_button.config(state=tk.DISABLED)
+        if error is not None:
+            self.load_status.config(text="Loading failed")
+            messagebox.showerror("Error", f"Could not load {self.directory}: {error}")
+        elif cancelled:
+            self.load_status.config(text=f"Cancelled after {len(self.dataset.images)} images")
+        else:
+            self.loaded_directory = self.directory
+            self.open_journal()
+            self.save_manifest(background=True)
+            self.start_watcher()
+            self.load_status.config(
+                text=f"{len(self.dataset.images)} images, {len(self.all_tags)} tags ({reread} captions read)"
+            )
 
+    def open_store(self):
+        """Sync the folders' SQLite store in the background, then page the grid out of it."""
+        dataset = self.dataset
+        directory, roots, recursive = dataset.directory, dataset.roots, dataset.recursive
+
+        # Windows working on the dataset in memory have nothing to show
+        if self.batch_window_open():
+            self.batch_window.destroy()
+        if self.cooccurrence_window is not None:
+            self.close_cooccurrence()
+
+        def sync():
+            store = CaptionStore(directory, roots=roots, recursive=recursive)
+            try:
+                return store, store.sync()
+            except BaseException:
+                store.close()
+                raise
+
+        self.cancel_load_button.config(state=tk.DISABLED)
+        self.load_status.config(text="Syncing store...")
         self.update_ui()
+        self.run_in_background(sync, lambda result, error: self.on_store_synced(dataset, result, error))
+
+    def on_store_synced(self, dataset, result, error):
+        """Show a synced store; only the tag counts are loaded into memory."""
+        if dataset is not self.dataset:
+            if result is not None:
+                result[0].close()  # Another directory was loaded since
+            return
+        if error is not None:
+            self.load_status.config(text="Loading failed")
+            messagebox.showerror("Error", f"Could not load {self.directory}: {error}")
+            return
+
+        store, (added, changed, _, conflicts) = result
+        if conflicts:
+            log.warning("Unsaved store edits to %d captions were replaced by the files on disk", len(conflicts))
+        self.store = store
+        self.dataset = StoreDataset(store)
+        self.loaded_directory = self.directory
+        self.all_tags = SortedTags(self.dataset.tag_index.counts)
+        for tag in self.all_tags.tags:
+            self.tag_search.add(tag)
+        self.refresh_all_tags_list()
+        self.request_filter()
+        self.load_status.config(
+            text=f"{len(self.dataset.images)} images, {len(self.all_tags)} tags ({len(added) + len(changed)} captions read)"
+        )
+
+    def flush_store(self):
+        """Write the captions edited in the store since the last flush."""
+        if self.store_flush_timer is not None:
+            self.root.after_cancel(self.store_flush_timer)
+            self.store_flush_timer = None
+        # Only the captions edited within the save delay, so this is quick enough for the Tk thread
+        _, conflicts = self.store.flush()
+        if conflicts:
+            messagebox.showwarning(
+                "Captions Changed on Disk",
+                f"{len(conflicts)} captions were changed by another program and were not overwritten, "
+                "e.g. " + self.store.caption_path(conflicts[0]) + ". Process the folders again to load them.",
+            )
+
+    def close_store(self):
+        """Write out the store's edits and close it."""
+        if self.store is None:
+            return
+        self.flush_store()
+        self.store.close()
+        self.store = None
+
+    def store_unsupported(self, title):
+        """Explain that ``title`` needs the dataset in memory; return True if it is paged from the store."""
+        if self.store is None:
+            return False
+        messagebox.showinfo(
+            title,
+            f"{title} needs the dataset in memory. Process the folders without \"Use SQLite store\", "
+            "or use el_caption_cli.py with --store.",
+        )
+        return True
+
+    def rescan_directory(self):
+        """Re-list the loaded directory and merge only added, changed and deleted files."""
+        # Our own saves changed some captions on disk; those still match memory
+        known = {}
+        for image_name in self.dataset.images:
+            caption_stat = self.known_caption_stat(image_name)
+            self.dataset.caption_stats[image_name] = caption_stat
+            known[image_name] = (caption_stat, self.dataset.image_tags[image_name])
+
+        self.rescan_entries = []
+        self.directory_loader = DirectoryLoader(
+            self.root, self.directory, self.natural_sort_key,
+            lambda batch, loaded, total: self.rescan_entries.extend(batch),
+            self.on_rescan_done,
+            known=known,
+            roots=self.dataset.roots,
+            recursive=self.dataset.recursive,
+        )
+        self.cancel_load_button.config(state=tk.NORMAL)
+        self.load_status.config(text="Rescanning...")
+        self.directory_loader.start()
+
+    def on_rescan_done(self, cancelled, error):
+        """Apply the differences found by a rescan to the dataset and indexes."""
+        reread = self.directory_loader.reread
+        self.directory_loader = None
+        self.cancel_load_button.config(state=tk.DISABLED)
+        if error is not None or cancelled:
+            self.load_status.config(text="Rescan failed" if error else "Rescan cancelled")
+            if error is not None:
+                messagebox.showerror("Error", f"Could not rescan {self.directory}: {error}")
+            return
+
+        current_image = self.dataset.images[self.current_image_index] if self.current_image_index != -1 else None
+        added, changed, removed, touched_tags = self.dataset.merge_scan(self.rescan_entries)
+        self.rescan_entries = []
+
+        for image_name in added + changed:
+            for tag in self.dataset.image_tags[image_name]:
+                self.add_to_all_tags(tag)
+
+        # Tags that no longer appear on any image leave the vocabulary
+        for tag in touched_tags:
+            if not self.dataset.tag_index.images_with(tag):
+                self.remove_from_all_tags(tag)
+
+        if added or removed:
+            self.current_image_index = self.dataset.image_positions.get(current_image, -1)
+
+        self.refresh_all_tags_list()
+        if self.current_image_index != -1:
+            self.select_image_by_index(self.current_image_index)
+
+        # Keep the user's filter rather than showing every image, Batch Edit and Export act on the grid
+        if removed:
+            self.display_thumbnails([image_name for image_name in self.grid_images if image_name in self.dataset.image_positions])
+        self.request_filter()
+        self.save_manifest(background=True)
+        self.load_status.config(
+            text=f"{len(self.dataset.images)} images: {len(added)} added, {len(changed)} changed, {len(removed)} removed "
+            f"({reread} captions read)"
+        )
+
+    def save_manifest(self, background=False):
+        """Record each image's caption stat and tags so the next load can skip unchanged captions."""
+        if self.loaded_directory is None or self.store is not None:
+            return  # The store keeps its own record
+
+        entries = self.dataset.manifest_entries(self.saver)
+
+        if background:
+            threading.Thread(target=save_manifest, args=(self.loaded_directory, entries), daemon=True).start()
+        else:
+            save_manifest(self.loaded_directory, entries)
+
+    def start_watcher(self):
+        """Watch the loaded directory for edits made by other programs."""
+        baseline = {}
+        for image_name in self.dataset.images:
+            caption_stat = self.known_caption_stat(image_name)
+            if caption_stat is not None:
+                baseline[os.path.splitext(image_name)[0] + ".txt"] = caption_stat
+
+        backend = PollingWatchBackend(self.directory, self.dataset.roots, self.dataset.recursive)
+        self.watcher = DirectoryWatcher(self.root, backend, baseline, self.on_watch_events)
+        self.watcher.start()
+
+    def on_watch_events(self, events):
+        """Merge changes made on disk by other programs."""
+        for event in events:
+            if event[0] == "caption":
+                _, txt_name, caption_stat, tags = event
+                self.apply_external_caption(txt_name, caption_stat, tags)
+            elif event[0] == "caption_removed":
+                self.apply_external_caption(event[1], None, [])
+            else:
+                _, added, removed, modified = event
+                self.refresh_modified_images(modified)
+                if (added or removed) and self.directory_loader is None:
+                    self.rescan_directory()
+
+    def apply_external_caption(self, txt_name, caption_stat, tags):
+        """Take a caption edited outside the app, unless it conflicts with unsaved edits."""
+        image_name = os.path.splitext(txt_name)[0] + ".png"
+        if image_name not in self.dataset.image_tags or caption_stat == self.known_caption_stat(image_name):
+            return  # Not one of ours, or our own write
+
+        tag_path = self.caption_path(image_name)
+        if self.saver.is_pending(tag_path):
+            # Pull our queued save back before it overwrites the other program's edit;
+            # a save already being written detects the conflict itself
+            if self.saver.discard(tag_path) is not None:
+                self.resolve_caption_conflict(image_name, caption_stat, tags)
+            return
+
+        self.set_known_caption_stat(image_name, caption_stat)
+        self.replace_image_tags(image_name, tags)
+
+    def poll_save_conflicts(self):
+        """Ask the user about saves the saver refused because the file changed on disk."""
+        if self.store is None:
+            self.dataset.absorb_written_stats(self.saver)
+        while not self.saver.conflicts.empty():
+            tag_path, _, disk_stat = self.saver.conflicts.get_nowait()
+            image_name = os.path.splitext(relative_name(self.directory, tag_path))[0] + ".png"
+            if image_name not in self.dataset.image_tags or self.caption_path(image_name) != tag_path:
+                continue  # From a directory that is no longer loaded
+            try:
+                disk_tags = read_caption_file(tag_path) if disk_stat is not None else []
+            except OSError:
+                disk_tags = []
+            self.resolve_caption_conflict(image_name, disk_stat, disk_tags)
+
+        self.checkpoint_journal()
+        self.refresh_tag_counts()  # Also catches edits from the file watcher
+        self.root.after(self.CONFLICT_POLL_MS, self.poll_save_conflicts)
+
+    def resolve_caption_conflict(self, image_name, disk_stat, disk_tags):
+        """Let the user choose between their unsaved tags and the version on disk."""
+        my_tags = self.dataset.image_tags[image_name]
+        keep_mine = messagebox.askyesno(
+            "Caption Changed on Disk",
+            f"The caption for '{image_name}' was changed by another program while you had unsaved edits.\n\n"
+            f"On disk: {', '.join(disk_tags)}\n"
+            f"Yours: {', '.join(my_tags)}\n\n"
+            "Keep your version? Choose No to load the version on disk.",
+        )
+
+        self.set_known_caption_stat(image_name, disk_stat)
+        if keep_mine:
+            self.queue_file_save(image_name)
+        else:
+            self.saver.discard(self.caption_path(image_name))
+            self.replace_image_tags(image_name, disk_tags)
+
+    def replace_image_tags(self, image_name, tags):
+        """Swap in a new tag list for one image, updating the indexes and the UI."""
+        old_tags = self.dataset.replace_tags(image_name, tags)
+
+        for tag in tags:
+            self.add_to_all_tags(tag)
+        for tag in set(old_tags) - set(tags):
+            if not self.dataset.tag_index.images_with(tag):
+                self.remove_from_all_tags(tag)
+
+        if self.current_image_index != -1 and self.dataset.images[self.current_image_index] == image_name:
+            self.select_image_by_index(self.current_image_index)
+        self.update_duplicate_captions([image_name])
+
+    def refresh_modified_images(self, image_names):
+        """Drop stale thumbnails for images changed on disk and redraw them."""
+        if not image_names or self.thumbnail_loader is None:
+            return
+        modified = set(image_names)
+        for image_name in modified:
+            self.thumbnail_loader.memory.pop(image_name, None)
+        for cell in self.grid_cells:
+            if cell["image_name"] in modified:
+                cell["image_name"] = None
+                cell["index"] = None
+        self.render_visible_thumbnails()
+
+        if self.current_image_index != -1 and self.dataset.images[self.current_image_index] in modified:
+            self.select_image_by_index(self.current_image_index)
+
+    def cancel_directory_load(self):
+        """Stop the directory load in progress, keeping what has been loaded so far."""
+        if self.directory_loader is not None:
+            self.directory_loader.cancel()
     
     def update_ui(self):
         """Update the UI with loaded data."""
         # Update thumbnails
         self.display_thumbnails()
 
-        # Preserve selection in All Tags
-        selected_tags = self.all_tags_list.curselection()
-        self.all_tags_list.delete(0, tk.END)
-        for tag in sorted(self.all_tags, key=self.natural_sort_key):
-            self.all_tags_list.insert(tk.END, tag)
-
-        # Restore selection in All Tags
-        for index in selected_tags:
-            if index < self.all_tags_list.size():
-                self.all_tags_list.selection_set(index)
+        self.refresh_all_tags_list()
 
         # Refresh the image tags if an image is selected
         if self.current_image_index != -1:
             self.select_image_by_index(self.current_image_index)
 
+    def all_tags_match(self, tag):
+        """Return True if ``tag`` passes the All Tags search box."""
+        return self.all_tags_query in tag.lower()
+
+    def add_to_all_tags(self, tag):
+        """Add a tag to the vocabulary, inserting just its row into the All Tags list."""
+        if self.all_tags.add(tag) is None:
+            return
+        self.tag_search.add(tag)
+        if not self.all_tags_match(tag):
+            return
+        self.shown_counts[tag] = self.dataset.tag_count(tag)
+        row = self.visible_tags.add(tag)
+        if row is not None:
+            self.all_tags_list.insert(row, self.all_tags_row_text(tag))
+            if tag in self.highlighted_tags:
+                self.style_all_tags_row(row, True)
+
+    def remove_from_all_tags(self, tag):
+        """Remove a tag from the vocabulary, deleting just its row from the All Tags list."""
+        self.all_tags.discard(tag)
+        self.tag_search.discard(tag)
+        row = self.visible_tags.discard(tag)
+        if row is not None:
+            self.all_tags_list.delete(row)
+
+    def refresh_all_tags_list(self):
+        """Bring the All Tags list in line with the vocabulary and search box.
+
+        Both the old and new rows are in the same sort order, so a single merge
+        pass finds the rows to delete and insert; runs of either are applied with
+        one Listbox call and untouched rows (and their selection) stay put.
+        Sorted by count the old order is stale, so every row is rewritten.
+        """
+        if self.sort_tags_by_frequency.get():
+            tags = self.all_tags.tags if not self.all_tags_query else self.tag_search.search(self.all_tags_query)
+            self.shown_counts = {tag: self.dataset.tag_count(tag) for tag in tags}
+            self.dataset.tag_index.take_changed()  # Every count is read fresh below
+            self.rewrite_all_tags_rows(SortedTags(tags, sort_key=self.frequency_sort_key))
+            return
+
+        if not self.all_tags_query:
+            new_visible = self.all_tags.subset(lambda tag: True)
+        else:
+            matching = self.tag_search.search(self.all_tags_query)
+            if len(matching) < len(self.all_tags) // 4:
+                new_visible = SortedTags(matching)  # Sorting a few matches beats walking the vocabulary
+            else:
+                new_visible = self.all_tags.subset(matching.__contains__)
+
+        old_keys = self.visible_tags.keys
+        new_keys = new_visible.keys
+        i = j = row = 0
+        while i < len(old_keys) or j < len(new_keys):
+            if j == len(new_keys) or (i < len(old_keys) and old_keys[i] < new_keys[j]):
+                # Run of rows that are no longer shown
+                start = i
+                while i < len(old_keys) and (j == len(new_keys) or old_keys[i] < new_keys[j]):
+                    i += 1
+                self.all_tags_list.delete(row, row + i - start - 1)
+            elif i == len(old_keys) or new_keys[j] < old_keys[i]:
+                # Run of rows to add
+                start = j
+                while j < len(new_keys) and (i == len(old_keys) or new_keys[j] < old_keys[i]):
+                    j += 1
+                self.all_tags_list.insert(row, *map(self.all_tags_row_text, new_visible.tags[start:j]))
+                for tag in new_visible.tags[start:j]:
+                    if tag in self.highlighted_tags:
+                        self.style_all_tags_row(row, True)
+                    row += 1
+            else:
+                i += 1
+                j += 1
+                row += 1
+
+        self.visible_tags = new_visible
+        self.refresh_tag_counts()
+
+    def all_tags_row_text(self, tag):
+        return f"{tag}  ({self.dataset.tag_count(tag)})"
+
+    def frequency_sort_key(self, tag):
+        """Most used first, by the count last shown so rows can still be found after it changes."""
+        return (-self.shown_counts.get(tag, 0),) + SortedTags.sort_key(tag)
+
+    def change_all_tags_sort(self):
+        """Re-sort the All Tags list by name or by count."""
+        if not self.sort_tags_by_frequency.get():
+            self.rewrite_all_tags_rows(self.all_tags.subset(self.all_tags_match))
+            return
+        self.refresh_all_tags_list()
+
+    def rewrite_all_tags_rows(self, visible):
+        """Replace every All Tags row, keeping the selected tag and the scroll position."""
+        selection = self.all_tags_list.curselection()
+        selected_tag = self.visible_tags[selection[0]] if selection else None
+        scroll_position = self.all_tags_list.yview()
+
+        self.all_tags_list.delete(0, tk.END)
+        if visible:
+            self.all_tags_list.insert(0, *map(self.all_tags_row_text, visible.tags))
+        self.visible_tags = visible
+        for tag in self.highlighted_tags:
+            row = visible.index(tag)
+            if row is not None:
+                self.style_all_tags_row(row, True)
+
+        self.all_tags_list.yview_moveto(scroll_position[0])
+        row = visible.index(selected_tag) if selected_tag is not None else None
+        if row is not None:
+            self.all_tags_list.selection_set(row)
+
+    def refresh_tag_counts(self):
+        """Update the counts on the All Tags rows of tags added to or removed from images since the last call.
+
+        The tag index records which tags it touched, so this costs one row per
+        changed tag rather than a pass over the captions; sorted by count, the
+        row also moves to its new place.
+        """
+        changed = self.dataset.tag_index.take_changed()
+        if not changed:
+            return
+        if self.cooccurrence_window is not None:
+            self.show_cooccurring(self.cooccurrence_tag)
+        if len(changed) > max(100, len(self.visible_tags) // 4):
+            # E.g. a loaded batch: one rewrite beats hundreds of single-row edits
+            if self.sort_tags_by_frequency.get():
+                self.refresh_all_tags_list()
+            else:
+                self.rewrite_all_tags_rows(self.visible_tags)
+            return
+
+        by_frequency = self.sort_tags_by_frequency.get()
+        selection = self.all_tags_list.curselection()
+        selected_tag = self.visible_tags[selection[0]] if selection else None
+        for tag in changed:
+            row = self.visible_tags.index(tag)
+            if row is None:
+                continue
+            self.all_tags_list.delete(row)
+            if by_frequency:
+                self.visible_tags.discard(tag)
+                self.shown_counts[tag] = self.dataset.tag_count(tag)
+                row = self.visible_tags.add(tag)
+            self.all_tags_list.insert(row, self.all_tags_row_text(tag))
+            if tag in self.highlighted_tags:
+                self.style_all_tags_row(row, True)
+            if tag == selected_tag:
+                self.all_tags_list.selection_set(row)
+
+    def open_cooccurrence(self):
+        """Open the window listing the tags most often used together with the selected tag."""
+        selection = self.all_tags_list.curselection()
+        if not selection or self.store_unsupported("Co-occurring Tags"):
+            return
+        if self.cooccurrence_window is None or not self.cooccurrence_window.winfo_exists():
+            self.cooccurrence_window = tk.Toplevel(self.root)
+            self.cooccurrence_window.protocol("WM_DELETE_WINDOW", self.close_cooccurrence)
+            self.cooccurrence_label = tk.Label(self.cooccurrence_window, anchor="w")
+            self.cooccurrence_label.pack(fill=tk.X, padx=5, pady=5)
+
+            columns = ("together", "of_selected", "of_other")
+            self.cooccurrence_tree = Treeview(self.cooccurrence_window, columns=columns, height=20)
+            self.cooccurrence_tree.heading("#0", text="Tag", anchor="w")
+            self.cooccurrence_tree.column("#0", width=220)
+            for column, text in zip(columns, ("Together", "% of selected", "% of tag")):
+                self.cooccurrence_tree.heading(column, text=text)
+                self.cooccurrence_tree.column(column, width=90, anchor="e")
+            self.cooccurrence_tree.pack(fill=tk.BOTH, expand=True, padx=5, pady=5)
+            # Double-click filters the images to those carrying both tags
+            self.cooccurrence_tree.bind("<Double-1>", self.filter_by_cooccurrence)
+        self.cooccurrence_window.lift()
+        self.show_cooccurring(self.visible_tags[selection[0]])
+
+    def follow_cooccurrence(self, event):
+        """Show the newly selected tag in the co-occurrence window, if it is open."""
+        selection = self.all_tags_list.curselection()
+        if selection and self.cooccurrence_window is not None:
+            self.show_cooccurring(self.visible_tags[selection[0]])
+
+    def close_cooccurrence(self):
+        self.cooccurrence_window.destroy()
+        self.cooccurrence_window = None
+
+    def show_cooccurring(self, tag):
+        """Fill the co-occurrence window for ``tag``."""
+        self.cooccurrence_tag = tag
+        count = self.dataset.tag_count(tag)
+        self.cooccurrence_window.title(f"Co-occurring Tags: {tag}")
+        self.cooccurrence_label.config(text=f"Tags used with '{tag}' ({count} images)")
+        self.cooccurrence_tree.delete(*self.cooccurrence_tree.get_children())
+        for other, together in self.dataset.cooccurring(tag, limit=self.COOCCURRENCE_ROWS):
+            self.cooccurrence_tree.insert("", tk.END, text=other, values=(
+                together,
+                f"{100 * together / count:.1f}%",
+                f"{100 * together / self.dataset.tag_count(other):.1f}%",
+            ))
+
+    def filter_by_cooccurrence(self, event):
+        selection = self.cooccurrence_tree.selection()
+        if not selection:
+            return
+        other = self.cooccurrence_tree.item(selection[0], "text")
+        self.filter_entry.delete(0, tk.END)
+        self.filter_entry.insert(0, f"{self.cooccurrence_tag}, {other}")
+        self.apply_filter()
 
     
     def select_image(self, event=None):
@@ -562,7 +2128,7 @@ class ImageTaggerApp:
             return
 
         self.current_image_index = selection[0]
-        image_name = self.images[self.current_image_index]
+        image_name = self.dataset.images[self.current_image_index]
 
         # Update image display
         img_path = os.path.join(self.directory, image_name)
@@ -570,29 +2136,49 @@ class ImageTaggerApp:
 
         # Update tags list
         self.image_tags_list.delete(0, tk.END)
-        for tag in self.image_tags[image_name]:
+        for tag in self.dataset.image_tags[image_name]:
             self.image_tags_list.insert(tk.END, tag)
 
             
     def display_selected_image(self, image_path):
         """Display the selected image in the center with scaling."""
-        img = Image.open(image_path)
-        width, height = img.size
-
         # Get available space
         frame_width = self.image_display.winfo_width()
         frame_height = self.image_display.winfo_height()
 
-        # Calculate scaling
-        scale = min(frame_width / width, frame_height / height, 1)  # Do not upscale
-        new_width = int(width * scale)
-        new_height = int(height * scale)
-        img = img.resize((new_width, new_height), Image.Resampling.LANCZOS)  # Use LANCZOS for resizing
+        img = self.preview_cache.get(image_path, frame_width, frame_height)
 
         img_tk = ImageTk.PhotoImage(img)
         self.image_display.config(image=img_tk)
         self.image_display.image = img_tk  # Keep reference to avoid garbage collection
 
+        # Warm the cache with the neighbours in the grid's current order
+        self.prefetch_neighbor_previews(relative_name(self.directory, image_path), frame_width, frame_height)
+
+        stats = self.preview_cache.stats()
+        self.preview_stats_label.config(
+            text=f"Preview cache: {stats['entries']} images, {stats['bytes'] / (1024 * 1024):.1f} MB, "
+            f"{stats['hit_rate']:.0%} hits"
+        )
+
+    def prefetch_neighbor_previews(self, image_name, width, height):
+        """Prefetch the previews of the images next to ``image_name`` in the grid."""
+        if self.store is not None:
+            position = self.grid_images.cached_index(image_name)  # Shown, so its page was read
+        else:
+            if self.grid_positions is None:
+                self.grid_positions = {name: index for index, name in enumerate(self.grid_images)}
+            position = self.grid_positions.get(image_name)
+        if position is None:
+            return
+
+        neighbors = []
+        for offset in range(1, self.PREFETCH_NEIGHBORS + 1):
+            for index in (position + offset, position - offset):
+                if 0 <= index < len(self.grid_images):
+                    neighbors.append(os.path.join(self.directory, self.grid_images[index]))
+        self.preview_cache.prefetch(neighbors, width, height)
+
 
     def add_tag_to_current_image(self, event):
         """Add a tag from the all tags list to the current image."""
@@ -603,14 +2189,15 @@ class ImageTaggerApp:
         if not selection:
             return
 
-        tag = self.all_tags_list.get(selection[0])
-        image_name = self.images[self.current_image_index]
+        tag = self.visible_tags[selection[0]]
+        image_name = self.dataset.images[self.current_image_index]
 
-        if tag not in self.image_tags[image_name]:
-            self.image_tags[image_name].append(tag)
+        old_tags = self.dataset.tags_of(image_name)
+        if self.dataset.add_tag(image_name, tag):
             self.image_tags_list.insert(tk.END, tag)  # Directly update the image tags list
+            self.image_tag_rows.setdefault(tag, self.image_tags_list.size() - 1)
             self.update_all_tags_highlight()
-            self.queue_file_save(image_name)  # Queue for saving
+            self.record_edit(f"Add '{tag}'", [(image_name, old_tags)])
 
     
     def remove_tag_from_image(self, event):
@@ -623,67 +2210,585 @@ class ImageTaggerApp:
             return
 
         tag = self.image_tags_list.get(selection[0])
-        image_name = self.images[self.current_image_index]
+        image_name = self.dataset.images[self.current_image_index]
 
-        if tag in self.image_tags[image_name]:
-            self.image_tags[image_name].remove(tag)
+        old_tags = self.dataset.tags_of(image_name)
+        if self.dataset.remove_tag(image_name, tag):
             self.image_tags_list.delete(selection[0])  # Directly update the listbox
+            self.index_image_tag_rows(self.dataset.tags_of(image_name))
             self.update_all_tags_highlight()
-            self.queue_file_save(image_name)  # Queue for saving
+            self.record_edit(f"Remove '{tag}'", [(image_name, old_tags)])
+
+    def caption_path(self, image_name):
+        """Return the path of an image's caption file."""
+        return self.dataset.caption_path(image_name)
+
+    def known_caption_stat(self, image_name):
+        """Return the (mtime_ns, size) we last read or wrote for an image's caption, None if it has none."""
+        written_stat = self.saver.written_stat(self.caption_path(image_name))
+        return written_stat if written_stat is not None else self.dataset.caption_stats[image_name]
+
+    def set_known_caption_stat(self, image_name, caption_stat):
+        self.dataset.caption_stats[image_name] = caption_stat
+        self.saver.forget_written(self.caption_path(image_name))
 
     def queue_file_save(self, image_name):
         """Queue an image's tags for saving in the background."""
-        tags = self.image_tags[image_name]
-        print(f"Queuing save for: {image_name} with tags: {tags}")  # Debugging log
-        self.save_queue.put((image_name, tags))
+        if self.store is not None:
+            # The store holds the edit; its captions are written once per burst of edits
+            if self.store_flush_timer is None:
+                self.store_flush_timer = self.root.after(int(self.SAVE_DELAY * 1000), self.flush_store)
+            if self.filter_entry.get().strip():
+                self.request_filter()  # The edit may move the image in or out of the paged matches
+            return
+        self.saver.queue(
+            self.caption_path(image_name),
+            self.dataset.image_tags[image_name],
+            expected_stat=self.known_caption_stat(image_name),
+        )
+
+    def record_edit(self, label, changed, save=True):
+        """Journal an edit of ``[(image_name, old_tags)]`` for undo and crash recovery, then queue the saves."""
+        if self.journal is not None:
+            self.journal.record(
+                label, [(image_name, old_tags, self.dataset.tags_of(image_name)) for image_name, old_tags in changed]
+            )
+        if save:
+            for image_name, _ in changed:
+                self.queue_file_save(image_name)
+        self.update_undo_buttons()
+        self.update_duplicate_captions(image_name for image_name, _ in changed)
+
+    def open_journal(self):
+        """Open the loaded directory's journal and restore edits a crash kept from reaching the captions."""
+        try:
+            self.journal = EditJournal(self.directory)
+        except OSError as e:
+            log.error("Could not open the edit journal for %s: %s", self.directory, e)
+            self.journal = None
+            self.update_undo_buttons()
+            return
+
+        plan, skipped = self.journal.replay_plan(self.dataset)
+        for image_name, tags in plan:
+            self.replace_image_tags(image_name, tags)
+            self.queue_file_save(image_name)
+        if plan or skipped:
+            message = f"Restored unsaved edits to {len(plan)} captions from the last session."
+            if skipped:
+                message += f"\n\n{len(skipped)} captions were changed by another program since and were left as they are."
+            messagebox.showinfo("Recovered Edits", message)
+            if plan:
+                self.apply_filter()
+
+        # Edits are durable in the journal now, so caption writes can wait and coalesce
+        self.saver.delay = self.SAVE_DELAY
+        self.update_undo_buttons()
+
+    def close_journal(self):
+        """Write out pending captions, checkpoint and close the journal."""
+        if self.journal is None:
+            return
+        self.saver.flush()
+        self.saver.delay = 0
+        self.journal.checkpoint()
+        self.journal.close()
+        self.journal = None
+        self.update_undo_buttons()
+
+    def checkpoint_journal(self):
+        """Mark the journal's edits saved once the captions they touch are all written."""
+        if self.journal is not None and self.journal.unsaved and not self.saver.pending_count():
+            self.journal.checkpoint()
+
+    def update_undo_buttons(self):
+        can_undo = self.journal is not None and self.journal.can_undo()
+        can_redo = self.journal is not None and self.journal.can_redo()
+        self.undo_button.config(state=tk.NORMAL if can_undo else tk.DISABLED)
+        self.redo_button.config(state=tk.NORMAL if can_redo else tk.DISABLED)
+
+    def undo_edit(self, event=None):
+        """Undo the latest edit, including bulk renames, deletes and batch edits."""
+        if self.journal is not None:
+            self.apply_journal_steps("Undid", self.journal.undo())
+
+    def redo_edit(self, event=None):
+        """Redo the latest undone edit."""
+        if self.journal is not None:
+            self.apply_journal_steps("Redid", self.journal.redo())
+
+    def apply_journal_steps(self, verb, result):
+        """Apply the ``(image_name, before, after)`` steps of an undo or redo to captions still in the expected state."""
+        self.update_undo_buttons()
+        if result is None:
+            return
+        label, steps = result
+        skipped = 0
+        for image_name, before, after in steps:
+            if image_name not in self.dataset.image_tags or self.dataset.tags_of(image_name) != before:
+                skipped += 1  # Changed since, e.g. by another program
+                continue
+            self.replace_image_tags(image_name, after)
+            self.queue_file_save(image_name)
+
+        status = f"{verb} {label}"
+        if skipped:
+            status += f" ({skipped} captions changed since were left alone)"
+            log.warning("%s: skipped %d captions changed since the edit", status, skipped)
+        self.load_status.config(text=status)
+        if len(steps) > 1:
+            self.apply_filter()  # A bulk edit may move images in or out of the filter
 
     def update_all_tags_highlight(self):
-        """Highlight tags in the All Tags list that are part of the current image's tags."""
-        if self.current_image_index == -1:
+        """Highlight tags in the All Tags list that are part of the current image's tags.
+
+        Only rows whose state changes are restyled: the symmetric difference
+        between the tags highlighted so far and the current image's tags.
+        """
+        current_image_tags = set()
+        if self.current_image_index != -1:
+            image_name = self.dataset.images[self.current_image_index]
+            current_image_tags = set(self.dataset.tags_of(image_name))
+
+        for tag in self.highlighted_tags ^ current_image_tags:
+            row = self.visible_tags.index(tag)
+            if row is not None:
+                self.style_all_tags_row(row, tag in current_image_tags)
+
+        self.highlighted_tags = current_image_tags
+        self.refresh_tag_counts()
+
+    def style_all_tags_row(self, row, highlighted):
+        """Apply or clear the highlight on one All Tags row."""
+        # An empty color falls back to the Listbox's own default
+        self.all_tags_list.itemconfig(row, bg="lightgreen" if highlighted else "")
+
+    def open_duplicates(self):
+        """Open the window for finding duplicate and near-duplicate images."""
+        if self.store_unsupported("Duplicates"):
+            return
+        if self.duplicates_window is not None and self.duplicates_window.winfo_exists():
+            self.duplicates_window.lift()
             return
 
-        # Get the default system colors
-        default_bg = self.root.cget("bg")
-        default_fg = self.all_tags_list.cget("fg")
+        self.duplicates_window = tk.Toplevel(self.root)
+        self.duplicates_window.title("Duplicates")
+        self.duplicates_window.transient(self.root)
+
+        controls = tk.Frame(self.duplicates_window)
+        controls.pack(fill=tk.X, padx=5, pady=5)
+        self.duplicate_method = tk.StringVar(value="dhash")
+        tk.OptionMenu(controls, self.duplicate_method, *HASHERS).pack(side=tk.LEFT)
+        tk.Label(controls, text="Max distance:").pack(side=tk.LEFT, padx=(5, 0))
+        self.duplicate_distance = tk.IntVar(value=4)
+        tk.Spinbox(controls, from_=0, to=MAX_DISTANCE, width=3, textvariable=self.duplicate_distance).pack(side=tk.LEFT)
+        tk.Button(controls, text="Find", command=self.find_duplicates).pack(side=tk.LEFT, padx=5)
+        tk.Button(controls, text="Cancel", command=self.cancel_duplicates).pack(side=tk.LEFT)
+
+        self.duplicates_differ_only = tk.BooleanVar(value=False)
+        tk.Checkbutton(
+            self.duplicates_window, text="Only groups whose captions differ",
+            variable=self.duplicates_differ_only, command=self.refresh_duplicate_groups,
+        ).pack(anchor="w", padx=5)
+
+        self.duplicates_status = tk.Label(self.duplicates_window, anchor="w")
+        self.duplicates_status.pack(fill=tk.X, padx=5)
+
+        self.duplicates_tree = Treeview(self.duplicates_window, columns=("caption",), height=20)
+        self.duplicates_tree.heading("#0", text="Image", anchor="w")
+        self.duplicates_tree.column("#0", width=220)
+        self.duplicates_tree.heading("caption", text="Caption", anchor="w")
+        self.duplicates_tree.column("caption", width=360)
+        self.duplicates_tree.pack(fill=tk.BOTH, expand=True, padx=5, pady=5)
+        self.duplicates_tree.bind("<<TreeviewSelect>>", self.show_duplicate_group)
+
+        buttons = tk.Frame(self.duplicates_window)
+        buttons.pack(fill=tk.X, padx=5, pady=5)
+        tk.Button(buttons, text="Show All in Grid", command=self.show_all_duplicates).pack(side=tk.LEFT)
+        tk.Button(buttons, text="Close", command=self.duplicates_window.destroy).pack(side=tk.RIGHT)
+
+        self.duplicate_rows = {}  # tree item -> (group, image name or None for the group row)
+        self.duplicate_items = {}  # image name -> tree item
+        self.refresh_duplicate_groups()
+
+    def find_duplicates(self):
+        """Hash every image in the background and group the near-identical ones."""
+        if self.duplicate_finder is not None or not self.dataset.images or self.store_unsupported("Duplicates"):
+            return
+        try:
+            max_distance = max(0, min(MAX_DISTANCE, self.duplicate_distance.get()))
+        except tk.TclError:
+            return  # Not a number
+        finder = self.duplicate_finder = DuplicateFinder(self.directory, self.duplicate_method.get(), max_distance)
+        image_names = list(self.dataset.images)
+        results = Queue()
+
+        def run():
+            try:
+                progress = lambda done, total: results.put(("progress", done, total))
+                results.put(("done", finder.find(image_names, self.natural_sort_key, progress), None))
+            except Exception as e:
+                results.put(("done", None, e))
+
+        threading.Thread(target=run, daemon=True).start()
+        self.duplicates_status.config(text="Hashing images...")
+        self.root.after(self.DUPLICATE_POLL_MS, self.poll_duplicates, finder, results)
+
+    def poll_duplicates(self, finder, results):
+        """Report hashing progress and show the groups once the search finishes."""
+        window_open = self.duplicates_window is not None and self.duplicates_window.winfo_exists()
+        while not results.empty():
+            item = results.get_nowait()
+            if item[0] == "progress":
+                if window_open and finder is self.duplicate_finder:
+                    self.duplicates_status.config(text=f"Hashed {item[1]} / {item[2]} images")
+                continue
+
+            _, groups, error = item
+            if finder is not self.duplicate_finder:
+                return  # Cancelled, or superseded by another directory
+            self.duplicate_finder = None
+            if error is not None:
+                log.error("Error finding duplicates: %s", error)
+                messagebox.showerror("Error", f"Could not find duplicates: {error}")
+                return
+            self.duplicate_groups = groups
+            self.refresh_duplicate_groups()
+            return
 
-        # Get the tags for the current image
-        image_name = self.images[self.current_image_index]
-        current_image_tags = set(self.image_tags[image_name])
+        self.root.after(self.DUPLICATE_POLL_MS, self.poll_duplicates, finder, results)
+
+    def cancel_duplicates(self):
+        if self.duplicate_finder is not None:
+            self.duplicate_finder.cancel()
+            self.duplicate_finder = None
+            if self.duplicates_window is not None and self.duplicates_window.winfo_exists():
+                self.duplicates_status.config(text="Cancelled")
+
+    def visible_duplicate_groups(self):
+        """Return the groups from the last search still in the dataset, filtered by the window's options."""
+        groups = []
+        differ_only = self.duplicates_differ_only.get()
+        for group in self.duplicate_groups:
+            group = [image_name for image_name in group if image_name in self.dataset.image_positions]
+            if len(group) < 2:
+                continue  # Removed since the search
+            if differ_only and len({tuple(self.dataset.image_tags[image_name]) for image_name in group}) == 1:
+                continue
+            groups.append(group)
+        return groups
+
+    def refresh_duplicate_groups(self):
+        """Redraw the group list of the Duplicates window."""
+        if self.duplicates_window is None or not self.duplicates_window.winfo_exists():
+            return
+        self.duplicates_tree.delete(*self.duplicates_tree.get_children())
+        self.duplicate_rows = {}
+        self.duplicate_items = {}
+        groups = self.visible_duplicate_groups()
+        for number, group in enumerate(groups, 1):
+            parent = self.duplicates_tree.insert("", tk.END, text=f"Group {number} ({len(group)} images)", open=True)
+            self.duplicate_rows[parent] = (group, None)
+            for image_name in group:
+                caption = ", ".join(self.dataset.image_tags[image_name])
+                row = self.duplicate_items[image_name] = self.duplicates_tree.insert(
+                    parent, tk.END, text=image_name, values=(caption,)
+                )
+                self.duplicate_rows[row] = (group, image_name)
+        if self.duplicate_finder is None:
+            images = sum(len(group) for group in groups)
+            self.duplicates_status.config(text=f"{len(groups)} groups, {images} images")
+
+    def update_duplicate_captions(self, image_names):
+        """Show the new captions of edited images listed in the Duplicates window."""
+        if self.duplicates_window is None or not self.duplicates_window.winfo_exists():
+            return
+        for image_name in image_names:
+            row = self.duplicate_items.get(image_name)
+            if row is not None:
+                self.duplicates_tree.item(row, values=(", ".join(self.dataset.image_tags[image_name]),))
+
+    def show_duplicate_group(self, event=None):
+        """Show the selected group in the image grid, and select the image if one was picked."""
+        selection = self.duplicates_tree.selection()
+        if not selection or selection[0] not in self.duplicate_rows:
+            return
+        group, image_name = self.duplicate_rows[selection[0]]
+        self.display_thumbnails(group)
+        if image_name is not None:
+            self.select_image_by_index(self.dataset.image_positions[image_name])
+
+    def show_all_duplicates(self):
+        """Show every listed group in the image grid, one after another."""
+        self.display_thumbnails([image_name for group in self.visible_duplicate_groups() for image_name in group])
+
+    def open_export(self):
+        """Open the window for exporting the images shown in the grid for training."""
+        if self.export_window is not None and self.export_window.winfo_exists():
+            self.export_window.lift()
+            return
 
-        # Reset and update background colors in the All Tags list
-        for index, tag in enumerate(self.all_tags_list.get(0, tk.END)):
-            if tag in current_image_tags:
-                self.all_tags_list.itemconfig(index, bg="lightgreen", fg=default_fg)
-            else:
-                self.all_tags_list.itemconfig(index, bg=default_bg, fg=default_fg)
+        self.export_window = tk.Toplevel(self.root)
+        self.export_window.title("Export")
+        self.export_window.transient(self.root)
+
+        form = tk.Frame(self.export_window)
+        form.pack(fill=tk.X, padx=5, pady=5)
+        tk.Label(form, text="Folder:").grid(row=0, column=0, sticky="w")
+        self.export_destination = tk.StringVar()
+        tk.Entry(form, textvariable=self.export_destination, width=40).grid(row=0, column=1, columnspan=2, sticky="we")
+        tk.Button(form, text="Browse...", command=self.browse_export_destination).grid(row=0, column=3, padx=(5, 0))
+
+        tk.Label(form, text="Manifest:").grid(row=1, column=0, sticky="w")
+        self.export_format = tk.StringVar(value=EXPORT_FORMATS[0])
+        tk.OptionMenu(form, self.export_format, *EXPORT_FORMATS).grid(row=1, column=1, sticky="w")
+
+        self.export_shards = tk.BooleanVar(value=False)
+        tk.Checkbutton(form, text="Pack into tar shards of", variable=self.export_shards).grid(row=2, column=0, columnspan=2, sticky="w")
+        self.export_shard_size = tk.IntVar(value=SHARD_SIZE)
+        tk.Spinbox(form, from_=1, to=1000000, width=8, textvariable=self.export_shard_size).grid(row=2, column=2, sticky="w")
+        tk.Label(form, text="images").grid(row=2, column=3, sticky="w")
+
+        self.export_shuffle = tk.BooleanVar(value=False)
+        tk.Checkbutton(form, text="Shuffle tags, keeping the first", variable=self.export_shuffle).grid(row=3, column=0, columnspan=2, sticky="w")
+        self.export_keep_tokens = tk.IntVar(value=0)
+        tk.Spinbox(form, from_=0, to=100, width=8, textvariable=self.export_keep_tokens).grid(row=3, column=2, sticky="w")
+        tk.Label(form, text="in place").grid(row=3, column=3, sticky="w")
+
+        self.export_status = tk.Label(self.export_window, anchor="w")
+        self.export_status.pack(fill=tk.X, padx=5)
+
+        buttons = tk.Frame(self.export_window)
+        buttons.pack(fill=tk.X, padx=5, pady=5)
+        tk.Button(buttons, text="Export", command=self.start_export).pack(side=tk.LEFT)
+        tk.Button(buttons, text="Cancel", command=self.cancel_export).pack(side=tk.LEFT, padx=5)
+        tk.Button(buttons, text="Close", command=self.export_window.destroy).pack(side=tk.RIGHT)
+
+        self.export_status.config(text=f"{len(self.grid_images)} images shown in the grid will be exported")
+
+    def browse_export_destination(self):
+        directory = filedialog.askdirectory(parent=self.export_window)
+        if directory:
+            self.export_destination.set(directory)
+
+    def start_export(self):
+        """Export the images shown in the grid in the background."""
+        if self.exporter is not None or not self.grid_images:
+            return
+        destination = self.export_destination.get().strip()
+        if not destination:
+            messagebox.showerror("Export", "Choose a folder to export to.", parent=self.export_window)
+            return
+        try:
+            shard_size = self.export_shard_size.get()
+            keep_tokens = max(0, self.export_keep_tokens.get())
+        except tk.TclError:
+            return  # Not a number
+        exporter = self.exporter = Exporter(
+            destination, manifest=self.export_format.get(), shards=self.export_shards.get(), shard_size=shard_size,
+            shuffle_tags=self.export_shuffle.get(), keep_tokens=keep_tokens,
+        )
+        dataset = self.dataset
+        # Store matches are paged in on the export thread rather than listed here
+        image_names = self.grid_images if self.store is not None else list(self.grid_images)
+        results = Queue()
+
+        def run():
+            try:
+                progress = lambda done, total: results.put(("progress", done, total))
+                results.put(("done", exporter.export(dataset.directory, dataset.tags_of, image_names, len(image_names), progress), None))
+            except Exception as e:
+                results.put(("done", None, e))
+
+        threading.Thread(target=run, daemon=True).start()
+        self.export_status.config(text="Exporting...")
+        self.root.after(self.EXPORT_POLL_MS, self.poll_export, exporter, results)
+
+    def poll_export(self, exporter, results):
+        """Report export progress until it finishes."""
+        window_open = self.export_window is not None and self.export_window.winfo_exists()
+        while not results.empty():
+            item = results.get_nowait()
+            if item[0] == "progress":
+                if window_open and exporter is self.exporter:
+                    self.export_status.config(text=f"Exported {item[1]} / {item[2]} images")
+                continue
+
+            _, result, error = item
+            if exporter is not self.exporter:
+                return  # Cancelled
+            self.exporter = None
+            if error is not None:
+                log.error("Error exporting: %s", error)
+                messagebox.showerror("Error", f"Could not export: {error}")
+                return
+            text = f"Exported {result['images']} images"
+            if exporter.shards:
+                text += f" in {result['shards']} shards"
+            if result["skipped"]:
+                text += f", skipped {len(result['skipped'])} that couldn't be read"
+            if window_open:
+                self.export_status.config(text=text)
+            return
+
+        self.root.after(self.EXPORT_POLL_MS, self.poll_export, exporter, results)
 
+    def cancel_export(self):
+        if self.exporter is not None:
+            self.exporter.cancel()
+            self.exporter = None
+            if self.export_window is not None and self.export_window.winfo_exists():
+                self.export_status.config(text="Cancelled")
+
+    def open_diagnostics(self):
+        """Open the window listing the timers, counters and gauges collected while instrumented."""
+        if self.diagnostics_window is not None and self.diagnostics_window.winfo_exists():
+            self.diagnostics_window.lift()
+            return
+
+        self.diagnostics_window = tk.Toplevel(self.root)
+        self.diagnostics_window.title("Diagnostics")
+
+        controls = tk.Frame(self.diagnostics_window)
+        controls.pack(fill=tk.X, padx=5, pady=5)
+        self.instrument_var = tk.BooleanVar(value=INSTRUMENTS.enabled)
+        tk.Checkbutton(
+            controls, text="Collect measurements", variable=self.instrument_var, command=self.toggle_instrumentation
+        ).pack(side=tk.LEFT)
+        tk.Button(controls, text="Reset", command=self.reset_diagnostics).pack(side=tk.LEFT, padx=5)
+        tk.Button(controls, text="Export CSV", command=lambda: self.export_diagnostics(".csv")).pack(side=tk.RIGHT)
+        tk.Button(controls, text="Export JSON", command=lambda: self.export_diagnostics(".json")).pack(side=tk.RIGHT, padx=5)
+
+        columns = ("kind", "count", "total", "mean", "max", "value")
+        self.diagnostics_tree = Treeview(self.diagnostics_window, columns=columns, height=20)
+        self.diagnostics_tree.heading("#0", text="Name", anchor="w")
+        self.diagnostics_tree.column("#0", width=220)
+        for column in columns:
+            self.diagnostics_tree.heading(column, text=column.title())
+            self.diagnostics_tree.column(column, width=80, anchor="e")
+        self.diagnostics_tree.pack(fill=tk.BOTH, expand=True, padx=5, pady=5)
+
+        self.refresh_diagnostics()
+
+    def refresh_diagnostics(self):
+        """Redraw the diagnostics table, then again every second while the window is open."""
+        if self.diagnostics_window is None or not self.diagnostics_window.winfo_exists():
+            self.diagnostics_window = None
+            return
 
+        def seconds(value):
+            return "" if value is None else f"{value * 1000:.2f} ms"
 
+        self.diagnostics_tree.delete(*self.diagnostics_tree.get_children())
+        for row in INSTRUMENTS.snapshot():
+            values = (row["kind"], row["count"] if row["count"] is not None else "")
+            if row["kind"] == "timer":
+                values += (f"{row['total_s']:.3f} s", seconds(row["mean_s"]), seconds(row["max_s"]), "")
+            else:
+                values += ("", "", "" if row["max_s"] is None else row["max_s"], row["value"])
+            self.diagnostics_tree.insert("", tk.END, text=row["name"], values=values)
+
+        self.root.after(1000, self.refresh_diagnostics)
+
+    def toggle_instrumentation(self):
+        INSTRUMENTS.enabled = self.instrument_var.get()
+
+    def reset_diagnostics(self):
+        INSTRUMENTS.reset()
+        self.refresh_diagnostics()
+
+    def export_diagnostics(self, extension):
+        """Save the current measurements as JSON or CSV."""
+        path = filedialog.asksaveasfilename(
+            parent=self.diagnostics_window,
+            defaultextension=extension,
+            filetypes=[(extension[1:].upper(), "*" + extension)],
+            initialfile="el_caption_diagnostics" + extension,
+        )
+        if not path:
+            return
+        try:
+            if extension == ".json":
+                INSTRUMENTS.export_json(path)
+            else:
+                INSTRUMENTS.export_csv(path)
+        except OSError as e:
+            messagebox.showerror("Export Failed", str(e), parent=self.diagnostics_window)
 
     def on_close(self):
         """Handle application close."""
-        print("Closing application...")
-
-        # Signal the save thread to exit
-        self.save_queue.put((None, None))
+        if self.flush_window is not None:
+            return  # Queued saves are being written before a directory switch, close once they are
+        log.info("Closing application")
+
+        # Stop generating thumbnails
+        if self.thumbnail_loader is not None:
+            self.thumbnail_loader.shutdown()
+
+        self.preview_cache.shutdown()
+        if self.watcher is not None:
+            self.watcher.stop()
+
+        # Stop loading
+        if self.directory_loader is not None:
+            self.directory_loader.cancel(discard=True)
+        self.cancel_duplicates()
+        self.cancel_export()
+
+        # Flush pending caption saves, showing progress if there is anything left
+        self.saver.expedite()
+        if self.saver.pending_count():
+            self.show_flush_progress(self.finish_close)
+        else:
+            self.finish_close()
+
+    def show_flush_progress(self, on_done):
+        """Show a small modal window while queued caption saves are written out, then call ``on_done()``."""
+        self.flush_window = tk.Toplevel(self.root)
+        self.flush_window.title("Saving")
+        self.flush_window.protocol("WM_DELETE_WINDOW", lambda: None)  # Don't lose edits
+        self.flush_window.transient(self.root)
+        self.flush_window.grab_set()  # No new edits while the queue drains
+
+        self.flush_label = tk.Label(self.flush_window, text="", padx=20, pady=20)
+        self.flush_label.pack()
+
+        self.flush_total = self.saver.pending_count()
+        self.poll_flush_progress(on_done)
+
+    def poll_flush_progress(self, on_done):
+        remaining = self.saver.pending_count()
+        if not remaining:
+            self.flush_window.destroy()
+            self.flush_window = None
+            on_done()
+            return
 
-        # Wait for the queue to finish processing
-        self.save_queue.join()
+        self.flush_label.config(text=f"Saving captions: {self.flush_total - remaining} of {self.flush_total} written")
+        self.root.after(100, self.poll_flush_progress, on_done)
 
-        # Wait for the thread to terminate
-        self.save_thread.join()
+    def finish_close(self):
+        """Stop the saver and close the window."""
+        self.saver.close()
+        self.save_manifest()
+        self.close_journal()
+        self.close_store()
 
-        print("Application closed.")
         self.root.destroy()
         
+    def index_image_tag_rows(self, tags):
+        """Rebuild the tag -> row map for the Image Tags list."""
+        self.image_tag_rows = {}
+        for row, tag in enumerate(tags):
+            self.image_tag_rows.setdefault(tag, row)
+
     def highlight_tag_in_image_tags(self, tag):
         """Highlight a tag in the Image Tags list if it exists."""
-        for index, current_tag in enumerate(self.image_tags_list.get(0, tk.END)):
-            if current_tag == tag:
-                self.image_tags_list.selection_clear(0, tk.END)  # Clear previous selections
-                self.image_tags_list.selection_set(index)  # Highlight the matching tag
-                self.image_tags_list.see(index)  # Scroll to make the tag visible
-                break
+        index = self.image_tag_rows.get(tag)
+        if index is not None:
+            self.image_tags_list.selection_clear(0, tk.END)  # Clear previous selections
+            self.image_tags_list.selection_set(index)  # Highlight the matching tag
+            self.image_tags_list.see(index)  # Scroll to make the tag visible
 
             
     def find_tag_in_image_tags(self, event):
@@ -696,16 +2801,17 @@ class ImageTaggerApp:
         if not selection:
             return
 
-        tag = self.all_tags_list.get(selection[0])
+        tag = self.visible_tags[selection[0]]
 
         # Check if the tag is in Image Tags
-        image_name = self.images[self.current_image_index]
-        if tag in self.image_tags[image_name]:
+        image_name = self.dataset.images[self.current_image_index]
+        if tag in self.dataset.tags_of(image_name):
             # Highlight and scroll to the tag in Image Tags
             self.highlight_tag_in_image_tags(tag)
 
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s %(name)s: %(message)s")
     root = tk.Tk()
     app = ImageTaggerApp(root)
     root.mainloop()
\ No newline at end of file
@@ -0,0 +1,317 @@
+"""Command line tools for El Caption datasets, for machines without a display.
+
+Examples::
+
+    python el_caption_cli.py stats ./dataset
+    python el_caption_cli.py filter ./dataset "orange hair, !(hat)"
+    python el_caption_cli.py rename-tag ./dataset "red_eyes" "red eyes" --dry-run
+    python el_caption_cli.py delete-tag ./dataset "watermark"
+    python el_caption_cli.py add-tag ./dataset "solo" --where "1girl, !(multiple girls)"
+    python el_caption_cli.py filter ./dataset "orange hair" --store --offset 1000 --limit 100
+    python el_caption_cli.py stats ./shards --recursive
+    python el_caption_cli.py stats ./part1:./part2
+    python el_caption_cli.py export ./dataset ./export --where "1girl" --shards --shuffle-tags --keep-tokens 1
+
+With ``--store`` the dataset is kept in ``.elcaption/captions.sqlite3``
+and queried there instead of being loaded into memory; each run only
+reads the captions changed since the last one.
+"""
+
+import argparse
+import json
+import os
+import sys
+
+from el_caption_core import CaptionSaver, Dataset, FilterSyntaxError, save_manifest, split_roots
+from el_caption_export import EXPORT_FORMATS, SHARD_SIZE, Exporter
+from el_caption_store import CaptionStore
+
+
+def dataset_folders(args):
+    """Return the folders named on the command line, separated by os.pathsep like the app's directory field."""
+    return [folder for folder in args.directory.split(os.pathsep) if folder]
+
+
+def load_dataset(args, refresh_manifest=True):
+    """Load the dataset named on the command line, refreshing its manifest if captions were re-read.
+
+    Editing commands pass ``refresh_manifest=False``: they refresh it when
+    they save, and a dry run writes nothing.
+    """
+    dataset = Dataset(args.directory, args.roots, recursive=args.recursive)
+    reread = dataset.load(max_workers=args.workers)
+    if reread and refresh_manifest:
+        save_manifest(dataset.directory, dataset.manifest_entries())
+    return dataset
+
+
+def open_store(args):
+    """Open the dataset's SQLite store and sync it with the caption files."""
+    store = CaptionStore(args.directory, roots=args.roots, recursive=args.recursive)
+    _, _, _, conflicts = store.sync(max_workers=args.workers)
+    for image_name in conflicts:
+        print(f"Discarded unsaved edits to {image_name}, its caption was changed by another program.", file=sys.stderr)
+    return store
+
+
+def scope_for(dataset, query):
+    """Return the set of images matching ``query``, or None for no restriction."""
+    if query is None:
+        return None
+    return set(dataset.filter(query))
+
+
+def save_changes(dataset, image_names, args):
+    """Write the captions of ``image_names`` (or report them on a dry run); return an exit code."""
+    if args.dry_run:
+        for image_name in image_names[:args.show]:
+            print(f"{image_name}: {', '.join(dataset.image_tags[image_name])}")
+        if len(image_names) > args.show:
+            print(f"... and {len(image_names) - args.show} more")
+        print(f"Dry run: {len(image_names)} caption files would be written.")
+        return 0
+
+    saver = CaptionSaver(max_workers=args.workers)
+    for image_name in image_names:
+        # Refuse to overwrite captions edited since we read them
+        saver.queue(
+            dataset.caption_path(image_name),
+            dataset.image_tags[image_name],
+            expected_stat=dataset.caption_stats[image_name],
+        )
+    saver.close()
+
+    conflicts = []
+    while not saver.conflicts.empty():
+        conflicts.append(saver.conflicts.get_nowait()[0])
+
+    save_manifest(dataset.directory, dataset.manifest_entries(saver))
+    print(f"Wrote {len(image_names) - len(conflicts)} caption files.")
+    if conflicts:
+        print(f"Skipped {len(conflicts)} caption files changed by another program while running:", file=sys.stderr)
+        for tag_path in conflicts:
+            print(f"  {tag_path}", file=sys.stderr)
+        return 1
+    return 0
+
+
+def save_store_changes(store, image_names, args):
+    """Store counterpart of save_changes: flush the edits (or roll them back on a dry run)."""
+    if args.dry_run:
+        for image_name in image_names[:args.show]:
+            print(f"{image_name}: {', '.join(store.tags_of(image_name))}")
+        if len(image_names) > args.show:
+            print(f"... and {len(image_names) - args.show} more")
+        print(f"Dry run: {len(image_names)} caption files would be written.")
+        store.rollback()
+        return 0
+
+    written, conflicts = store.flush(max_workers=args.workers)
+    print(f"Wrote {len(written)} caption files.")
+    if conflicts:
+        print(f"Skipped {len(conflicts)} caption files changed by another program while running:", file=sys.stderr)
+        for image_name in conflicts:
+            print(f"  {store.caption_path(image_name)}", file=sys.stderr)
+        return 1
+    return 0
+
+
+def cmd_stats(args):
+    if args.store:
+        with open_store(args) as store:
+            stats = store.stats(top=args.top)
+    else:
+        stats = load_dataset(args).stats(top=args.top)
+    if args.json:
+        print(json.dumps(stats, indent=2))
+        return 0
+
+    print(f"Images: {stats['images']} ({stats['captioned']} captioned)")
+    print(f"Tags: {stats['tags']} unique, {stats['tag_occurrences']} total, "
+          f"{stats['mean_tags_per_image']:.1f} per image")
+    for tag, count in stats["top_tags"]:
+        print(f"{count:>8}  {tag}")
+    return 0
+
+
+def cmd_filter(args):
+    if args.store:
+        with open_store(args) as store:
+            if args.count:
+                print(store.count(args.query))
+            elif args.limit is None and not args.offset:
+                sys.stdout.writelines(image_name + "\n" for image_name in store.iter_matches(args.query))
+            else:
+                limit = -1 if args.limit is None else args.limit  # -1 is no limit to SQLite
+                sys.stdout.writelines(image_name + "\n" for image_name in store.page(args.query, args.offset, limit))
+        return 0
+
+    matches = load_dataset(args).filter(args.query)
+    if args.count:
+        print(len(matches))
+    else:
+        end = None if args.limit is None else args.offset + args.limit
+        sys.stdout.writelines(image_name + "\n" for image_name in matches[args.offset:end])
+    return 0
+
+
+def cmd_rename_tag(args):
+    if args.store:
+        with open_store(args) as store:
+            touched = store.rename_tag(args.old_tag, args.new_tag, where=args.where)
+            print(f"Renaming '{args.old_tag}' to '{args.new_tag}' on {len(touched)} images.")
+            return save_store_changes(store, touched, args)
+
+    dataset = load_dataset(args, refresh_manifest=False)
+    touched = dataset.rename_tag(args.old_tag, args.new_tag, scope=scope_for(dataset, args.where))
+    print(f"Renaming '{args.old_tag}' to '{args.new_tag}' on {len(touched)} images.")
+    return save_changes(dataset, touched, args)
+
+
+def cmd_delete_tag(args):
+    if args.store:
+        with open_store(args) as store:
+            touched = store.delete_tag(args.tag, where=args.where)
+            print(f"Deleting '{args.tag}' from {len(touched)} images.")
+            return save_store_changes(store, touched, args)
+
+    dataset = load_dataset(args, refresh_manifest=False)
+    touched = dataset.delete_tag(args.tag, scope=scope_for(dataset, args.where))
+    print(f"Deleting '{args.tag}' from {len(touched)} images.")
+    return save_changes(dataset, touched, args)
+
+
+def cmd_add_tag(args):
+    if args.store:
+        with open_store(args) as store:
+            touched = store.add_tag(args.tag, where=args.where)
+            print(f"Adding '{args.tag}' to {len(touched)} images.")
+            return save_store_changes(store, touched, args)
+
+    dataset = load_dataset(args, refresh_manifest=False)
+    touched = dataset.add_tag_to(args.tag, dataset.filter(args.where))
+    print(f"Adding '{args.tag}' to {len(touched)} images.")
+    return save_changes(dataset, touched, args)
+
+
+def print_progress(done, total):
+    print(f"\rExported {done}" + (f" / {total}" if total is not None else "") + " images", end="", file=sys.stderr)
+
+
+def cmd_export(args):
+    exporter = Exporter(
+        args.destination, manifest=args.format, shards=args.shards, shard_size=args.shard_size,
+        shard_bytes=args.shard_mb << 20, shuffle_tags=args.shuffle_tags, keep_tokens=args.keep_tokens,
+        max_tags=args.max_tags, seed=args.seed, max_workers=args.workers,
+    )
+    if args.store:
+        with open_store(args) as store:
+            result = exporter.export(
+                store.directory, store.tags_of, store.iter_matches(args.where), store.count(args.where), print_progress
+            )
+    else:
+        dataset = load_dataset(args)
+        image_names = dataset.images if args.where is None else dataset.filter(args.where)
+        result = exporter.export(dataset.directory, dataset.tags_of, image_names, len(image_names), print_progress)
+    print(file=sys.stderr)
+    if result is None:
+        print("Export cancelled.", file=sys.stderr)
+        return 1
+
+    print(f"Exported {result['images']} images to {exporter.manifest_path()}"
+          + (f" and {result['shards']} shards." if args.shards else "."))
+    if result["skipped"]:
+        print(f"Skipped {len(result['skipped'])} images that couldn't be read:", file=sys.stderr)
+        for image_path in result["skipped"]:
+            print(f"  {image_path}", file=sys.stderr)
+        return 1
+    return 0
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Inspect and bulk-edit El Caption datasets.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument(
+        "directory", help=f"dataset directory of .png images and .txt captions; several separated by '{os.pathsep}'"
+    )
+    common.add_argument("--workers", type=int, default=8, help="threads used to read and write captions")
+    common.add_argument("--store", action="store_true", help="query an SQLite store of the dataset instead of loading it")
+    common.add_argument("-r", "--recursive", action="store_true", help="include images in subfolders, named by relative path")
+
+    editing = argparse.ArgumentParser(add_help=False)
+    editing.add_argument("--dry-run", action="store_true", help="show what would change without writing anything")
+    editing.add_argument("--show", type=int, default=20, help="captions listed by --dry-run")
+
+    stats = subparsers.add_parser("stats", parents=[common], help="summarise images and tags")
+    stats.add_argument("--top", type=int, default=20, help="most used tags to list")
+    stats.add_argument("--json", action="store_true", help="print machine-readable JSON")
+    stats.set_defaults(func=cmd_stats)
+
+    filter_ = subparsers.add_parser("filter", parents=[common], help="list images matching a filter query")
+    filter_.add_argument("query", help="filter query, same syntax as the Images filter")
+    filter_.add_argument("--count", action="store_true", help="only print the number of matches")
+    filter_.add_argument("--offset", type=int, default=0, help="skip this many matches")
+    filter_.add_argument("--limit", type=int, help="print at most this many matches")
+    filter_.set_defaults(func=cmd_filter)
+
+    rename = subparsers.add_parser("rename-tag", parents=[common, editing], help="rename or merge a tag")
+    rename.add_argument("old_tag")
+    rename.add_argument("new_tag")
+    rename.add_argument("--where", help="only images matching this filter query")
+    rename.set_defaults(func=cmd_rename_tag)
+
+    delete = subparsers.add_parser("delete-tag", parents=[common, editing], help="remove a tag from captions")
+    delete.add_argument("tag")
+    delete.add_argument("--where", help="only images matching this filter query")
+    delete.set_defaults(func=cmd_delete_tag)
+
+    add = subparsers.add_parser("add-tag", parents=[common, editing], help="add a tag to matching images")
+    add.add_argument("tag")
+    add.add_argument("--where", required=True, help="filter query selecting the images")
+    add.set_defaults(func=cmd_add_tag)
+
+    export = subparsers.add_parser("export", parents=[common], help="write captions to a manifest, optionally with tar shards")
+    export.add_argument("destination", help="folder for the manifest and shards")
+    export.add_argument("--where", help="only images matching this filter query")
+    export.add_argument("--format", choices=EXPORT_FORMATS, default="jsonl", help="manifest format")
+    export.add_argument("--shards", action="store_true", help="also pack images and captions into webdataset-style tar shards")
+    export.add_argument("--shard-size", type=int, default=SHARD_SIZE, help="images per shard")
+    export.add_argument("--shard-mb", type=int, default=1024, help="maximum shard size in MB")
+    export.add_argument("--shuffle-tags", action="store_true", help="shuffle the order of each caption's tags")
+    export.add_argument("--keep-tokens", type=int, default=0, help="tags at the start of each caption left in place by --shuffle-tags")
+    export.add_argument("--max-tags", type=int, help="export at most this many tags per caption")
+    export.add_argument("--seed", type=int, help="seed for --shuffle-tags, for repeatable exports")
+    export.set_defaults(func=cmd_export)
+
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    for folder in dataset_folders(args) or [args.directory]:
+        if not os.path.isdir(folder):
+            print(f"Not a directory: {folder}", file=sys.stderr)
+            return 2
+    try:
+        # Several folders load as one dataset under their common parent
+        args.directory, args.roots = split_roots(dataset_folders(args))
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        return 2
+    for name in ("old_tag", "new_tag", "tag"):
+        if hasattr(args, name):
+            setattr(args, name, getattr(args, name).strip())
+            if not getattr(args, name):
+                print("Tags cannot be empty.", file=sys.stderr)
+                return 2
+    try:
+        return args.func(args)
+    except FilterSyntaxError as e:
+        print(f"Invalid filter: {e}", file=sys.stderr)
+        return 2
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,1846 @@
+"""Dataset engine for El Caption: captions, tags, indexes and filtering.
+
+Nothing here imports tkinter or PIL, so it runs on machines without a
+display; ``el_caption.py`` builds the UI on top of it and
+``el_caption_cli.py`` the batch command line.
+"""
+
+import os
+import re
+import csv
+import json
+import logging
+import threading
+import time
+import fnmatch
+import functools
+import bisect
+import itertools
+from array import array
+from collections import Counter, OrderedDict
+from collections.abc import Mapping
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from queue import Queue
+
+# Hidden directory created next to the dataset for El Caption's own files
+CACHE_DIR_NAME = ".elcaption"
+
+log = logging.getLogger("el_caption")
+
+
+class _NullTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+NULL_TIMER = _NullTimer()
+
+
+class _Timer:
+    __slots__ = ("instruments", "name", "started")
+
+    def __init__(self, instruments, name):
+        self.instruments = instruments
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.instruments.record(self.name, time.perf_counter() - self.started)
+        return False
+
+
+class Instrumentation:
+    """Named timers, counters and gauges showing where time goes.
+
+    Off by default. While disabled ``timer()`` hands out a shared no-op
+    context manager and the other methods return straight away, so
+    instrumented code pays for one attribute check. Set ``EL_CAPTION_INSTRUMENT=1``
+    to start enabled.
+    """
+
+    CSV_FIELDS = ("name", "kind", "count", "total_s", "mean_s", "max_s", "value")
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.timings = {}  # name -> [count, total seconds, max seconds]
+            self.counters = {}  # name -> count
+            self.gauges = {}  # name -> [last value, max value]
+
+    def timer(self, name):
+        """Return a context manager that records how long its block takes under ``name``."""
+        if not self.enabled:
+            return NULL_TIMER
+        return _Timer(self, name)
+
+    def record(self, name, seconds):
+        """Record one measured duration."""
+        if not self.enabled:
+            return
+        with self.lock:
+            entry = self.timings.get(name)
+            if entry is None:
+                self.timings[name] = [1, seconds, seconds]
+            else:
+                entry[0] += 1
+                entry[1] += seconds
+                entry[2] = max(entry[2], seconds)
+
+    def count(self, name, amount=1):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def gauge(self, name, value):
+        """Record the current value of something that goes up and down, like a queue depth."""
+        if not self.enabled:
+            return
+        with self.lock:
+            entry = self.gauges.get(name)
+            if entry is None:
+                self.gauges[name] = [value, value]
+            else:
+                entry[0] = value
+                entry[1] = max(entry[1], value)
+
+    def snapshot(self):
+        """Return every metric as a list of dicts with the CSV_FIELDS keys, sorted by name."""
+        rows = []
+        with self.lock:
+            for name, (count, total, longest) in self.timings.items():
+                rows.append({"name": name, "kind": "timer", "count": count, "total_s": total,
+                             "mean_s": total / count, "max_s": longest, "value": None})
+            for name, value in self.counters.items():
+                rows.append({"name": name, "kind": "counter", "count": value, "total_s": None,
+                             "mean_s": None, "max_s": None, "value": value})
+            for name, (value, highest) in self.gauges.items():
+                rows.append({"name": name, "kind": "gauge", "count": None, "total_s": None,
+                             "mean_s": None, "max_s": highest, "value": value})
+        rows.sort(key=lambda row: row["name"])
+        return rows
+
+    def export_json(self, path):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"metrics": self.snapshot()}, f, indent=2)
+
+    def export_csv(self, path):
+        with open(path, "w", newline="", encoding="utf-8") as f:
+            writer = csv.DictWriter(f, fieldnames=self.CSV_FIELDS)
+            writer.writeheader()
+            writer.writerows(self.snapshot())
+
+
+# Shared by the engine, the UI and the command line tools
+INSTRUMENTS = Instrumentation(enabled=os.environ.get("EL_CAPTION_INSTRUMENT") == "1")
+
+
+def natural_sort_key(s):
+    """Generate a sort key for natural sort order."""
+    # Split the string into chunks of digits and non-digits
+    return [int(text) if text.isdigit() else text.lower() for text in re.split(r'(\d+)', s)]
+
+
+class SortedTags:
+    """Tags kept in natural sort order, with their sort keys precomputed.
+
+    Positions are found by binary search, so membership tests, inserts and
+    removals don't re-sort the vocabulary. The position of a tag is also its
+    row in a Listbox that mirrors this container.
+
+    ``sort_key`` replaces the natural order, e.g. to sort by frequency. Keys
+    are computed once on insert, so a key that can change must be read from
+    a snapshot the caller updates around ``discard`` and ``add``.
+    """
+
+    def __init__(self, tags=(), sort_key=None):
+        if sort_key is not None:
+            self.sort_key = sort_key
+        entries = sorted((self.sort_key(tag), tag) for tag in set(tags))
+        self.keys = [key for key, _ in entries]
+        self.tags = [tag for _, tag in entries]
+
+    @staticmethod
+    def sort_key(tag):
+        # The tag itself breaks ties between tags that differ only in case
+        return (natural_sort_key(tag), tag)
+
+    def __len__(self):
+        return len(self.tags)
+
+    def __iter__(self):
+        return iter(self.tags)
+
+    def __getitem__(self, index):
+        return self.tags[index]
+
+    def __contains__(self, tag):
+        return self.index(tag) is not None
+
+    def index(self, tag):
+        """Return the position of ``tag``, or None if it isn't present."""
+        index = bisect.bisect_left(self.keys, self.sort_key(tag))
+        if index < len(self.tags) and self.tags[index] == tag:
+            return index
+        return None
+
+    def add(self, tag):
+        """Insert ``tag`` and return its position, or None if it was already present."""
+        key = self.sort_key(tag)
+        index = bisect.bisect_left(self.keys, key)
+        if index < len(self.tags) and self.tags[index] == tag:
+            return None
+        self.keys.insert(index, key)
+        self.tags.insert(index, tag)
+        return index
+
+    def discard(self, tag):
+        """Remove ``tag`` and return the position it had, or None if it wasn't present."""
+        index = self.index(tag)
+        if index is not None:
+            del self.keys[index]
+            del self.tags[index]
+        return index
+
+    def subset(self, predicate):
+        """Return a new SortedTags holding the tags that satisfy ``predicate``, without re-sorting."""
+        result = SortedTags(sort_key=self.sort_key)
+        for key, tag in zip(self.keys, self.tags):
+            if predicate(tag):
+                result.keys.append(key)
+                result.tags.append(tag)
+        return result
+
+
+def normalize_tag(tag):
+    """Fold case, underscores and repeated spaces, to spot near-duplicate tags."""
+    return " ".join(tag.lower().replace("_", " ").split())
+
+
+class TagSearchIndex:
+    """Trigram index over the tag vocabulary for case-insensitive substring search.
+
+    A query of three or more characters only has to check tags that contain
+    all of its trigrams, starting from the rarest one. Shorter queries match
+    too much of the vocabulary for an index to help, so they scan it instead.
+    """
+
+    def __init__(self):
+        self.lowered = {}  # tag -> lowercase tag
+        self.trigrams = {}  # trigram -> set of tags
+        self.normalized = {}  # normalize_tag(tag) -> set of tags
+
+    @staticmethod
+    def _trigrams(text):
+        return {text[i:i + 3] for i in range(len(text) - 2)}
+
+    def add(self, tag):
+        if tag in self.lowered:
+            return
+        lowered = self.lowered[tag] = tag.lower()
+        for gram in self._trigrams(lowered):
+            self.trigrams.setdefault(gram, set()).add(tag)
+        self.normalized.setdefault(normalize_tag(tag), set()).add(tag)
+
+    def discard(self, tag):
+        lowered = self.lowered.pop(tag, None)
+        if lowered is None:
+            return
+        for gram in self._trigrams(lowered):
+            tags = self.trigrams[gram]
+            tags.discard(tag)
+            if not tags:
+                del self.trigrams[gram]
+        key = normalize_tag(tag)
+        self.normalized[key].discard(tag)
+        if not self.normalized[key]:
+            del self.normalized[key]
+
+    def search(self, query):
+        """Return the set of tags containing ``query``, ignoring case."""
+        query = query.lower()
+        if len(query) < 3:
+            return {tag for tag, lowered in self.lowered.items() if query in lowered}
+
+        postings = []
+        for gram in self._trigrams(query):
+            tags = self.trigrams.get(gram)
+            if not tags:
+                return set()
+            postings.append(tags)
+        postings.sort(key=len)
+
+        candidates = postings[0].intersection(*postings[1:])
+        if len(query) == 3:
+            return candidates
+        # Sharing every trigram doesn't guarantee the trigrams are contiguous
+        return {tag for tag in candidates if query in self.lowered[tag]}
+
+    def ranked(self, query, frequency, limit=None):
+        """Return tags containing ``query``, most frequent first."""
+        tags = sorted(self.search(query), key=lambda tag: (-frequency(tag), natural_sort_key(tag)))
+        return tags if limit is None else tags[:limit]
+
+    def near_duplicates(self, tag):
+        """Return existing tags that differ from ``tag`` only in case, underscores or spacing."""
+        return self.normalized.get(normalize_tag(tag), set()) - {tag}
+
+
+class TagVocabulary:
+    """Interns tags to small integer ids, so captions can be stored as ``array('I')``.
+
+    Ids are never reused; a tag keeps its id for the life of the dataset
+    even when no image carries it any more.
+    """
+
+    def __init__(self):
+        self.tags = []  # id -> tag
+        self.ids = {}  # tag -> id
+
+    def __len__(self):
+        return len(self.tags)
+
+    def intern(self, tag):
+        """Return the id of ``tag``, assigning the next one if it is new."""
+        tag_id = self.ids.get(tag)
+        if tag_id is None:
+            tag_id = self.ids[tag] = len(self.tags)
+            self.tags.append(tag)
+        return tag_id
+
+    def id_of(self, tag):
+        """Return the id of ``tag``, or None if it was never interned."""
+        return self.ids.get(tag)
+
+    def encode(self, tags):
+        ids = self.ids
+        try:
+            return array("I", [ids[tag] for tag in tags])
+        except KeyError:  # Some tags are new
+            intern = self.intern
+            return array("I", [intern(tag) for tag in tags])
+
+    def decode(self, tag_ids):
+        tags = self.tags
+        return [tags[tag_id] for tag_id in tag_ids]
+
+
+class ImageTagsView(Mapping):
+    """Read-only ``{image name: tags}`` view of a Dataset's compact tag storage.
+
+    Each lookup decodes a fresh list, so callers may keep or change it
+    freely; edits go through the Dataset methods.
+    """
+
+    def __init__(self, dataset):
+        self.dataset = dataset
+
+    def __getitem__(self, image_name):
+        return self.dataset.tags_of(image_name)
+
+    def __contains__(self, image_name):
+        return image_name in self.dataset.image_ids
+
+    def __iter__(self):
+        return iter(self.dataset.images)
+
+    def __len__(self):
+        return len(self.dataset.images)
+
+
+class TagIndex:
+    """Inverted index from each tag to the set of image ids that carry it.
+
+    ``version`` changes on every mutation so cached query results can be
+    invalidated cheaply.
+    """
+
+    def __init__(self):
+        self.images_by_tag = {}
+        self.images = set()  # Every indexed image id, tagged or not
+        self.changed = set()  # Tags whose image count may have changed since take_changed()
+        self.version = 0
+
+    def add_image(self, image_id, tags):
+        """Index all tags of a newly loaded image."""
+        self.images.add(image_id)
+        self.version += 1
+        for tag in tags:
+            self.add(image_id, tag)
+
+    def remove_image(self, image_id, tags):
+        """Drop an image and all of its tags from the index."""
+        self.images.discard(image_id)
+        self.version += 1
+        for tag in set(tags):
+            self.discard(image_id, tag)
+
+    def add(self, image_id, tag):
+        images = self.images_by_tag.get(tag)
+        if images is None:
+            images = self.images_by_tag[tag] = set()
+        images.add(image_id)
+        self.changed.add(tag)
+        self.version += 1
+
+    def discard(self, image_id, tag):
+        images = self.images_by_tag.get(tag)
+        if images is None:
+            return
+        images.discard(image_id)
+        self.changed.add(tag)
+        if not images:
+            del self.images_by_tag[tag]
+        self.version += 1
+
+    def images_with(self, tag):
+        """Return the set of image ids carrying ``tag`` (do not mutate it)."""
+        return self.images_by_tag.get(tag, frozenset())
+
+    def count(self, tag):
+        return len(self.images_by_tag.get(tag, ()))
+
+    def take_changed(self):
+        """Return the tags whose count may have changed since the last call, and start over."""
+        changed, self.changed = self.changed, set()
+        return changed
+
+    def tags_matching(self, pattern):
+        """Resolve a tag, or a compiled wildcard regex, against the indexed vocabulary."""
+        if isinstance(pattern, str):
+            return [pattern] if pattern in self.images_by_tag else []
+        return [tag for tag in self.images_by_tag if pattern.match(tag)]
+
+
+class TagCooccurrence:
+    """Sparse, symmetric tag co-occurrence counts, by tag id.
+
+    ``row(a)[b]`` is the number of images carrying both ``a`` and ``b``, and
+    ``row(a)[a]`` is the number carrying ``a``. A row is counted from the
+    captions of the tag's images the first time it is asked for, then kept
+    current by ``add_image``/``remove_image``/``add_tag``/``remove_tag`` in
+    time proportional to the tags on the edited image. Only the ``MAX_ROWS``
+    most recently used rows are kept.
+    """
+
+    MAX_ROWS = 128
+
+    def __init__(self, build_row):
+        self.build_row = build_row  # tag id -> Counter of the tag ids on its images
+        self.rows = OrderedDict()
+
+    def row(self, tag_id):
+        row = self.rows.get(tag_id)
+        if row is None:
+            row = self.rows[tag_id] = self.build_row(tag_id)
+            if len(self.rows) > self.MAX_ROWS:
+                self.rows.popitem(last=False)
+        else:
+            self.rows.move_to_end(tag_id)
+        return row
+
+    @staticmethod
+    def _decrement(row, tag_id):
+        count = row[tag_id] - 1
+        if count > 0:
+            row[tag_id] = count
+        else:
+            del row[tag_id]
+
+    def add_image(self, tag_ids):
+        if not self.rows:
+            return
+        tag_ids = set(tag_ids)
+        for tag_id in tag_ids:
+            row = self.rows.get(tag_id)
+            if row is not None:
+                row.update(tag_ids)
+
+    def remove_image(self, tag_ids):
+        if not self.rows:
+            return
+        tag_ids = set(tag_ids)
+        for tag_id in tag_ids:
+            row = self.rows.get(tag_id)
+            if row is not None:
+                for other in tag_ids:
+                    self._decrement(row, other)
+
+    def add_tag(self, tag_id, others):
+        """Count ``tag_id`` newly on an image that carries the distinct tag ids ``others``."""
+        row = self.rows.get(tag_id)
+        if row is not None:
+            row.update(others)
+            row[tag_id] += 1
+        for other in others:
+            row = self.rows.get(other)
+            if row is not None:
+                row[tag_id] += 1
+
+    def remove_tag(self, tag_id, others):
+        """Uncount ``tag_id`` gone from an image that still carries the distinct tag ids ``others``."""
+        row = self.rows.get(tag_id)
+        if row is not None:
+            for other in others:
+                self._decrement(row, other)
+            self._decrement(row, tag_id)
+        for other in others:
+            row = self.rows.get(other)
+            if row is not None:
+                self._decrement(row, tag_id)
+
+
+class FilterSyntaxError(ValueError):
+    """Raised for filter queries that can't be parsed."""
+
+
+def tokenize_filter_query(query):
+    """Split a filter query into (kind, value) tokens.
+
+    Kinds are ``term``, ``and`` (comma), ``or`` (the standalone word OR),
+    ``not`` (``!`` directly before a parenthesis), ``(`` and ``)``. Parentheses
+    that appear inside a tag, as in ``ganyu (genshin impact)``, stay part of
+    the tag; double quotes force a literal tag.
+    """
+    tokens = []
+    pos = 0
+    length = len(query)
+
+    def or_at(index):
+        """True if the word OR starts at ``index`` and stands alone."""
+        end = index + 2
+        return query.startswith("OR", index) and (end == length or query[end].isspace() or query[end] == "(")
+
+    while pos < length:
+        char = query[pos]
+        if char.isspace():
+            pos += 1
+        elif char == ",":
+            tokens.append(("and", ","))
+            pos += 1
+        elif char in "()":
+            tokens.append((char, char))
+            pos += 1
+        elif char == "!" and query.startswith("!(", pos):
+            tokens.append(("not", "!"))
+            pos += 1
+        elif char == '"':
+            end = query.find('"', pos + 1)
+            if end == -1:
+                raise FilterSyntaxError("Unterminated quote in filter")
+            tokens.append(("literal", query[pos + 1:end]))
+            pos = end + 1
+        elif or_at(pos):
+            tokens.append(("or", "OR"))
+            pos += 2
+        else:
+            # A plain tag runs until a comma, a standalone OR or an unbalanced ")"
+            start = pos
+            depth = 0
+            while pos < length:
+                char = query[pos]
+                if char == "," and depth == 0:
+                    break
+                if char == "(":
+                    depth += 1
+                elif char == ")":
+                    if depth == 0:
+                        break
+                    depth -= 1
+                elif char.isspace() and depth == 0 and or_at(pos + 1):
+                    break
+                pos += 1
+            tokens.append(("term", query[start:pos].strip()))
+
+    return tokens
+
+
+class FilterQuery:
+    """A filter query compiled to an expression tree.
+
+    Grammar, loosest binding first::
+
+        query := and_expr ("OR" and_expr)*
+        and_expr := unary ("," unary)*
+        unary := "!(" query ")" | "(" query ")" | tag
+
+    Tags may contain ``*``, ``?`` and ``[...]`` wildcards, which are compiled
+    to regexes once per query. Nodes are tuples: ``("all",)``, ``("tag", str)``,
+    ``("glob", regex)``, ``("not", node)``, ``("and", [nodes])`` and
+    ``("or", [nodes])``.
+    """
+
+    def __init__(self, query):
+        self.query = query
+        self.tokens = tokenize_filter_query(query)
+        self.pos = 0
+        self.tree = self._parse_or()
+        if self.pos < len(self.tokens):
+            raise FilterSyntaxError(f"Unexpected '{self.tokens[self.pos][1]}' in filter")
+        del self.tokens
+
+    def _peek(self):
+        return self.tokens[self.pos][0] if self.pos < len(self.tokens) else None
+
+    def _parse_or(self):
+        branches = []
+        while True:
+            branch = self._parse_and()
+            if branch is not None:
+                branches.append(branch)
+            if self._peek() != "or":
+                break
+            self.pos += 1
+
+        if not branches:
+            return ("all",)
+        return branches[0] if len(branches) == 1 else ("or", branches)
+
+    def _parse_and(self):
+        terms = []
+        while True:
+            term = self._parse_unary()
+            if term is not None:
+                terms.append(term)
+            if self._peek() != "and":
+                break
+            self.pos += 1
+
+        if not terms:
+            return None
+        return terms[0] if len(terms) == 1 else ("and", terms)
+
+    def _parse_unary(self):
+        kind = self._peek()
+        if kind == "not":
+            self.pos += 1
+            return ("not", self._parse_unary() or ("all",))
+        if kind == "(":
+            self.pos += 1
+            node = self._parse_or()
+            if self._peek() != ")":
+                raise FilterSyntaxError("Missing ')' in filter")
+            self.pos += 1
+            return node
+        if kind == "literal":
+            self.pos += 1
+            return ("tag", self.tokens[self.pos - 1][1])
+        if kind == "term":
+            self.pos += 1
+            pattern = self.tokens[self.pos - 1][1]
+            if any(char in pattern for char in "*?["):
+                return ("glob", re.compile(fnmatch.translate(pattern)))
+            return ("tag", pattern)
+        return None  # Empty operand, e.g. "a,,b"
+
+    def evaluate(self, index):
+        """Return the set of image ids in ``index`` that match the query."""
+        return self._evaluate(self.tree, index)
+
+    def _estimate(self, node, index):
+        """Cheap upper bound on the number of matches, used to order AND terms."""
+        kind = node[0]
+        if kind == "tag":
+            return len(index.images_with(node[1]))
+        if kind == "glob":
+            return sum(len(index.images_with(tag)) for tag in index.tags_matching(node[1]))
+        if kind == "and":
+            return min(self._estimate(child, index) for child in node[1])
+        if kind == "or":
+            return sum(self._estimate(child, index) for child in node[1])
+        if kind == "not":
+            return len(index.images) - self._estimate(node[1], index)
+        return len(index.images)
+
+    def _evaluate(self, node, index):
+        kind = node[0]
+        if kind == "all":
+            return set(index.images)
+        if kind == "tag":
+            return set(index.images_with(node[1]))
+        if kind == "glob":
+            return set().union(*(index.images_with(tag) for tag in index.tags_matching(node[1])))
+        if kind == "not":
+            return index.images - self._evaluate(node[1], index)
+        if kind == "or":
+            return set().union(*(self._evaluate(child, index) for child in node[1]))
+
+        # AND: intersect the most selective positive terms first, then subtract negations
+        positives = [child for child in node[1] if child[0] != "not"]
+        negatives = [child[1] for child in node[1] if child[0] == "not"]
+        positives.sort(key=lambda child: self._estimate(child, index))
+
+        result = self._evaluate(positives[0], index) if positives else set(index.images)
+        for child in positives[1:]:
+            if not result:
+                return result
+            result &= self._evaluate(child, index)
+        for child in negatives:
+            if not result:
+                break
+            result -= self._evaluate(child, index)
+        return result
+
+
+@functools.lru_cache(maxsize=128)
+def compile_filter_query(query):
+    """Parse a filter query, reusing the compiled form for repeated queries."""
+    return FilterQuery(query)
+
+
+def stage_caption_file(tag_path, tags):
+    """Write ``tags`` to a hidden temp file next to ``tag_path`` and return the temp file's path."""
+    directory, name = os.path.split(tag_path)
+    temp_path = os.path.join(directory, f".{name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    try:
+        # Same permissions a plain open() would give: the umask default, or the existing file's mode
+        fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+        with os.fdopen(fd, "w") as f:
+            f.write(", ".join(tags))
+        try:
+            os.chmod(temp_path, os.stat(tag_path).st_mode & 0o7777)
+        except FileNotFoundError:
+            pass
+        return temp_path
+    except BaseException:
+        remove_quietly(temp_path)
+        raise
+
+
+def remove_quietly(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def write_caption_file(tag_path, tags):
+    """Atomically replace a caption file, so a crash never leaves it truncated; return its new stat."""
+    temp_path = stage_caption_file(tag_path, tags)
+    try:
+        os.replace(temp_path, tag_path)
+    except BaseException:
+        remove_quietly(temp_path)
+        raise
+    return os.stat(tag_path)
+
+
+def caption_file_stat(tag_path):
+    """Return a caption's (mtime_ns, size), or None if the file doesn't exist."""
+    try:
+        stat = os.stat(tag_path)
+    except FileNotFoundError:
+        return None
+    return (stat.st_mtime_ns, stat.st_size)
+
+
+# Passed as expected_stat to skip CaptionSaver's on-disk conflict check
+UNCHECKED = object()
+
+
+class CaptionSaver:
+    """Write-behind saver for caption files.
+
+    Queued saves are keyed by path, so repeated edits of the same caption
+    collapse into one write of the latest tags. Tag lists are snapshotted when
+    queued, and a background thread drains the queue in batches across a small
+    worker pool.
+
+    A save can carry the ``(mtime_ns, size)`` the caption is expected to have
+    on disk (None if it shouldn't exist yet). If the file changed behind our
+    back the write is skipped and ``(tag_path, tags, disk_stat)`` is put on
+    ``conflicts`` instead of clobbering the other writer.
+
+    With a ``delay`` (seconds) nothing is written until the oldest queued
+    save is that old, so a burst of edits to one caption costs one write.
+    Only use it when the edits are durable elsewhere, e.g. in an
+    EditJournal. ``flush()`` and ``close()`` don't wait for the delay.
+    """
+
+    def __init__(self, max_workers=4, batch_size=256, delay=0):
+        self.max_workers = max_workers
+        self.batch_size = batch_size
+        self.delay = delay
+        self.pending = {}  # tag path -> (tags snapshot, expected stat), in queue order
+        self.due = {}  # tag path -> time.monotonic() after which it is written, while delayed
+        self.flushing = 0  # Threads waiting in flush(), which skips the delay
+        self.written_stats = {}  # tag path -> (mtime_ns, size) after our last write, until taken
+        self.conflicts = Queue()
+        self.in_flight = 0
+        self.in_flight_paths = set()
+        self.queued_at = {}  # tag path -> perf_counter() when first queued, while instrumented
+        self.closed = False
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def queue(self, tag_path, tags, expected_stat=UNCHECKED):
+        """Queue a caption file to be written with (a copy of) ``tags``."""
+        with self.condition:
+            # Re-queueing moves the entry to the back with the newest tags, the file's base state is unchanged
+            previous = self.pending.pop(tag_path, None)
+            if previous is not None:
+                expected_stat = previous[1]
+            self.pending[tag_path] = (tuple(tags), expected_stat)
+            if self.delay:
+                self.due.setdefault(tag_path, time.monotonic() + self.delay)
+            if INSTRUMENTS.enabled:
+                self.queued_at.setdefault(tag_path, time.perf_counter())
+                INSTRUMENTS.gauge("save.queue_depth", len(self.pending) + self.in_flight)
+            self.condition.notify_all()
+
+    def discard(self, tag_path):
+        """Drop a queued save and return its tags, or None if nothing was queued."""
+        with self.condition:
+            previous = self.pending.pop(tag_path, None)
+            self.due.pop(tag_path, None)
+            self.queued_at.pop(tag_path, None)
+            self.condition.notify_all()
+            return previous[0] if previous is not None else None
+
+    def expedite(self):
+        """Stop delaying saves and write everything queued right away."""
+        with self.condition:
+            self.delay = 0
+            self.due.clear()
+            self.condition.notify_all()
+
+    def is_pending(self, tag_path):
+        """Return True if a save of ``tag_path`` is queued or being written."""
+        with self.condition:
+            return tag_path in self.pending or tag_path in self.in_flight_paths
+
+    def written_stat(self, tag_path):
+        """Return the (mtime_ns, size) of our last write of ``tag_path`` if not yet taken, else None."""
+        with self.condition:
+            return self.written_stats.get(tag_path)
+
+    def forget_written(self, tag_path):
+        """Drop the stat of our last write of ``tag_path``, once the file is known to have changed since."""
+        with self.condition:
+            self.written_stats.pop(tag_path, None)
+
+    def take_written_stats(self):
+        """Return and forget the stats of the files written since the last call."""
+        with self.condition:
+            written_stats, self.written_stats = self.written_stats, {}
+            return written_stats
+
+    def pending_count(self):
+        """Return the number of caption files not yet written."""
+        with self.condition:
+            return len(self.pending) + self.in_flight
+
+    def flush(self, timeout=None):
+        """Block until everything queued so far is written; return False on timeout."""
+        with self.condition:
+            self.flushing += 1
+            self.condition.notify_all()
+            try:
+                return self.condition.wait_for(lambda: not self.pending and not self.in_flight, timeout)
+            finally:
+                self.flushing -= 1
+
+    def close(self, timeout=None):
+        """Flush and stop the worker thread."""
+        flushed = self.flush(timeout)
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        self.thread.join(timeout)
+        return flushed
+
+    def _run(self):
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while True:
+                with self.condition:
+                    while True:
+                        if not self.pending:
+                            if self.closed:
+                                return  # Closed and drained
+                            self.condition.wait()
+                        elif self.closed or self.flushing or not self.due:
+                            break
+                        else:
+                            wait = min(self.due.values()) - time.monotonic()
+                            if wait <= 0:
+                                break
+                            self.condition.wait(wait)
+
+                    batch = []
+                    for tag_path in list(self.pending)[:self.batch_size]:
+                        batch.append((tag_path, *self.pending.pop(tag_path)))
+                        self.due.pop(tag_path, None)
+                    self.in_flight = len(batch)
+                    self.in_flight_paths = {item[0] for item in batch}
+
+                # Each path appears once per batch, and batches don't overlap
+                list(executor.map(self._write, batch))
+
+                with self.condition:
+                    self.in_flight = 0
+                    self.in_flight_paths = set()
+                    self.condition.notify_all()
+
+    def _forget_queued(self, tag_path):
+        with self.condition:
+            if tag_path not in self.pending:
+                self.queued_at.pop(tag_path, None)
+
+    def _write(self, item):
+        tag_path, tags, expected_stat = item
+        try:
+            if expected_stat is not UNCHECKED:
+                disk_stat = caption_file_stat(tag_path)
+                if disk_stat != expected_stat:
+                    INSTRUMENTS.count("save.conflicts")
+                    self._forget_queued(tag_path)
+                    self.conflicts.put((tag_path, tags, disk_stat))
+                    return
+
+            with INSTRUMENTS.timer("save.write"):
+                stat = write_caption_file(tag_path, tags)
+        except Exception as e:
+            log.error("Error saving file %s: %s", tag_path, e)
+            self._forget_queued(tag_path)
+            return
+
+        new_stat = (stat.st_mtime_ns, stat.st_size)
+        with self.condition:
+            queued_at = self.queued_at.pop(tag_path, None)
+            if queued_at is not None and tag_path not in self.pending:
+                INSTRUMENTS.record("save.latency", time.perf_counter() - queued_at)
+
+            # Lets a rescan recognise our own writes as unchanged
+            self.written_stats[tag_path] = new_stat
+
+            # A save queued while this one was in flight now expects the file we just wrote
+            queued = self.pending.get(tag_path)
+            if queued is not None and expected_stat is not UNCHECKED and queued[1] == expected_stat:
+                self.pending[tag_path] = (queued[0], new_stat)
+
+
+class BatchEditError(Exception):
+    """Raised when a batch of caption writes can't be committed; no caption was changed."""
+
+
+def commit_caption_files(changes, max_workers=8):
+    """Write several caption files all-or-nothing and return {tag_path: (mtime_ns, size)}.
+
+    ``changes`` is a list of ``(tag_path, new_tags, old_tags, expected_stat)``.
+    Every new caption is first written to a temp file, and checked against
+    ``expected_stat`` like CaptionSaver does, before any caption is replaced.
+    If a replace still fails part-way, the captions already replaced are put
+    back from ``old_tags``.
+    """
+    def stage(change):
+        tag_path, tags, _, expected_stat = change
+        if expected_stat is not UNCHECKED and caption_file_stat(tag_path) != expected_stat:
+            raise BatchEditError(f"{tag_path} was changed by another program")
+        return stage_caption_file(tag_path, tags)
+
+    staged = {}
+    errors = []
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [(change[0], executor.submit(stage, change)) for change in changes]
+            for tag_path, future in futures:
+                try:
+                    staged[tag_path] = future.result()
+                except (OSError, BatchEditError) as e:
+                    errors.append(e)
+        if errors:
+            raise BatchEditError(
+                f"{len(errors)} of {len(changes)} captions could not be written, nothing was changed. "
+                f"First error: {errors[0]}"
+            )
+
+        new_stats = {}
+        replaced = []
+        for tag_path, _, old_tags, expected_stat in changes:
+            try:
+                os.replace(staged.pop(tag_path), tag_path)
+                new_stats[tag_path] = caption_file_stat(tag_path)
+            except OSError as e:
+                for replaced_path, replaced_tags, existed in reversed(replaced):
+                    if existed:
+                        write_caption_file(replaced_path, replaced_tags)
+                    else:
+                        remove_quietly(replaced_path)
+                raise BatchEditError(f"Could not replace {tag_path}: {e}. The captions already replaced were restored.")
+            replaced.append((tag_path, old_tags, expected_stat is not None))
+        return new_stats
+    finally:
+        for temp_path in staged.values():
+            remove_quietly(temp_path)
+
+
+def read_caption_file(tag_path):
+    """Read a caption file and return its tags in order."""
+    with open(tag_path, "r") as f:
+        # Split by commas and strip whitespace
+        return [tag.strip() for tag in f.read().strip().split(",")]
+
+
+MANIFEST_VERSION = 1
+
+
+def manifest_path(directory):
+    return os.path.join(directory, CACHE_DIR_NAME, "manifest.json")
+
+
+def load_manifest(directory):
+    """Return the saved manifest as {image_name: (caption stat or None, tags)}, or {} if unusable.
+
+    A caption stat is ``(mtime_ns, size)`` of the ``.txt`` file the tags were
+    parsed from; None means the image had no caption file.
+    """
+    try:
+        with open(manifest_path(directory), "r", encoding="utf-8") as f:
+            data = json.load(f)
+        if data.get("version") != MANIFEST_VERSION:
+            return {}
+        return {
+            image_name: (tuple(stat) if stat is not None else None, tags)
+            for image_name, (stat, tags) in data["entries"].items()
+        }
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        if not isinstance(e, FileNotFoundError):
+            log.warning("Ignoring unreadable manifest in %s: %s", directory, e)
+        return {}
+
+
+def save_manifest(directory, entries):
+    """Atomically write a manifest of {image_name: (caption stat or None, tags)}."""
+    path = manifest_path(directory)
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump({"version": MANIFEST_VERSION, "entries": entries}, f, separators=(",", ":"))
+        os.replace(temp_path, path)
+    except OSError as e:
+        log.error("Error saving manifest for %s: %s", directory, e)
+
+
+def journal_path(directory):
+    return os.path.join(directory, CACHE_DIR_NAME, "journal.jsonl")
+
+
+class EditJournal:
+    """Append-only log of tag edits, for undo/redo and crash recovery.
+
+    Each edit is one JSON line ``{"type": "edit", "id", "label", "changes"}``
+    where ``changes`` is ``[[image_name, old_tags, new_tags], ...]``; undo and
+    redo append ``{"type": "undo" | "redo", "id"}``. Lines go to the OS as
+    soon as they are recorded, so they survive the process being killed, and
+    a background thread fsyncs them at most every ``FSYNC_INTERVAL`` seconds.
+
+    Caption files are written lazily by the caller. Once they have all
+    landed, ``checkpoint()`` appends a ``{"type": "checkpoint"}`` line; lines
+    after the last checkpoint are ``unsaved`` and are replayed on startup
+    onto captions that never got written. When the file has doubled in size
+    since it was last compacted, the checkpoint rewrites it as just the undo
+    history (at most ``UNDO_LIMIT`` edits).
+    """
+
+    UNDO_LIMIT = 200
+    FSYNC_INTERVAL = 0.05
+    COMPACT_MIN_BYTES = 1 << 20  # Don't bother compacting smaller journals
+
+    def __init__(self, directory):
+        self.path = journal_path(directory)
+        self.undo_stack = []  # Edits, oldest first
+        self.redo_stack = []  # Undone edits, most recently undone last
+        self.unsaved = []  # (image_name, before, after) since the last checkpoint, in order
+        self.next_id = 1
+        torn = self._load()
+
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.file = open(self.path, "a", encoding="utf-8")
+        if torn:
+            self.file.write("\n")  # Keep the next record off the damaged line
+        self.compacted_size = self.file.tell()
+        self.dirty = False
+        self.closed = False
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self._sync, daemon=True)
+        self.thread.start()
+
+    def _load(self):
+        """Rebuild the undo/redo stacks and unsaved steps; return True if the last line was cut short."""
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                lines = f.readlines()
+        except FileNotFoundError:
+            return False
+        except OSError as e:
+            log.warning("Ignoring unreadable journal %s: %s", self.path, e)
+            return False
+
+        edits = {}
+        for line in lines:
+            try:
+                record = json.loads(line)
+                kind = record["type"]
+            except (ValueError, KeyError, TypeError):
+                log.warning("Ignoring damaged journal line in %s", self.path)  # A write cut short by a crash
+                continue
+            if kind == "checkpoint":
+                self.unsaved = []
+            elif kind == "edit":
+                entry = {"id": record["id"], "label": record["label"], "changes": record["changes"]}
+                edits[entry["id"]] = entry
+                self.next_id = max(self.next_id, entry["id"] + 1)
+                self.undo_stack.append(entry)
+                self.redo_stack = []
+                self.unsaved.extend(entry["changes"])
+            elif kind in ("undo", "redo"):
+                entry = edits.get(record.get("id"))
+                source, target = (self.undo_stack, self.redo_stack) if kind == "undo" else (self.redo_stack, self.undo_stack)
+                if entry is None or not source or source[-1] is not entry:
+                    continue
+                target.append(source.pop())
+                self.unsaved.extend(self._steps(entry, undo=kind == "undo"))
+        del self.undo_stack[:-self.UNDO_LIMIT]
+        return bool(lines) and not lines[-1].endswith("\n")
+
+    @staticmethod
+    def _steps(entry, undo=False):
+        """Return an entry's changes as ``(image_name, before, after)`` in the order to apply them."""
+        if undo:
+            return [(image_name, new_tags, old_tags) for image_name, old_tags, new_tags in reversed(entry["changes"])]
+        return [tuple(change) for change in entry["changes"]]
+
+    def _append(self, record):
+        with self.condition:
+            self.file.write(json.dumps(record, separators=(",", ":")) + "\n")
+            self.file.flush()  # In the OS now, so it survives the process dying
+            self.dirty = True
+            self.condition.notify_all()
+
+    def _sync(self):
+        """Group fsyncs: everything appended within FSYNC_INTERVAL shares one."""
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.dirty or self.closed)
+                if self.closed:
+                    return
+            time.sleep(self.FSYNC_INTERVAL)
+            with self.condition:
+                if self.closed:
+                    return
+                self.dirty = False
+                try:
+                    with INSTRUMENTS.timer("journal.fsync"):
+                        os.fsync(self.file.fileno())
+                except OSError as e:
+                    log.error("Error syncing journal %s: %s", self.path, e)
+
+    def record(self, label, changes):
+        """Log an edit of ``[(image_name, old_tags, new_tags)]`` and make it the one to undo next."""
+        changes = [[image_name, list(old_tags), list(new_tags)] for image_name, old_tags, new_tags in changes]
+        if not changes:
+            return None
+        entry = {"id": self.next_id, "label": label, "changes": changes}
+        self.next_id += 1
+        self._append({"type": "edit", **entry})
+        self.undo_stack.append(entry)
+        del self.undo_stack[:-self.UNDO_LIMIT]
+        self.redo_stack = []
+        self.unsaved.extend(self._steps(entry))
+        INSTRUMENTS.count("journal.edits")
+        return entry
+
+    def can_undo(self):
+        return bool(self.undo_stack)
+
+    def can_redo(self):
+        return bool(self.redo_stack)
+
+    def undo(self):
+        """Log undoing the latest edit; return ``(label, [(image_name, before, after)])`` to apply, or None."""
+        if not self.undo_stack:
+            return None
+        entry = self.undo_stack.pop()
+        self.redo_stack.append(entry)
+        self._append({"type": "undo", "id": entry["id"]})
+        steps = self._steps(entry, undo=True)
+        self.unsaved.extend(steps)
+        return entry["label"], steps
+
+    def redo(self):
+        """Log redoing the latest undone edit; return ``(label, steps)`` like ``undo``, or None."""
+        if not self.redo_stack:
+            return None
+        entry = self.redo_stack.pop()
+        self.undo_stack.append(entry)
+        self._append({"type": "redo", "id": entry["id"]})
+        steps = self._steps(entry)
+        self.unsaved.extend(steps)
+        return entry["label"], steps
+
+    def replay_plan(self, dataset):
+        """Return ``(plan, skipped)`` for the unsaved steps after a crash.
+
+        ``plan`` is ``[(image_name, tags)]`` for captions still holding the
+        tags they had before the first unsaved step; ``skipped`` lists images
+        that were changed by another program since, or no longer exist.
+        """
+        first = {}
+        final = {}
+        for image_name, before, after in self.unsaved:
+            first.setdefault(image_name, list(before))
+            final[image_name] = list(after)
+
+        plan = []
+        skipped = []
+        for image_name, tags in final.items():
+            if image_name not in dataset.image_tags:
+                skipped.append(image_name)
+                continue
+            current = dataset.tags_of(image_name)
+            if current == tags:
+                continue  # The caption was written before the crash
+            if current == first[image_name]:
+                plan.append((image_name, tags))
+            else:
+                skipped.append(image_name)
+        return plan, skipped
+
+    def checkpoint(self):
+        """Mark every logged edit as written to the caption files, compacting the journal if it has grown."""
+        if self.file.tell() < max(self.COMPACT_MIN_BYTES, 2 * self.compacted_size):
+            self._append({"type": "checkpoint"})
+            self.unsaved = []
+            return True
+        return self.compact()
+
+    def compact(self):
+        """Rewrite the journal as just the undo history and a checkpoint."""
+        with self.condition:
+            temp_path = f"{self.path}.{os.getpid()}.tmp"
+            try:
+                with open(temp_path, "w", encoding="utf-8") as f:
+                    # Undone edits are logged as edit + undo so redo still works after a restart
+                    for entry in self.undo_stack + self.redo_stack[::-1]:
+                        f.write(json.dumps({"type": "edit", **entry}, separators=(",", ":")) + "\n")
+                    for entry in self.redo_stack:
+                        f.write(json.dumps({"type": "undo", "id": entry["id"]}, separators=(",", ":")) + "\n")
+                    f.write(json.dumps({"type": "checkpoint"}) + "\n")
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(temp_path, self.path)
+            except OSError as e:
+                remove_quietly(temp_path)
+                log.error("Error compacting journal %s: %s", self.path, e)
+                return False
+            self.file.close()
+            self.file = open(self.path, "a", encoding="utf-8")
+            self.compacted_size = self.file.tell()
+            self.dirty = False
+            self.unsaved = []
+            INSTRUMENTS.count("journal.compactions")
+            return True
+
+    def close(self):
+        """Fsync what is left and stop the sync thread."""
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        self.thread.join()
+        try:
+            os.fsync(self.file.fileno())
+        except OSError as e:
+            log.error("Error syncing journal %s: %s", self.path, e)
+        self.file.close()
+
+
+def split_roots(directories):
+    """Return ``(directory, roots)`` for loading several folders as one dataset.
+
+    ``directory`` is the folders' deepest common parent and ``roots`` are the
+    folders relative to it ("" for the parent itself), so every image keeps a
+    unique name relative to one directory.
+
+    The dataset's ``.elcaption`` folder goes in that parent, so raises
+    ValueError if the folders only share a filesystem root or a drive.
+    """
+    directories = [os.path.abspath(directory) for directory in directories]
+    if len(directories) == 1:
+        return directories[0], ("",)
+    try:
+        directory = os.path.commonpath(directories)
+    except ValueError:
+        raise ValueError("The folders are on different drives, so they can't be loaded as one dataset.") from None
+    if os.path.dirname(directory) == directory:
+        raise ValueError(
+            f"The folders have no common parent folder other than {directory}. "
+            "Move them under one folder to load them as one dataset."
+        )
+    roots = sorted({os.path.relpath(folder, directory).replace(os.sep, "/") for folder in directories})
+    return directory, tuple("" if root == "." else root for root in roots)
+
+
+def relative_name(directory, path):
+    """Return the dataset name of a file: its path relative to ``directory``, with "/" separators."""
+    return os.path.relpath(path, directory).replace(os.sep, "/")
+
+
+def list_dataset_files(directory, roots=("",), recursive=False, max_workers=8):
+    """Return {name: os.DirEntry} for the .png and .txt files in ``roots`` of ``directory``.
+
+    Names are paths relative to ``directory`` with "/" separators, which is
+    how images are identified everywhere else. With ``recursive`` every
+    subfolder is a shard listed as its own job on a thread pool, so the
+    shards of a large dataset are listed concurrently. Hidden folders, like
+    the cache, are skipped.
+    """
+    files = {}
+
+    def list_folder(folder):
+        prefix = folder + "/" if folder else ""
+        subfolders = []
+        with os.scandir(os.path.join(directory, folder)) as entries:
+            for entry in entries:
+                if entry.name.endswith((".png", ".txt")):
+                    files[prefix + entry.name] = entry
+                elif recursive and not entry.name.startswith(".") and entry.is_dir(follow_symlinks=False):
+                    subfolders.append(prefix + entry.name)
+        return subfolders
+
+    if not recursive and len(roots) == 1:
+        list_folder(roots[0])
+        return files
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = {executor.submit(list_folder, root) for root in roots}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                pending.update(executor.submit(list_folder, folder) for folder in future.result())
+    return files
+
+
+class DirectoryScanner:
+    """Lists a dataset directory once and reads its captions with a thread pool.
+
+    ``batches()`` yields ``(batch, loaded, total)`` where each batch is a
+    list of ``(image_name, tags, caption_stat)`` in natural order, so callers
+    can start using a large dataset before all of it is read. Captions whose
+    mtime and size match ``known`` (by default the saved manifest) are reused
+    instead of re-read.
+
+    ``roots`` and ``recursive`` select the folders scanned, see
+    ``list_dataset_files``; image names are relative to ``directory``.
+    """
+
+    BATCH_SIZE = 500
+
+    def __init__(self, directory, known=None, sort_key=natural_sort_key, max_workers=8, roots=("",), recursive=False):
+        self.directory = directory
+        self.roots = roots
+        self.recursive = recursive
+        self.known = known  # image_name -> (caption stat or None, tags); None loads the manifest
+        self.sort_key = sort_key
+        self.max_workers = max_workers
+        self.reread = 0  # Caption files actually parsed
+        self.cancelled = threading.Event()
+
+    def cancel(self):
+        """Stop after the batch in progress."""
+        self.cancelled.set()
+
+    def batches(self):
+        known = self.known if self.known is not None else load_manifest(self.directory)
+
+        # One pass over the folders; DirEntry names tell us which sidecars exist
+        with INSTRUMENTS.timer("load.list_directory"):
+            captions = list_dataset_files(self.directory, self.roots, self.recursive, self.max_workers)
+            images = [name for name in captions if name.endswith(".png")]
+
+            # Sort images in natural order, which also keeps each subfolder together
+            images.sort(key=self.sort_key)
+        total = len(images)
+
+        def read(image_name):
+            entry = captions.get(os.path.splitext(image_name)[0] + ".txt")
+            if entry is None:
+                return image_name, [], None, False
+
+            # Reuse the known tags if the caption hasn't changed since
+            stat = entry.stat()
+            caption_stat = (stat.st_mtime_ns, stat.st_size)
+            previous = known.get(image_name)
+            if previous is not None and previous[0] == caption_stat:
+                return image_name, list(previous[1]), caption_stat, False
+
+            return image_name, read_caption_file(entry.path), caption_stat, True
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            for start in range(0, total, self.BATCH_SIZE):
+                if self.cancelled.is_set():
+                    break
+                batch = []
+                reread_before = self.reread
+                with INSTRUMENTS.timer("load.read_batch"):
+                    for image_name, tags, caption_stat, reread in executor.map(read, images[start:start + self.BATCH_SIZE]):
+                        batch.append((image_name, tags, caption_stat))
+                        self.reread += reread
+                INSTRUMENTS.count("load.captions_parsed", self.reread - reread_before)
+                INSTRUMENTS.count("load.images", len(batch))
+                yield batch, start + len(batch), total
+
+
+
+class PollingWatchBackend:
+    """Watch backend that lists a dataset's folders with ``os.scandir`` and compares mtimes and sizes."""
+
+    def __init__(self, directory, roots=("",), recursive=False):
+        self.directory = directory
+        self.roots = roots
+        self.recursive = recursive
+
+    def snapshot(self):
+        """Return {file name: (mtime_ns, size)} for the dataset's images and captions."""
+        files = {}
+        for name, entry in list_dataset_files(self.directory, self.roots, self.recursive).items():
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue  # Deleted mid-sweep
+            files[name] = (stat.st_mtime_ns, stat.st_size)
+        return files
+
+    def read_caption(self, name):
+        return read_caption_file(os.path.join(self.directory, name))
+
+
+def merge_tags(tags, sources, target):
+    """Return ``tags`` with each of ``sources`` replaced by ``target`` in place, keeping only its first occurrence."""
+    result = []
+    for tag in tags:
+        if tag in sources:
+            tag = target
+        if tag != target or target not in result:
+            result.append(tag)
+    return result
+
+
+class BatchEdit:
+    """Tag operations staged for many images and applied to each caption in one pass.
+
+    Operations run in the order they were staged:
+
+    * ``("add", tag)`` appends a tag the caption doesn't have yet,
+    * ``("remove", tag)`` drops every occurrence of a tag,
+    * ``("rename", old, new)`` and ``("merge", sources, target)`` replace tags
+      where they stand, keeping the first copy of the target,
+    * ``("reorder", tags)`` moves the listed tags to the front, in that order.
+    """
+
+    def __init__(self, operations=()):
+        self.operations = list(operations)
+
+    def add(self, tag):
+        self.operations.append(("add", tag))
+
+    def remove(self, tag):
+        self.operations.append(("remove", tag))
+
+    def rename(self, old_tag, new_tag):
+        self.operations.append(("rename", old_tag, new_tag))
+
+    def merge(self, sources, target):
+        self.operations.append(("merge", tuple(sources), target))
+
+    def reorder(self, tags):
+        self.operations.append(("reorder", tuple(tags)))
+
+    @staticmethod
+    def describe(operation):
+        """Return a one-line description of an operation."""
+        kind = operation[0]
+        if kind == "add":
+            return f"Add '{operation[1]}'"
+        if kind == "remove":
+            return f"Remove '{operation[1]}'"
+        if kind == "rename":
+            return f"Rename '{operation[1]}' to '{operation[2]}'"
+        if kind == "merge":
+            return f"Merge {', '.join(repr(tag) for tag in operation[1])} into '{operation[2]}'"
+        return f"Move {', '.join(repr(tag) for tag in operation[1])} to the front"
+
+    def _candidate_tags(self):
+        """Tags an image must carry for the edit to change it, or None if any image may change."""
+        tags = set()
+        for operation in self.operations:
+            kind = operation[0]
+            if kind == "add":
+                return None
+            if kind in ("remove", "rename"):
+                tags.add(operation[1])
+            else:
+                tags.update(operation[1])
+        return tags
+
+    def apply(self, tags):
+        """Return a new tag list with every operation applied to ``tags``."""
+        tags = list(tags)
+        for operation in self.operations:
+            kind = operation[0]
+            if kind == "add":
+                if operation[1] not in tags:
+                    tags.append(operation[1])
+            elif kind == "remove":
+                tags = [tag for tag in tags if tag != operation[1]]
+            elif kind == "reorder":
+                front = [tag for tag in operation[1] if tag in tags]
+                tags = front + [tag for tag in tags if tag not in front]
+            else:
+                sources = {operation[1]} if kind == "rename" else set(operation[1])
+                if not sources.isdisjoint(tags):
+                    tags = merge_tags(tags, sources, operation[2])
+        return tags
+
+    def plan(self, dataset, image_names):
+        """Return ``[(image_name, new_tags)]`` for the images in ``image_names`` whose caption would change."""
+        candidates = dataset.ids_of(image_names)
+        candidate_tags = self._candidate_tags()
+        if candidate_tags is not None:
+            carriers = set().union(*(dataset.tag_index.images_with(tag) for tag in candidate_tags))
+            candidates &= carriers
+
+        plan = []
+        for image_name in dataset._in_order(candidates):
+            old_tags = dataset.image_tags[image_name]
+            new_tags = self.apply(old_tags)
+            if new_tags != old_tags:
+                plan.append((image_name, new_tags))
+        return plan
+
+
+class Dataset:
+    """A dataset's images in natural order, their tags and the index over them.
+
+    Every image gets a stable integer id when it is added (``image_ids`` and
+    ``image_names`` map between the two) and its caption is stored as an
+    ``array('I')`` of ids from the shared tag ``vocabulary``. ``image_tags``
+    is a read-only view that decodes them back to strings.
+
+    Mutations keep the tag storage and ``tag_index`` in step and return the
+    images they touched, so the caller decides how to save them and what to
+    refresh.
+    """
+
+    FILTER_CACHE_SIZE = 16  # Recent filter results kept for quick toggling
+
+    def __init__(self, directory="", roots=("",), recursive=False):
+        self.directory = directory
+        self.roots = roots  # Folders loaded, relative to directory; see list_dataset_files
+        self.recursive = recursive
+        self.images = []
+        self.image_positions = {}  # image name -> index in self.images
+        self.image_ids = {}  # image name -> image id
+        self.image_names = []  # image id -> image name, None once removed
+        self.image_tag_ids = []  # image id -> array('I') of tag ids in caption order, None once removed
+        self.vocabulary = TagVocabulary()
+        self.image_tags = ImageTagsView(self)
+        self.cooccurrence = TagCooccurrence(self._count_cooccurring)
+        self.caption_stats = {}  # image name -> (mtime_ns, size) of the caption as read, or None
+        self.tag_index = TagIndex()
+        self.filter_cache = OrderedDict()  # query -> (tag index version, matching images)
+
+    def caption_path(self, image_name):
+        """Return the path of an image's caption file."""
+        return os.path.join(self.directory, os.path.splitext(image_name)[0] + ".txt")
+
+    def tags_of(self, image_name):
+        """Return a new list of an image's tags in caption order."""
+        return self.vocabulary.decode(self.image_tag_ids[self.image_ids[image_name]])
+
+    def ids_of(self, image_names):
+        """Return the set of ids of ``image_names``, skipping names not in the dataset."""
+        image_ids = self.image_ids
+        return {image_ids[image_name] for image_name in image_names if image_name in image_ids}
+
+    def _new_image(self, image_name, tags):
+        image_id = len(self.image_names)
+        self.image_ids[image_name] = image_id
+        self.image_names.append(image_name)
+        self.image_tag_ids.append(self.vocabulary.encode(tags))
+        self.tag_index.add_image(image_id, tags)
+        self.cooccurrence.add_image(self.image_tag_ids[image_id])
+
+    def load(self, known=None, max_workers=8):
+        """Scan the directory and read every caption; return how many captions were parsed."""
+        scanner = DirectoryScanner(
+            self.directory, known=known, max_workers=max_workers, roots=self.roots, recursive=self.recursive
+        )
+        for batch, _, _ in scanner.batches():
+            self.add_images(batch)
+        return scanner.reread
+
+    def add_images(self, batch):
+        """Append a batch of ``(image_name, tags, caption_stat)`` from a DirectoryScanner."""
+        for image_name, tags, caption_stat in batch:
+            self.image_positions[image_name] = len(self.images)
+            self.images.append(image_name)
+            self.caption_stats[image_name] = caption_stat
+            self._new_image(image_name, tags)
+
+    def merge_scan(self, entries):
+        """Bring the dataset in line with a complete rescan of its directory.
+
+        Returns ``(added, changed, removed, touched_tags)``: lists of image
+        names, and the old tags of changed and removed images, which may no
+        longer be on any image.
+        """
+        seen = set()
+        touched_tags = set()
+        added = []
+        changed = []
+
+        for image_name, tags, caption_stat in entries:
+            seen.add(image_name)
+            if image_name not in self.image_ids:
+                added.append(image_name)
+                self._new_image(image_name, tags)
+            elif caption_stat != self.caption_stats[image_name]:
+                changed.append(image_name)
+                touched_tags.update(self.replace_tags(image_name, tags))
+            else:
+                continue
+            self.caption_stats[image_name] = caption_stat
+
+        removed = [image_name for image_name in self.images if image_name not in seen]
+        for image_name in removed:
+            image_id = self.image_ids.pop(image_name)
+            old_tags = self.vocabulary.decode(self.image_tag_ids[image_id])
+            touched_tags.update(old_tags)
+            self.tag_index.remove_image(image_id, old_tags)
+            self.cooccurrence.remove_image(self.image_tag_ids[image_id])
+            self.image_names[image_id] = None
+            self.image_tag_ids[image_id] = None
+            del self.caption_stats[image_name]
+
+        if added or removed:
+            # The scanner already returns images in natural order
+            self.images = [image_name for image_name, _, _ in entries]
+            self.image_positions = {image_name: index for index, image_name in enumerate(self.images)}
+        return added, changed, removed, touched_tags
+
+    def absorb_written_stats(self, saver):
+        """Take the stats of ``saver``'s finished writes into ``caption_stats``.
+
+        Call it regularly, so the saver doesn't keep a stat for every file it
+        ever wrote.
+        """
+        for tag_path, caption_stat in saver.take_written_stats().items():
+            try:
+                image_name = os.path.splitext(relative_name(self.directory, tag_path))[0] + ".png"
+            except ValueError:
+                continue  # Another drive, so not from this dataset
+            if image_name in self.image_ids and self.caption_path(image_name) == tag_path:
+                self.caption_stats[image_name] = caption_stat
+
+    def manifest_entries(self, saver=None):
+        """Return manifest entries for every image whose caption on disk matches memory."""
+        if saver is not None:
+            self.absorb_written_stats(saver)
+        entries = {}
+        for image_name in self.images:
+            if saver is not None and saver.is_pending(self.caption_path(image_name)):
+                continue  # The file on disk doesn't hold these tags yet, let the next load read it
+            entries[image_name] = (self.caption_stats[image_name], self.tags_of(image_name))
+        return entries
+
+    def filter(self, query):
+        """Return the images matching a filter query, in dataset order."""
+        query = query.strip()
+        filtered_images = self.cached_filter(query)
+        if filtered_images is None:
+            version = self.tag_index.version
+            filtered_images = self.evaluate_filter(query)
+            self.cache_filter(query, version, filtered_images)
+        return filtered_images
+
+    def cached_filter(self, query):
+        """Return the cached result of ``query`` if the tags haven't changed since, else None."""
+        # Recently used queries are answered from the cache until the tags change
+        cached = self.filter_cache.get(query)
+        if cached is not None and cached[0] == self.tag_index.version:
+            self.filter_cache.move_to_end(query)
+            INSTRUMENTS.count("filter.cache_hits")
+            return cached[1]
+        return None
+
+    def evaluate_filter(self, query):
+        """Evaluate a filter query, bypassing the cache.
+
+        Only reads the dataset, so it can run on another thread than the one
+        editing it; the caller must compare ``tag_index.version`` from before
+        the call with the one after, since an edit in between can make the
+        result stale or the evaluation fail.
+        """
+        with INSTRUMENTS.timer("filter.evaluate"):
+            return self._in_order(compile_filter_query(query).evaluate(self.tag_index))
+
+    def cache_filter(self, query, version, filtered_images):
+        """Remember the result of ``query`` evaluated at tag index ``version``."""
+        if version != self.tag_index.version:
+            return  # Already stale
+        self.filter_cache[query] = (version, filtered_images)
+        self.filter_cache.move_to_end(query)
+        if len(self.filter_cache) > self.FILTER_CACHE_SIZE:
+            self.filter_cache.popitem(last=False)
+
+    def images_with(self, tag):
+        """Return the images carrying ``tag``, in dataset order."""
+        return self._in_order(self.tag_index.images_with(tag))
+
+    def _in_order(self, image_ids):
+        """Return the names of ``image_ids`` in dataset order."""
+        image_names = self.image_names
+        return sorted((image_names[image_id] for image_id in image_ids), key=self.image_positions.__getitem__)
+
+    def replace_tags(self, image_name, tags):
+        """Swap in a new tag list for one image and return the old one."""
+        image_id = self.image_ids[image_name]
+        old_tags = self.vocabulary.decode(self.image_tag_ids[image_id])
+        self.tag_index.remove_image(image_id, old_tags)
+        self.cooccurrence.remove_image(self.image_tag_ids[image_id])
+        self.image_tag_ids[image_id] = self.vocabulary.encode(tags)
+        self.tag_index.add_image(image_id, tags)
+        self.cooccurrence.add_image(self.image_tag_ids[image_id])
+        return old_tags
+
+    def commit_batch(self, plan, expected_stat=None, max_workers=8):
+        """Write a BatchEdit plan to disk, each caption once, then apply it in memory.
+
+        ``expected_stat(image_name)`` gives the caption stat to check for edits
+        made by other programs (by default the stat as loaded). Raises
+        BatchEditError, leaving the files and the dataset untouched, if any
+        caption can't be written. Returns ``[(image_name, old_tags)]``.
+        """
+        changes = self.batch_changes(plan, expected_stat)
+        with INSTRUMENTS.timer("batch_edit.commit"):
+            new_stats = commit_caption_files(changes, max_workers=max_workers)
+        return self.apply_batch(plan, new_stats)
+
+    def batch_changes(self, plan, expected_stat=None):
+        """Return the ``commit_caption_files`` changes writing a BatchEdit plan, see ``commit_batch``.
+
+        Writing them only reads this list, so it can happen on another thread.
+        """
+        expected_stat = expected_stat or self.caption_stats.__getitem__
+        return [
+            (self.caption_path(image_name), new_tags, self.tags_of(image_name), expected_stat(image_name))
+            for image_name, new_tags in plan
+        ]
+
+    def apply_batch(self, plan, new_stats):
+        """Apply a plan written by ``commit_caption_files`` in memory; return ``[(image_name, old_tags)]``."""
+        changed = []
+        for image_name, new_tags in plan:
+            changed.append((image_name, self.replace_tags(image_name, new_tags)))
+            self.caption_stats[image_name] = new_stats[self.caption_path(image_name)]
+        return changed
+
+    def add_tag(self, image_name, tag):
+        """Append ``tag`` to an image's caption; return False if it already had it."""
+        image_id = self.image_ids[image_name]
+        tag_ids = self.image_tag_ids[image_id]
+        tag_id = self.vocabulary.intern(tag)
+        if tag_id in tag_ids:
+            return False
+        self.cooccurrence.add_tag(tag_id, set(tag_ids))
+        tag_ids.append(tag_id)
+        self.tag_index.add(image_id, tag)
+        return True
+
+    def remove_tag(self, image_name, tag):
+        """Remove the first occurrence of ``tag`` from an image; return False if it didn't have it."""
+        image_id = self.image_ids[image_name]
+        tag_ids = self.image_tag_ids[image_id]
+        tag_id = self.vocabulary.id_of(tag)
+        if tag_id is None or tag_id not in tag_ids:
+            return False
+        tag_ids.remove(tag_id)
+        if tag_id not in tag_ids:
+            self.tag_index.discard(image_id, tag)
+            self.cooccurrence.remove_tag(tag_id, set(tag_ids))
+        return True
+
+    def add_tag_to(self, tag, image_names):
+        """Add ``tag`` to each of ``image_names``; return the images that changed, in order."""
+        return [image_name for image_name in self._in_order(self.ids_of(image_names)) if self.add_tag(image_name, tag)]
+
+    def delete_tag(self, tag, scope=None):
+        """Remove ``tag`` from every image, or only those in the set ``scope``; return the images that changed."""
+        carriers = self.tag_index.images_with(tag)
+        touched = self._in_order(carriers if scope is None else carriers & self.ids_of(scope))
+        for image_name in touched:
+            self.remove_tag(image_name, tag)
+        return touched
+
+    def rename_tag(self, old_tag, new_tag, scope=None):
+        """Rename ``old_tag`` on every image (or those in ``scope``), merging into ``new_tag`` where both exist.
+
+        The new tag takes the old one's place in each caption. Returns the
+        images that changed, in order.
+        """
+        if old_tag == new_tag:
+            return []
+        carriers = self.tag_index.images_with(old_tag)
+        touched = self._in_order(carriers if scope is None else carriers & self.ids_of(scope))
+        for image_name in touched:
+            self.replace_tags(image_name, merge_tags(self.tags_of(image_name), {old_tag}, new_tag))
+        return touched
+
+    def tag_count(self, tag):
+        """Return the number of images carrying ``tag``."""
+        return self.tag_index.count(tag)
+
+    def _count_cooccurring(self, tag_id):
+        image_tag_ids = self.image_tag_ids
+        carriers = self.tag_index.images_with(self.vocabulary.tags[tag_id])
+        # set() so a tag repeated within one caption counts once
+        return Counter(itertools.chain.from_iterable(set(image_tag_ids[image_id]) for image_id in carriers))
+
+    def cooccurring(self, tag, limit=None):
+        """Return ``[(other tag, images carrying both)]`` for the tags seen with ``tag``, most frequent first."""
+        tag_id = self.vocabulary.id_of(tag)
+        if tag_id is None or not self.tag_index.count(tag):
+            return []
+        tags = self.vocabulary.tags
+        pairs = [(tags[other], count) for other, count in self.cooccurrence.row(tag_id).items() if other != tag_id]
+        pairs.sort(key=lambda item: (-item[1], natural_sort_key(item[0])))
+        return pairs[:limit]
+
+    def tag_counts(self):
+        """Return {tag: number of images carrying it}."""
+        return {tag: len(images) for tag, images in self.tag_index.images_by_tag.items()}
+
+    def stats(self, top=20):
+        """Summarise the dataset as a JSON-friendly dict."""
+        counts = self.tag_counts()
+        occurrences = sum(len(tag_ids) for tag_ids in self.image_tag_ids if tag_ids is not None)
+        return {
+            "images": len(self.images),
+            "captioned": sum(1 for caption_stat in self.caption_stats.values() if caption_stat is not None),
+            "tags": len(counts),
+            "tag_occurrences": occurrences,
+            "mean_tags_per_image": occurrences / len(self.images) if self.images else 0.0,
+            "top_tags": sorted(counts.items(), key=lambda item: (-item[1], natural_sort_key(item[0])))[:top],
+        }
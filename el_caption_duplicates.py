@@ -0,0 +1,286 @@
+"""Perceptual-hash duplicate detection for El Caption datasets.
+
+Every image is reduced to a 64-bit dHash or pHash in a process pool. Hashes
+are cached in ``.elcaption/hashes.json`` against the image's mtime and size,
+so a rerun only hashes new or changed images. Near-duplicates are found by
+looking hashes up on exact bit ranges instead of comparing every pair::
+
+    finder = DuplicateFinder("./dataset", method="dhash", max_distance=4)
+    for group in finder.find(image_names):
+        print(group)
+"""
+
+import os
+import json
+import math
+import logging
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image
+
+from el_caption_core import CACHE_DIR_NAME, INSTRUMENTS
+
+log = logging.getLogger("el_caption")
+
+HASH_CACHE_VERSION = 1
+NOT_CACHED = object()  # HashCache.get() miss; None is a cached "couldn't decode"
+HASH_SIZE = 8  # Hashes are HASH_SIZE x HASH_SIZE bits
+MAX_DISTANCE = 5  # Beyond this HashIndex degrades towards comparing every pair
+PHASH_SIZE = 32  # pHash takes the low frequencies of a DCT over an image this size
+
+# DCT-II basis for the HASH_SIZE lowest frequencies, one row per frequency
+_DCT = [
+    [math.cos(math.pi * (2 * x + 1) * u / (2 * PHASH_SIZE)) for x in range(PHASH_SIZE)]
+    for u in range(HASH_SIZE)
+]
+
+
+def _bits(flags):
+    value = 0
+    for flag in flags:
+        value = (value << 1) | flag
+    return value
+
+
+def dhash(img):
+    """Difference hash: whether each pixel is brighter than its right neighbour, on a 9x8 grayscale."""
+    width = HASH_SIZE + 1
+    pixels = img.convert("L").resize((width, HASH_SIZE), Image.Resampling.LANCZOS).tobytes()
+    return _bits(
+        pixels[row + col] > pixels[row + col + 1]
+        for row in range(0, width * HASH_SIZE, width)
+        for col in range(HASH_SIZE)
+    )
+
+
+def phash(img):
+    """Perceptual hash: which low DCT frequencies of a 32x32 grayscale are above their median.
+
+    Only the 8x8 low-frequency corner of the DCT is computed, one separable
+    pass over the rows and one over the columns.
+    """
+    pixels = img.convert("L").resize((PHASH_SIZE, PHASH_SIZE), Image.Resampling.LANCZOS).tobytes()
+    rows = [pixels[start:start + PHASH_SIZE] for start in range(0, PHASH_SIZE * PHASH_SIZE, PHASH_SIZE)]
+    by_row = [[sum(c * p for c, p in zip(basis, row)) for basis in _DCT] for row in rows]
+    coefficients = [
+        sum(c * by_row[y][u] for y, c in enumerate(basis))
+        for basis in _DCT
+        for u in range(HASH_SIZE)
+    ]
+    median = sorted(coefficients)[len(coefficients) // 2]
+    return _bits(c > median for c in coefficients)
+
+
+HASHERS = {"dhash": dhash, "phash": phash}
+
+
+def hash_image(image_path, method):
+    """Worker job: return the ``method`` hash of an image, or None if it can't be decoded."""
+    try:
+        with Image.open(image_path) as img:
+            img.draft("L", (PHASH_SIZE * 2, PHASH_SIZE * 2))  # JPEG decodes at reduced scale
+            return HASHERS[method](img)
+    except (OSError, ValueError) as e:
+        log.warning("Error hashing %s: %s", image_path, e)
+        return None
+
+
+def hamming(a, b):
+    return bin(a ^ b).count("1")
+
+
+class HashIndex:
+    """Finds the hashes within a Hamming distance of a query without comparing against every hash.
+
+    The bits are split into ``max_distance + 1`` ranges. Two hashes that
+    differ in at most ``max_distance`` bits must agree exactly on at least
+    one range (pigeonhole), so hashes are filed under the value of each range
+    and a search only checks those filed under the query's values. The ranges
+    shrink as the distance grows, so large distances get slow quickly.
+    """
+
+    def __init__(self, max_distance, bits=HASH_SIZE * HASH_SIZE):
+        parts = max_distance + 1
+        bounds = [bits * i // parts for i in range(parts + 1)]
+        self.max_distance = max_distance
+        self.ranges = [(low, (1 << (high - low)) - 1) for low, high in zip(bounds, bounds[1:])]  # (shift, mask)
+        self.tables = [{} for _ in self.ranges]
+
+    def add(self, value):
+        for (shift, mask), table in zip(self.ranges, self.tables):
+            table.setdefault((value >> shift) & mask, []).append(value)
+
+    def search(self, value):
+        """Return [(distance, hash)] for the added hashes within ``max_distance`` of ``value``."""
+        candidates = set()
+        for (shift, mask), table in zip(self.ranges, self.tables):
+            candidates.update(table.get((value >> shift) & mask, ()))
+        found = []
+        for other in candidates:
+            distance = hamming(value, other)
+            if distance <= self.max_distance:
+                found.append((distance, other))
+        return found
+
+
+def group_duplicates(hashes, max_distance, sort_key=None):
+    """Return groups (lists of 2+ image names) whose hashes are within ``max_distance`` of each other.
+
+    Images with identical hashes are grouped directly; only the distinct
+    hashes are searched, each against those before it. Groups are transitive: if a is near b and b
+    near c, all three share a group even if a and c are further apart.
+    """
+    by_hash = {}
+    for image_name, value in hashes.items():
+        by_hash.setdefault(value, []).append(image_name)
+
+    # Union-find over distinct hashes
+    parent = {value: value for value in by_hash}
+
+    def find(value):
+        while parent[value] != value:
+            parent[value] = parent[parent[value]]
+            value = parent[value]
+        return value
+
+    if max_distance > 0:
+        index = HashIndex(max_distance)
+        for value in by_hash:
+            for _, other in index.search(value):
+                root, other_root = find(value), find(other)
+                if root != other_root:
+                    parent[other_root] = root
+            index.add(value)
+
+    groups = {}
+    for value, image_names in by_hash.items():
+        groups.setdefault(find(value), []).extend(image_names)
+    groups = [sorted(names, key=sort_key) for names in groups.values() if len(names) > 1]
+    groups.sort(key=lambda names: sort_key(names[0]) if sort_key else names[0])
+    return groups
+
+
+def hash_cache_path(directory):
+    return os.path.join(directory, CACHE_DIR_NAME, "hashes.json")
+
+
+class HashCache:
+    """Image hashes saved next to the dataset, keyed by method and valid while the image's mtime and size match."""
+
+    def __init__(self, directory):
+        self.path = hash_cache_path(directory)
+        self.entries = {}  # method -> {image_name: [mtime_ns, size, hash]}
+        self.dirty = False
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            if data.get("version") == HASH_CACHE_VERSION:
+                self.entries = data["entries"]
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            if not isinstance(e, FileNotFoundError):
+                log.warning("Ignoring unreadable hash cache %s: %s", self.path, e)
+
+    def get(self, method, image_name, stat):
+        """Return the cached hash, None if the image couldn't be decoded, or NOT_CACHED."""
+        entry = self.entries.get(method, {}).get(image_name)
+        if entry is not None and entry[0] == stat.st_mtime_ns and entry[1] == stat.st_size:
+            return entry[2]
+        return NOT_CACHED
+
+    def put(self, method, image_name, stat, value):
+        self.entries.setdefault(method, {})[image_name] = [stat.st_mtime_ns, stat.st_size, value]
+        self.dirty = True
+
+    def prune(self, method, image_names):
+        """Forget hashes of images no longer in the dataset."""
+        entries = self.entries.get(method, {})
+        for image_name in entries.keys() - set(image_names):
+            del entries[image_name]
+            self.dirty = True
+
+    def save(self):
+        """Atomically write the cache if it changed."""
+        if not self.dirty:
+            return
+        temp_path = f"{self.path}.{os.getpid()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(temp_path, "w", encoding="utf-8") as f:
+                json.dump({"version": HASH_CACHE_VERSION, "entries": self.entries}, f, separators=(",", ":"))
+            os.replace(temp_path, self.path)
+            self.dirty = False
+        except OSError as e:
+            log.error("Error saving hash cache %s: %s", self.path, e)
+
+
+class DuplicateFinder:
+    """Hashes a dataset's images (reusing cached hashes) and groups the near-identical ones."""
+
+    CHUNK_SIZE = 32  # Images per worker round trip
+
+    def __init__(self, directory, method="dhash", max_distance=4, max_workers=None):
+        if method not in HASHERS:
+            raise ValueError(f"Unknown hash method: {method}")
+        self.directory = directory
+        self.method = method
+        self.max_distance = max_distance
+        self.max_workers = max_workers or max(1, (os.cpu_count() or 2) - 1)
+        self.cancelled = threading.Event()
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def hashes(self, image_names, progress=None):
+        """Return {image_name: hash} for the images that could be decoded.
+
+        ``progress(done, total)`` is called as hashes arrive, from this thread.
+        """
+        cache = HashCache(self.directory)
+        found = {}
+        missing = []
+        for image_name in image_names:
+            try:
+                stat = os.stat(os.path.join(self.directory, image_name))
+            except OSError:
+                continue
+            value = cache.get(self.method, image_name, stat)
+            if value is NOT_CACHED:
+                missing.append((image_name, stat))
+            elif value is not None:
+                found[image_name] = value
+        total = len(image_names)
+        INSTRUMENTS.count("duplicates.cache_hits", total - len(missing))
+        INSTRUMENTS.count("duplicates.hashed", len(missing))
+
+        if progress is not None:
+            progress(total - len(missing), total)
+        if missing:
+            # Spawn rather than fork, the parent holds a display connection and threads
+            executor = ProcessPoolExecutor(max_workers=self.max_workers, mp_context=multiprocessing.get_context("spawn"))
+            try:
+                paths = (os.path.join(self.directory, image_name) for image_name, _ in missing)
+                results = executor.map(hash_image, paths, [self.method] * len(missing), chunksize=self.CHUNK_SIZE)
+                for done, ((image_name, stat), value) in enumerate(zip(missing, results), 1):
+                    if self.cancelled.is_set():
+                        break
+                    if value is not None:
+                        found[image_name] = value
+                    cache.put(self.method, image_name, stat, value)
+                    if progress is not None and done % self.CHUNK_SIZE == 0:
+                        progress(total - len(missing) + done, total)
+            finally:
+                executor.shutdown(wait=not self.cancelled.is_set(), cancel_futures=True)
+
+        cache.prune(self.method, image_names)
+        cache.save()  # Even after a cancel, so the next run picks up where this one stopped
+        return found
+
+    def find(self, image_names, sort_key=None, progress=None):
+        """Return the groups of duplicate images among ``image_names``, or None if cancelled."""
+        hashes = self.hashes(image_names, progress)
+        if self.cancelled.is_set():
+            return None
+        with INSTRUMENTS.timer("duplicates.group"):
+            return group_duplicates(hashes, self.max_distance, sort_key)
@@ -0,0 +1,226 @@
+"""Streaming export of El Caption datasets for training.
+
+Captions are written to a JSONL or CSV manifest one image at a time, and
+the images can be packed with their captions into webdataset-style tar
+shards (``shard-000000.tar`` holding ``<key>.png`` and ``<key>.txt``)::
+
+    exporter = Exporter("./export", manifest="jsonl", shards=True, shuffle_tags=True, keep_tokens=1)
+    exporter.export(dataset.directory, dataset.tags_of, dataset.filter("orange hair"))
+
+Shards are filled in order and written by a pool of threads. Only the
+captions of the shards being written are held in memory, so exports of any
+size run in the same memory.
+"""
+
+import os
+import csv
+import json
+import time
+import random
+import logging
+import tarfile
+import threading
+from io import BytesIO
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from el_caption_core import INSTRUMENTS
+
+log = logging.getLogger("el_caption")
+
+EXPORT_FORMATS = ("jsonl", "csv")
+SHARD_SIZE = 1000  # Images per shard
+SHARD_BYTES = 1 << 30  # Shards are closed before they grow past this
+TAR_OVERHEAD = 1024  # Header and padding of one tar member, roughly
+PROGRESS_EVERY = 500  # Images between progress reports while only writing the manifest
+
+
+def export_tags(tags, keep_tokens=0, max_tags=None, rng=None):
+    """Return the tags as exported.
+
+    With ``rng`` the tags after the first ``keep_tokens`` are shuffled, the
+    way trainers' keep_tokens option works; ``max_tags`` then cuts the list.
+    """
+    tags = list(tags)
+    if rng is not None:
+        rest = tags[keep_tokens:]
+        rng.shuffle(rest)
+        tags[keep_tokens:] = rest
+    if max_tags is not None:
+        del tags[max_tags:]
+    return tags
+
+
+def sample_key(image_name):
+    """Return the webdataset key of an image: its name without extension, dots replaced.
+
+    Webdataset groups tar members by the part of the name before the first
+    dot, so dots inside the name would split a sample.
+    """
+    directory, name = os.path.split(os.path.splitext(image_name)[0])
+    return os.path.join(directory, name.replace(".", "_")).replace(os.sep, "/")
+
+
+def write_shard(path, samples, cancelled):
+    """Worker job: write ``samples`` [(image_path, key, caption)] to a tar at ``path``.
+
+    Returns the image paths that couldn't be read. The tar is written under
+    a temporary name and renamed when complete, so a shard either exists
+    whole or not at all.
+    """
+    temp_path = f"{path}.tmp"
+    skipped = []
+    with INSTRUMENTS.timer("export.shard"):
+        with tarfile.open(temp_path, "w") as tar:
+            for image_path, key, caption in samples:
+                if cancelled.is_set():
+                    break
+                try:
+                    tar.add(image_path, arcname=key + os.path.splitext(image_path)[1].lower())
+                except OSError as e:
+                    log.warning("Error exporting %s: %s", image_path, e)
+                    skipped.append(image_path)
+                    continue
+                data = caption.encode("utf-8")
+                info = tarfile.TarInfo(key + ".txt")
+                info.size = len(data)
+                info.mtime = int(time.time())
+                tar.addfile(info, BytesIO(data))
+    if cancelled.is_set():
+        os.remove(temp_path)
+    else:
+        os.replace(temp_path, path)
+    return skipped
+
+
+class Exporter:
+    """Writes a manifest of images and captions, and optionally tar shards, to a destination folder."""
+
+    def __init__(self, destination, manifest="jsonl", shards=False, shard_size=SHARD_SIZE, shard_bytes=SHARD_BYTES,
+                 shuffle_tags=False, keep_tokens=0, max_tags=None, seed=None, max_workers=4):
+        if manifest not in EXPORT_FORMATS:
+            raise ValueError(f"Unknown manifest format: {manifest}")
+        self.destination = destination
+        self.manifest = manifest
+        self.shards = shards
+        self.shard_size = max(1, shard_size)
+        self.shard_bytes = shard_bytes
+        self.keep_tokens = keep_tokens
+        self.max_tags = max_tags
+        self.rng = random.Random(seed) if shuffle_tags else None
+        self.max_workers = max_workers
+        self.cancelled = threading.Event()
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def manifest_path(self):
+        return os.path.join(self.destination, f"manifest.{self.manifest}")
+
+    def shard_path(self, number):
+        return os.path.join(self.destination, f"shard-{number:06d}.tar")
+
+    def _row_writer(self, f):
+        """Return a function writing one manifest row to ``f``."""
+        if self.manifest == "jsonl":
+            return lambda row: f.write(json.dumps(row, ensure_ascii=False) + "\n")
+        fields = ["image", "caption"] + (["shard", "key"] if self.shards else [])
+        writer = csv.DictWriter(f, fields, extrasaction="ignore")
+        writer.writeheader()
+        return writer.writerow
+
+    def export(self, directory, tags_of, image_names, total=None, progress=None):
+        """Export ``image_names`` (any iterable) of the dataset in ``directory``; ``tags_of(name)`` gives captions.
+
+        ``progress(done, total)`` is called from this thread as images are
+        written. Returns {"images", "shards", "skipped"}, or None if
+        cancelled; a cancelled export leaves the shards finished so far.
+
+        With shards, a shard's manifest rows are written once its writer
+        returns, in shard order and without the images it couldn't read.
+        """
+        os.makedirs(self.destination, exist_ok=True)
+        exported = 0
+        skipped = []
+        shard = []  # (image_path, key, caption)
+        shard_rows = []
+        shard_bytes = 0
+        shard_count = 0
+        pending = deque()  # (future, rows) per shard, in shard order
+
+        def collect(block):
+            """Write the rows of the finished shards at the front of ``pending``, waiting for the first if ``block``."""
+            nonlocal exported
+            collected = False
+            while pending and (block or pending[0][0].done()):
+                future, rows = pending.popleft()
+                shard_skipped = future.result()
+                skipped.extend(shard_skipped)
+                unread = set(shard_skipped)
+                for row in rows:
+                    if os.path.join(directory, row["image"]) not in unread:
+                        write_row(row)
+                        exported += 1
+                block = False
+                collected = True
+            if collected and progress is not None:
+                progress(exported, total)
+
+        def submit():
+            nonlocal shard, shard_rows, shard_bytes, shard_count
+            collect(block=False)
+            # Wait for a writer before queueing more than two shards each, which bounds memory
+            if len(pending) >= self.max_workers * 2:
+                collect(block=True)
+            future = executor.submit(write_shard, self.shard_path(shard_count), shard, self.cancelled)
+            pending.append((future, shard_rows))
+            shard, shard_rows, shard_bytes, shard_count = [], [], 0, shard_count + 1
+
+        manifest_path = self.manifest_path()
+        temp_path = f"{manifest_path}.tmp"
+        with open(temp_path, "w", encoding="utf-8", newline="") as f, \
+                ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            write_row = self._row_writer(f)
+            try:
+                for image_name in image_names:
+                    if self.cancelled.is_set():
+                        break
+                    tags = export_tags(tags_of(image_name), self.keep_tokens, self.max_tags, self.rng)
+                    row = {"image": image_name, "caption": ", ".join(tags), "tags": tags}
+                    if not self.shards:
+                        write_row(row)
+                        exported += 1
+                        if progress is not None and exported % PROGRESS_EVERY == 0:
+                            progress(exported, total)
+                        continue
+
+                    image_path = os.path.join(directory, image_name)
+                    try:
+                        size = os.path.getsize(image_path) + len(row["caption"].encode("utf-8")) + 2 * TAR_OVERHEAD
+                    except OSError as e:
+                        log.warning("Error exporting %s: %s", image_path, e)
+                        skipped.append(image_path)
+                        continue
+                    if shard and (len(shard) >= self.shard_size or shard_bytes + size > self.shard_bytes):
+                        submit()
+                    row["key"] = sample_key(image_name)
+                    row["shard"] = os.path.basename(self.shard_path(shard_count))
+                    shard.append((image_path, row["key"], row["caption"]))
+                    shard_rows.append(row)
+                    shard_bytes += size
+                if shard and not self.cancelled.is_set():
+                    submit()
+                while pending:
+                    collect(block=True)
+            except BaseException:
+                self.cancelled.set()  # Stop the writers before the pool waits for them
+                raise
+        INSTRUMENTS.count("export.images", exported)
+
+        if self.cancelled.is_set():
+            os.remove(temp_path)
+            return None
+        os.replace(temp_path, manifest_path)
+        if progress is not None:
+            progress(exported, total)
+        return {"images": exported, "shards": shard_count, "skipped": skipped}
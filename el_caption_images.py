@@ -0,0 +1,118 @@
+"""Thumbnail and preview decoding for El Caption, needing only Pillow.
+
+Kept apart from the tkinter UI so the thumbnail worker processes and
+``benchmark.py`` can import it on machines without tkinter.
+"""
+
+import os
+import time
+import hashlib
+import logging
+
+from PIL import Image
+
+log = logging.getLogger("el_caption")
+
+THUMBNAIL_SIZE = 50
+
+# Modes Image.reduce() averages correctly; others are converted first
+REDUCE_MODES = ("L", "LA", "RGB", "RGBA", "RGBX", "CMYK", "YCbCr")
+
+
+def thumbnail_cache_key(image_name, stat, size):
+    """Return the cache key for an image with the given stat result."""
+    raw = f"{image_name}|{stat.st_mtime_ns}|{stat.st_size}|{size}"
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+
+def thumbnail_cache_path(cache_dir, key):
+    """Return the cache file path for a key (fanned out into 256 buckets)."""
+    return os.path.join(cache_dir, key[:2], key + ".png")
+
+
+def reduce_image(img, factor):
+    """Integer-downscale an image, first converting modes ``reduce`` can't average (palette, bilevel, 16-bit)."""
+    if img.mode not in REDUCE_MODES:
+        img = img.convert("RGBA" if "A" in img.mode or "transparency" in img.info else "RGB")
+    return img.reduce(factor)
+
+
+def decode_thumbnail(image_path, size):
+    """Decode an image straight to thumbnail size, using reduced-resolution decoding where possible."""
+    img = Image.open(image_path)
+
+    # JPEG can decode at 1/2, 1/4 or 1/8 scale directly; a no-op for PNG
+    img.draft("RGB", (size, size))
+
+    # Cheap integer downscale before the final resampling pass
+    factor = min(img.width // (size * 2), img.height // (size * 2))
+    if factor > 1:
+        img = reduce_image(img, factor)
+
+    img.thumbnail((size, size))
+    if img.mode not in ("RGB", "RGBA"):
+        img = img.convert("RGBA" if "A" in img.mode or "transparency" in img.info else "RGB")
+    return img
+
+
+def store_thumbnail(cache_dir, key, img):
+    """Atomically write a thumbnail into the cache and return its size in bytes."""
+    cache_path = thumbnail_cache_path(cache_dir, key)
+    temp_path = f"{cache_path}.{os.getpid()}.tmp"
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    img.save(temp_path, format="PNG", compress_level=1)
+    os.replace(temp_path, cache_path)
+    return os.path.getsize(cache_path)
+
+
+def render_thumbnail(directory, cache_dir, image_name, size):
+    """Worker job: return (key, bytes written, mode, size, pixels, decode seconds) for an image's thumbnail.
+
+    Runs in a worker process. A cache hit is a read of a small PNG; a miss
+    decodes the original and writes the cache entry. Decode seconds is 0 on
+    a hit.
+    """
+    image_path = os.path.join(directory, image_name)
+    key = thumbnail_cache_key(image_name, os.stat(image_path), size)
+
+    try:
+        img = Image.open(thumbnail_cache_path(cache_dir, key))
+        img.load()
+    except OSError:
+        img = None
+
+    written = 0
+    decode_seconds = 0.0
+    if img is None:
+        started = time.perf_counter()
+        img = decode_thumbnail(image_path, size)
+        decode_seconds = time.perf_counter() - started
+        try:
+            written = store_thumbnail(cache_dir, key, img)
+        except OSError as e:
+            # A read-only dataset still works, it just isn't cached
+            log.warning("Error caching thumbnail for %s: %s", image_name, e)
+
+    return key, written, img.mode, img.size, img.tobytes(), decode_seconds
+
+
+def decode_preview(image_path, max_width, max_height):
+    """Decode an image scaled to fit (max_width, max_height), never upscaling.
+
+    Uses reduced-resolution decoding (``draft`` for JPEG, ``reduce`` otherwise)
+    when the target is much smaller than the original, then finishes with LANCZOS.
+    """
+    img = Image.open(image_path)
+    width, height = img.size
+
+    # Calculate scaling
+    scale = min(max_width / width, max_height / height, 1)  # Do not upscale
+    new_width = max(1, int(width * scale))
+    new_height = max(1, int(height * scale))
+
+    img.draft("RGB", (new_width, new_height))
+    factor = min(img.width // (new_width * 2), img.height // (new_height * 2))
+    if factor > 1:
+        img = reduce_image(img, factor)
+
+    return img.resize((new_width, new_height), Image.Resampling.LANCZOS)  # Use LANCZOS for resizing
@@ -0,0 +1,548 @@
+"""SQLite-backed caption store for El Caption datasets too large to hold in memory.
+
+The ``.txt`` sidecars stay the source of truth. ``CaptionStore.sync()``
+pulls in captions added, changed or deleted on disk since the last sync
+(only changed files are read), edits made through the store are marked
+dirty and ``flush()`` writes them back atomically. Filter queries are
+compiled to SQL and results are read a page at a time::
+
+    with CaptionStore("./dataset") as store:
+        store.sync()
+        print(store.count("orange hair, !(hat)"))
+        for image_name in store.page("orange hair", offset=0, limit=100):
+            print(image_name, store.tags_of(image_name))
+
+``StoreDataset`` puts a synced store behind the parts of the Dataset
+interface the app uses, so the app can page its grid out of the store.
+"""
+
+import os
+import re
+import sqlite3
+import functools
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from el_caption_core import (
+    CACHE_DIR_NAME,
+    INSTRUMENTS,
+    DirectoryScanner,
+    caption_file_stat,
+    compile_filter_query,
+    merge_tags,
+    natural_sort_key,
+    write_caption_file,
+)
+
+SCHEMA_VERSION = 1
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS images (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE,
+    position INTEGER NOT NULL,  -- Natural sort order of the names
+    caption_mtime_ns INTEGER,  -- NULL when the image has no caption file
+    caption_size INTEGER,
+    dirty INTEGER NOT NULL DEFAULT 0  -- Edited here, not yet written to the .txt
+);
+CREATE INDEX IF NOT EXISTS images_position ON images (position);
+CREATE INDEX IF NOT EXISTS images_dirty ON images (dirty) WHERE dirty;
+
+CREATE TABLE IF NOT EXISTS tags (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE
+);
+
+CREATE TABLE IF NOT EXISTS image_tags (
+    image_id INTEGER NOT NULL,
+    position INTEGER NOT NULL,  -- Order of the tag in the caption
+    tag_id INTEGER NOT NULL,
+    PRIMARY KEY (image_id, position)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS image_tags_tag ON image_tags (tag_id, image_id);
+"""
+
+
+def store_path(directory):
+    return os.path.join(directory, CACHE_DIR_NAME, "captions.sqlite3")
+
+
+@functools.lru_cache(maxsize=64)
+def _compiled(pattern):
+    return re.compile(pattern)
+
+
+def _regexp(pattern, value):
+    """SQLite REGEXP operator, used for wildcard tags."""
+    return value is not None and _compiled(pattern).match(value) is not None
+
+
+def filter_sql(node):
+    """Translate a FilterQuery tree into ``(where clause over images, parameters)``."""
+    kind = node[0]
+    if kind == "all":
+        return "1", []
+    if kind == "tag":
+        return (
+            "images.id IN (SELECT image_id FROM image_tags WHERE tag_id = (SELECT id FROM tags WHERE name = ?))",
+            [node[1]],
+        )
+    if kind == "glob":
+        return (
+            "images.id IN (SELECT image_id FROM image_tags WHERE tag_id IN (SELECT id FROM tags WHERE name REGEXP ?))",
+            [node[1].pattern],
+        )
+    if kind == "not":
+        clause, params = filter_sql(node[1])
+        return f"NOT ({clause})", params
+
+    clauses = []
+    params = []
+    for child in node[1]:
+        clause, child_params = filter_sql(child)
+        clauses.append(f"({clause})")
+        params.extend(child_params)
+    return f" {'AND' if kind == 'and' else 'OR'} ".join(clauses), params
+
+
+class CaptionStore:
+    """Images, tags in caption order and caption file metadata in one SQLite database.
+
+    Edits happen inside a transaction: ``flush()`` writes the dirty captions
+    and commits, ``rollback()`` forgets them.
+    """
+
+    def __init__(self, directory, path=None, roots=("",), recursive=False):
+        self.directory = directory
+        self.roots = roots  # Folders stored, relative to directory; see list_dataset_files
+        self.recursive = recursive  # Also store the images in subfolders, named by relative path
+        self.path = path or store_path(directory)
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.connection = sqlite3.connect(self.path, check_same_thread=False)
+        self.connection.create_function("regexp", 2, _regexp, deterministic=True)
+        self.connection.execute("PRAGMA journal_mode = WAL")
+        self.connection.execute("PRAGMA synchronous = NORMAL")
+        if self.connection.execute("PRAGMA user_version").fetchone()[0] != SCHEMA_VERSION:
+            self.connection.executescript(
+                "DROP TABLE IF EXISTS images; DROP TABLE IF EXISTS tags; DROP TABLE IF EXISTS image_tags;"
+                + SCHEMA
+                + f"PRAGMA user_version = {SCHEMA_VERSION};"
+            )
+        self.tag_ids = dict(self.connection.execute("SELECT name, id FROM tags").fetchall())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+        return False
+
+    def close(self):
+        """Close the database, dropping any edits that weren't flushed."""
+        self.connection.rollback()
+        self.connection.close()
+
+    def caption_path(self, image_name):
+        return os.path.join(self.directory, os.path.splitext(image_name)[0] + ".txt")
+
+    def _tag_id(self, tag):
+        tag_id = self.tag_ids.get(tag)
+        if tag_id is None:
+            tag_id = self.tag_ids[tag] = self.connection.execute("INSERT INTO tags (name) VALUES (?)", (tag,)).lastrowid
+        return tag_id
+
+    def _image_id(self, image_name):
+        row = self.connection.execute("SELECT id FROM images WHERE name = ?", (image_name,)).fetchone()
+        if row is None:
+            raise KeyError(image_name)
+        return row[0]
+
+    def _write_tags(self, image_id, tags):
+        self.connection.execute("DELETE FROM image_tags WHERE image_id = ?", (image_id,))
+        self.connection.executemany(
+            "INSERT INTO image_tags (image_id, position, tag_id) VALUES (?, ?, ?)",
+            [(image_id, position, self._tag_id(tag)) for position, tag in enumerate(tags)],
+        )
+
+    def _read_tags(self, image_id):
+        return [
+            name for name, in self.connection.execute(
+                "SELECT tags.name FROM image_tags JOIN tags ON tags.id = image_tags.tag_id"
+                " WHERE image_id = ? ORDER BY image_tags.position",
+                (image_id,),
+            )
+        ]
+
+    def sync(self, max_workers=8):
+        """Bring the store in line with the directory, reading only captions whose mtime or size changed.
+
+        Returns ``(added, changed, removed, conflicts)`` lists of image names.
+        Conflicts are captions edited in the store and on disk since the last
+        sync; the version on disk wins.
+        """
+        stored = {
+            name: (image_id, position, (mtime_ns, size) if mtime_ns is not None else None, dirty)
+            for image_id, name, position, mtime_ns, size, dirty in self.connection.execute(
+                "SELECT id, name, position, caption_mtime_ns, caption_size, dirty FROM images"
+            )
+        }
+        # Tags of unchanged captions aren't needed, the scanner only reports their stat
+        known = {name: (caption_stat, ()) for name, (_, _, caption_stat, _) in stored.items()}
+        scanner = DirectoryScanner(
+            self.directory, known=known, max_workers=max_workers, roots=self.roots, recursive=self.recursive
+        )
+
+        added = []
+        changed = []
+        conflicts = []
+        seen = set()
+        position = 0
+        with INSTRUMENTS.timer("store.sync"):
+            for batch, _, _ in scanner.batches():
+                for image_name, tags, caption_stat in batch:
+                    seen.add(image_name)
+                    mtime_ns, size = caption_stat if caption_stat is not None else (None, None)
+                    previous = stored.get(image_name)
+                    if previous is None:
+                        image_id = self.connection.execute(
+                            "INSERT INTO images (name, position, caption_mtime_ns, caption_size) VALUES (?, ?, ?, ?)",
+                            (image_name, position, mtime_ns, size),
+                        ).lastrowid
+                        self._write_tags(image_id, tags)
+                        added.append(image_name)
+                    else:
+                        image_id, old_position, old_stat, dirty = previous
+                        if caption_stat != old_stat:
+                            if dirty:
+                                conflicts.append(image_name)
+                            self.connection.execute(
+                                "UPDATE images SET position = ?, caption_mtime_ns = ?, caption_size = ?, dirty = 0"
+                                " WHERE id = ?",
+                                (position, mtime_ns, size, image_id),
+                            )
+                            self._write_tags(image_id, tags)
+                            changed.append(image_name)
+                        elif position != old_position:
+                            self.connection.execute("UPDATE images SET position = ? WHERE id = ?", (position, image_id))
+                    position += 1
+
+            removed = [image_name for image_name in stored if image_name not in seen]
+            removed.sort(key=natural_sort_key)
+            for image_name in removed:
+                image_id = stored[image_name][0]
+                self.connection.execute("DELETE FROM image_tags WHERE image_id = ?", (image_id,))
+                self.connection.execute("DELETE FROM images WHERE id = ?", (image_id,))
+            self.connection.commit()
+        return added, changed, removed, conflicts
+
+    def flush(self, max_workers=8):
+        """Write every dirty caption to its ``.txt`` and commit.
+
+        A caption changed on disk since it was synced is not overwritten; it
+        stays dirty and the next ``sync()`` loads the version on disk.
+        Returns ``(written, conflicts)`` lists of image names.
+        """
+        dirty = self.connection.execute(
+            "SELECT id, name, caption_mtime_ns, caption_size FROM images WHERE dirty ORDER BY position"
+        ).fetchall()
+        jobs = [
+            (image_id, image_name, (mtime_ns, size) if mtime_ns is not None else None, self._read_tags(image_id))
+            for image_id, image_name, mtime_ns, size in dirty
+        ]
+
+        def write(job):
+            image_id, image_name, expected_stat, tags = job
+            tag_path = self.caption_path(image_name)
+            if caption_file_stat(tag_path) != expected_stat:
+                return image_id, image_name, None
+            stat = write_caption_file(tag_path, tags)
+            return image_id, image_name, (stat.st_mtime_ns, stat.st_size)
+
+        written = []
+        conflicts = []
+        with INSTRUMENTS.timer("store.flush"), ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for image_id, image_name, caption_stat in executor.map(write, jobs):
+                if caption_stat is None:
+                    conflicts.append(image_name)
+                    continue
+                self.connection.execute(
+                    "UPDATE images SET caption_mtime_ns = ?, caption_size = ?, dirty = 0 WHERE id = ?",
+                    (caption_stat[0], caption_stat[1], image_id),
+                )
+                written.append(image_name)
+        self.connection.commit()
+        return written, conflicts
+
+    def rollback(self):
+        """Forget edits made since the last flush or sync."""
+        self.connection.rollback()
+        self.tag_ids = dict(self.connection.execute("SELECT name, id FROM tags").fetchall())
+
+    def tags_of(self, image_name):
+        """Return an image's tags in caption order."""
+        return self._read_tags(self._image_id(image_name))
+
+    def position_of(self, image_name):
+        """Return an image's index in dataset order."""
+        row = self.connection.execute("SELECT position FROM images WHERE name = ?", (image_name,)).fetchone()
+        if row is None:
+            raise KeyError(image_name)
+        return row[0]
+
+    def set_tags(self, image_name, tags):
+        """Replace an image's tags; written to disk by the next ``flush()``."""
+        image_id = self._image_id(image_name)
+        self._write_tags(image_id, tags)
+        self.connection.execute("UPDATE images SET dirty = 1 WHERE id = ?", (image_id,))
+
+    def _where(self, query):
+        if query is None:
+            return "1", []
+        return filter_sql(compile_filter_query(query.strip()).tree)
+
+    def count(self, query=None):
+        """Return how many images match a filter query (all of them for None)."""
+        clause, params = self._where(query)
+        return self.connection.execute(f"SELECT COUNT(*) FROM images WHERE {clause}", params).fetchone()[0]
+
+    def page(self, query=None, offset=0, limit=100):
+        """Return up to ``limit`` matching image names in dataset order, skipping the first ``offset``."""
+        clause, params = self._where(query)
+        with INSTRUMENTS.timer("store.page"):
+            return [
+                name for name, in self.connection.execute(
+                    f"SELECT name FROM images WHERE {clause} ORDER BY position LIMIT ? OFFSET ?",
+                    params + [limit, offset],
+                )
+            ]
+
+    def iter_matches(self, query=None, page_size=1000):
+        """Yield every matching image name in dataset order, one page of rows at a time."""
+        clause, params = self._where(query)
+        cursor = self.connection.execute(f"SELECT name FROM images WHERE {clause} ORDER BY position", params)
+        while True:
+            rows = cursor.fetchmany(page_size)
+            if not rows:
+                return
+            for name, in rows:
+                yield name
+
+    def _edit(self, tag, where, edit):
+        """Apply ``edit(tags)`` to images carrying ``tag`` (and matching ``where``); return those that changed."""
+        clause, params = self._where(where)
+        carriers = self.connection.execute(
+            "SELECT images.id, images.name FROM images WHERE images.id IN"
+            " (SELECT image_id FROM image_tags WHERE tag_id = (SELECT id FROM tags WHERE name = ?))"
+            f" AND ({clause}) ORDER BY images.position",
+            [tag] + params,
+        ).fetchall()
+        touched = []
+        for image_id, image_name in carriers:
+            tags = self._read_tags(image_id)
+            new_tags = edit(tags)
+            if new_tags != tags:
+                self._write_tags(image_id, new_tags)
+                self.connection.execute("UPDATE images SET dirty = 1 WHERE id = ?", (image_id,))
+                touched.append(image_name)
+        return touched
+
+    def delete_tag(self, tag, where=None):
+        """Remove ``tag`` from matching images; return the images that changed, in order."""
+        def edit(tags):
+            tags = list(tags)
+            tags.remove(tag)
+            return tags
+        return self._edit(tag, where, edit)
+
+    def rename_tag(self, old_tag, new_tag, where=None):
+        """Rename ``old_tag`` on matching images, merging into ``new_tag`` where both exist."""
+        if old_tag == new_tag:
+            return []
+        return self._edit(old_tag, where, lambda tags: merge_tags(tags, {old_tag}, new_tag))
+
+    def add_tag(self, tag, where):
+        """Append ``tag`` to every image matching ``where`` that lacks it; return those images."""
+        clause, params = self._where(where)
+        candidates = self.connection.execute(
+            f"SELECT images.id, images.name FROM images WHERE ({clause}) AND images.id NOT IN"
+            " (SELECT image_id FROM image_tags WHERE tag_id = (SELECT id FROM tags WHERE name = ?))"
+            " ORDER BY images.position",
+            params + [tag],
+        ).fetchall()
+        tag_id = self._tag_id(tag)
+        for image_id, _ in candidates:
+            self.connection.execute(
+                "INSERT INTO image_tags (image_id, position, tag_id)"
+                " SELECT ?, COALESCE(MAX(position) + 1, 0), ? FROM image_tags WHERE image_id = ?",
+                (image_id, tag_id, image_id),
+            )
+            self.connection.execute("UPDATE images SET dirty = 1 WHERE id = ?", (image_id,))
+        return [image_name for _, image_name in candidates]
+
+    def tag_counts(self):
+        """Return {tag: number of images carrying it}."""
+        return dict(self.connection.execute(
+            "SELECT tags.name, COUNT(DISTINCT image_tags.image_id) FROM image_tags"
+            " JOIN tags ON tags.id = image_tags.tag_id GROUP BY image_tags.tag_id"
+        ))
+
+    def stats(self, top=20):
+        """Summarise the store as a JSON-friendly dict, like Dataset.stats."""
+        images, captioned = self.connection.execute(
+            "SELECT COUNT(*), COUNT(caption_mtime_ns) FROM images"
+        ).fetchone()
+        occurrences = self.connection.execute("SELECT COUNT(*) FROM image_tags").fetchone()[0]
+        counts = self.tag_counts()
+        return {
+            "images": images,
+            "captioned": captioned,
+            "tags": len(counts),
+            "tag_occurrences": occurrences,
+            "mean_tags_per_image": occurrences / images if images else 0.0,
+            "top_tags": sorted(counts.items(), key=lambda item: (-item[1], natural_sort_key(item[0])))[:top],
+        }
+
+
+class StoreImages:
+    """The image names matching a filter query, read from a CaptionStore a page at a time.
+
+    A read-only sequence: the length is counted once, indexing fetches the
+    page holding the index (the last few are cached) and iterating streams
+    every match, so the app's grid only reads the rows it shows.
+    """
+
+    PAGE_SIZE = 200
+    CACHED_PAGES = 16
+
+    def __init__(self, store, query=None):
+        self.store = store
+        self.query = query
+        self.length = store.count(query)
+        self.pages = OrderedDict()  # page number -> image names, least recently used first
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self.length
+        if not 0 <= index < self.length:
+            raise IndexError(index)
+        number, offset = divmod(index, self.PAGE_SIZE)
+        page = self.pages.get(number)
+        if page is None:
+            page = self.pages[number] = self.store.page(self.query, number * self.PAGE_SIZE, self.PAGE_SIZE)
+            if len(self.pages) > self.CACHED_PAGES:
+                self.pages.popitem(last=False)
+        else:
+            self.pages.move_to_end(number)
+        return page[offset]
+
+    def __iter__(self):
+        return self.store.iter_matches(self.query)
+
+    def cached_index(self, image_name):
+        """Return the index of ``image_name`` if its page is cached (e.g. it is shown), else None."""
+        for number, page in self.pages.items():
+            if image_name in page:
+                return number * self.PAGE_SIZE + page.index(image_name)
+        return None
+
+
+class StorePositions:
+    """Read-only mapping of image name -> index in dataset order, looked up in a CaptionStore."""
+
+    def __init__(self, store):
+        self.store = store
+
+    def __getitem__(self, image_name):
+        return self.store.position_of(image_name)
+
+    def __contains__(self, image_name):
+        return self.get(image_name) is not None
+
+    def get(self, image_name, default=None):
+        try:
+            return self.store.position_of(image_name)
+        except KeyError:
+            return default
+
+
+class StoreTagCounts:
+    """How many images carry each tag, standing in for a Dataset's TagIndex in the app's tag lists."""
+
+    def __init__(self, counts):
+        self.counts = counts
+        self.changed = set()  # Tags whose count changed since take_changed()
+
+    def count(self, tag):
+        return self.counts.get(tag, 0)
+
+    def add(self, tag):
+        self.counts[tag] = self.counts.get(tag, 0) + 1
+        self.changed.add(tag)
+
+    def discard(self, tag):
+        count = self.counts.get(tag, 0) - 1
+        if count > 0:
+            self.counts[tag] = count
+        else:
+            self.counts.pop(tag, None)
+        self.changed.add(tag)
+
+    def take_changed(self):
+        """Return the tags whose count changed since the last call, and start over."""
+        changed, self.changed = self.changed, set()
+        return changed
+
+
+class StoreDataset:
+    """A synced CaptionStore behind the parts of the Dataset interface the app's grid, filter and tag lists use.
+
+    Only the tag counts are held in memory; image names are paged in by
+    StoreImages and captions read as they are shown. Edits go to the store
+    and reach the ``.txt`` files with its ``flush()``.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self.directory = store.directory
+        self.roots = store.roots
+        self.recursive = store.recursive
+        self.images = StoreImages(store)
+        self.image_positions = StorePositions(store)
+        self.tag_index = StoreTagCounts(store.tag_counts())
+
+    def caption_path(self, image_name):
+        return self.store.caption_path(image_name)
+
+    def tags_of(self, image_name):
+        """Return a new list of an image's tags in caption order."""
+        return self.store.tags_of(image_name)
+
+    def tag_count(self, tag):
+        return self.tag_index.count(tag)
+
+    def filter(self, query):
+        """Return the images matching a filter query as StoreImages; raises FilterSyntaxError."""
+        return StoreImages(self.store, query.strip())
+
+    def add_tag(self, image_name, tag):
+        """Append ``tag`` to an image's caption; return False if it already had it."""
+        tags = self.store.tags_of(image_name)
+        if tag in tags:
+            return False
+        self.store.set_tags(image_name, tags + [tag])
+        self.tag_index.add(tag)
+        return True
+
+    def remove_tag(self, image_name, tag):
+        """Remove the first occurrence of ``tag`` from an image; return False if it didn't have it."""
+        tags = self.store.tags_of(image_name)
+        if tag not in tags:
+            return False
+        tags.remove(tag)
+        self.store.set_tags(image_name, tags)
+        if tag not in tags:
+            self.tag_index.discard(tag)
+        return True